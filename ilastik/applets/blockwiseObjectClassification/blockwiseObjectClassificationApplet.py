@@ -35,7 +35,8 @@ class BlockwiseObjectClassificationApplet(StandardApplet):
 
     @property
     def broadcastingSlots(self):
-        return ['Classifier', 'LabelsCount', 'SelectedFeatures', 'BlockShape3dDict', 'HaloPadding3dDict']
+        return ['Classifier', 'LabelsCount', 'SelectedFeatures', 'BlockShape3dDict', 'HaloPadding3dDict',
+                'AutoHaloPadding', 'TrainingObjectExtent']
     
     @property
     def singleLaneGuiClass(self):
@@ -133,6 +133,10 @@ class BlockwiseObjectClassificationGui( LayerViewerGui ):
         halo_padding_dict['y'] = self._drawer.haloSpinBox_Y.value()
         halo_padding_dict['z'] = self._drawer.haloSpinBox_Z.value()
 
+        # Editing the halo overrides the halo derived from the labeled objects
+        if halo_padding_dict != haloPaddingSlot.value:
+            self.topLevelOperatorView.AutoHaloPadding.setValue( False )
+
         blockShapeSlot.setValue( block_shape_dict )
         haloPaddingSlot.setValue( halo_padding_dict )
         #make final output visible
@@ -14,12 +14,13 @@
 #
 # Copyright 2011-2014, the ilastik developers
 
-from ilastik.applets.base.appletSerializer import AppletSerializer, SerialDictSlot
+from ilastik.applets.base.appletSerializer import AppletSerializer, SerialSlot, SerialDictSlot
 
 class BlockwiseObjectClassificationSerializer(AppletSerializer):
     def __init__(self, topGroupName, operator):
         serialSlots = [SerialDictSlot(operator.BlockShape3dDict, selfdepends=True),
-                       SerialDictSlot(operator.HaloPadding3dDict, selfdepends=True)]
+                       SerialDictSlot(operator.HaloPadding3dDict, selfdepends=True),
+                       SerialSlot(operator.AutoHaloPadding, selfdepends=True)]
 
         super(BlockwiseObjectClassificationSerializer, self ).__init__(topGroupName,
                                                               slots=serialSlots,
@@ -0,0 +1,160 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+"""
+Stitching of object labels that were computed independently per block.
+
+Each block labels its objects with local ids.  Objects that cross a block
+face touch the neighboring block's face with foreground voxels, so the
+fragments on both sides belong to the same object (for the 6-neighborhood
+used by the object labeling).  All such fragments are merged into global
+object ids, which are numbered consecutively per time slice.
+"""
+import collections
+
+import numpy
+
+# The objects of a single 3d block (one time slice), restricted to the block itself (without halo):
+#  sizes:       voxel count of each local label (index 0 is the background)
+#  lower/upper: the first and last plane of the block's labels along each spatial axis,
+#               as (flat indices, labels) of the foreground voxels in that plane
+#  predictions: predicted class of each local label (may be empty)
+BlockObjects = collections.namedtuple('BlockObjects', ['sizes', 'lower', 'upper', 'predictions'])
+
+def _sparse_plane(plane):
+    plane = plane.ravel()
+    indices = numpy.flatnonzero(plane)
+    return indices, plane[indices]
+
+def block_objects(labels, predictions):
+    """
+    Summarize the labels of a 3d block for stitching.
+
+    :param labels: local labels of the block (without halo), 3d
+    :param predictions: predicted class per local label
+    """
+    labels = numpy.asarray(labels)
+    assert labels.ndim == 3
+    sizes = numpy.bincount(labels.ravel())
+    lower = [_sparse_plane(labels.take(0, axis=a)) for a in range(3)]
+    upper = [_sparse_plane(labels.take(-1, axis=a)) for a in range(3)]
+    return BlockObjects(sizes, lower, upper, numpy.asarray(predictions))
+
+
+class _UnionFind(object):
+    def __init__(self, n):
+        self.parent = numpy.arange(n)
+
+    def find(self, i):
+        parent = self.parent
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    def union(self, i, j):
+        ri, rj = self.find(i), self.find(j)
+        if ri != rj:
+            self.parent[max(ri, rj)] = min(ri, rj)
+
+    def roots(self):
+        roots = self.parent
+        while True:
+            next_roots = roots[roots]
+            if numpy.all(next_roots == roots):
+                return roots
+            roots = next_roots
+
+
+def stitch_blocks(block_shape, blocks):
+    """
+    Merge the object fragments of all blocks of one time slice into global objects.
+
+    :param block_shape: 3d shape of the blocks
+    :param blocks: dict of block start (3d) -> BlockObjects
+    :returns: (luts, predictions): luts[block start] maps the local labels of that block to
+              global object ids (0 stays the background), predictions maps each global id to
+              the predicted class of its largest fragment.
+    """
+    block_starts = sorted(blocks.keys())
+
+    # every local label of every block is a node
+    offsets = {}
+    nnodes = 0
+    for start in block_starts:
+        offsets[start] = nnodes
+        nnodes += len(blocks[start].sizes)
+    uf = _UnionFind(nnodes)
+
+    # merge fragments that touch across block faces
+    for start in block_starts:
+        for axis in range(3):
+            neighbor = list(start)
+            neighbor[axis] += block_shape[axis]
+            neighbor = tuple(neighbor)
+            if neighbor not in blocks:
+                continue
+            # foreground voxels at the same position of both planes
+            ia, a = blocks[start].upper[axis]
+            ib, b = blocks[neighbor].lower[axis]
+            if len(ia) == 0 or len(ib) == 0:
+                continue
+            pos = numpy.minimum(numpy.searchsorted(ib, ia), len(ib) - 1)
+            touching = ib[pos] == ia
+            pairs = set(zip(a[touching] + offsets[start], b[pos[touching]] + offsets[neighbor]))
+            for i, j in pairs:
+                uf.union(i, j)
+    roots = uf.roots()
+
+    # global ids, in order of the blocks and their local labels
+    sizes = numpy.zeros((nnodes,), dtype=numpy.int64)
+    preds = numpy.zeros((nnodes,), dtype=numpy.int64)
+    present = numpy.zeros((nnodes,), dtype=bool)
+    for start in block_starts:
+        obj = blocks[start]
+        o = offsets[start]
+        n = len(obj.sizes)
+        sizes[o:o+n] = obj.sizes
+        present[o+1:o+n] = obj.sizes[1:] > 0
+        npred = min(n, len(obj.predictions))
+        preds[o:o+npred] = obj.predictions[:npred]
+
+    global_ids = numpy.zeros((nnodes,), dtype=numpy.uint32)
+    present_roots = roots[present]
+    unique_roots, first = numpy.unique(present_roots, return_index=True)
+    # number the objects in order of their first fragment
+    order = numpy.argsort(first)
+    root_ids = numpy.zeros((nnodes,), dtype=numpy.uint32)
+    root_ids[unique_roots[order]] = numpy.arange(1, len(unique_roots) + 1)
+    global_ids[present] = root_ids[present_roots]
+
+    # each object gets the class of its largest fragment
+    nobjects = len(unique_roots)
+    predictions = numpy.zeros((nobjects + 1,), dtype=numpy.int64)
+    nodes = numpy.flatnonzero(present)
+    if len(nodes) > 0:
+        nodes = nodes[numpy.lexsort((-sizes[nodes], global_ids[nodes]))]
+        ids = global_ids[nodes]
+        is_first = numpy.ones(len(ids), dtype=bool)
+        is_first[1:] = ids[1:] != ids[:-1]
+        predictions[ids[is_first]] = preds[nodes[is_first]]
+
+    luts = {}
+    for start in block_starts:
+        o = offsets[start]
+        luts[start] = global_ids[o:o+len(blocks[start].sizes)]
+    return luts, predictions
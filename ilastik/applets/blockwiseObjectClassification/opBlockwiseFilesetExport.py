@@ -0,0 +1,177 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import copy
+import hashlib
+import logging
+
+import numpy
+
+from lazyflow.graph import Operator, InputSlot, OutputSlot, OrderedSignal
+from lazyflow.utility.io.blockwiseFileset import BlockwiseFileset
+from lazyflow.utility.fileLock import FileLock
+from lazyflow.utility.timer import Timer
+
+logger = logging.getLogger(__name__)
+
+class OpBlockwiseFilesetExport(Operator):
+    """
+    Writes images into blockwise filesets, one block at a time.
+
+    Each block is marked as available in its fileset as soon as it has been
+    written, and blocks that are already available are skipped.  An export
+    that was interrupted therefore continues with the first incomplete block
+    when it is executed again.
+
+    The fileset blocks have the spatial shape of BlockShape3dDict (and a
+    single time slice), so each of them is computed by exactly one block
+    of the blockwise object classification.
+
+    With TaskCount > 1, only every TaskCount-th block (starting at
+    TaskIndex) is exported, so several processes can share the work.
+    The fileset descriptions are adjusted under a file lock, so only the
+    first task that sees a new blocking scheme resets the block statuses.
+    """
+    Inputs = InputSlot(level=1) # The images to export, all of the same shape
+    OutputDescriptions = InputSlot(level=1, stype='filestring') # One fileset description file per input
+    BlockShape3dDict = InputSlot() # A dict of SPATIAL block dims
+
+    TaskIndex = InputSlot(value=0)
+    TaskCount = InputSlot(value=1)
+
+    ReturnCode = OutputSlot()
+
+    def __init__(self, *args, **kwargs):
+        super( OpBlockwiseFilesetExport, self ).__init__( *args, **kwargs )
+        self.progressSignal = OrderedSignal()
+
+    def setupOutputs(self):
+        assert len(self.Inputs) == len(self.OutputDescriptions), \
+            "Need one fileset description per input, got {} descriptions for {} inputs"\
+            .format( len(self.OutputDescriptions), len(self.Inputs) )
+        shapes = set( slot.meta.shape for slot in self.Inputs )
+        assert len(shapes) <= 1, "All exported images must have the same shape, got: {}".format( list(shapes) )
+
+        self.ReturnCode.meta.dtype = bool
+        self.ReturnCode.meta.shape = (1,)
+
+    def execute(self, slot, subindex, ignored_roi, result):
+        filesets = []
+        try:
+            for inputSlot, descriptionSlot in zip( self.Inputs, self.OutputDescriptions ):
+                filesets.append( self._prepareFileset( inputSlot, descriptionSlot.value ) )
+            if filesets:
+                with Timer() as exportTimer:
+                    self._exportBlocks( filesets )
+                logger.info( "Finished blockwise export in {} seconds".format( exportTimer.seconds() ) )
+        finally:
+            for fileset in filesets:
+                fileset.close()
+
+        result[0] = True
+        return result
+
+    def _exportBlocks(self, filesets):
+        shape = self.Inputs[0].meta.shape
+        block_rois = self.getTaskBlockRois( filesets[0], self.TaskIndex.value, self.TaskCount.value )
+
+        def isComplete(block_roi):
+            return all( fileset.getBlockStatus( block_roi[0] ) == BlockwiseFileset.BLOCK_AVAILABLE
+                        for fileset in filesets )
+
+        remaining_rois = filter( lambda block_roi: not isComplete(block_roi), block_rois )
+        logger.info( "Exporting {} of {} blocks ({} already done)"
+                     .format( len(remaining_rois), len(block_rois), len(block_rois) - len(remaining_rois) ) )
+
+        self.progressSignal( 0 )
+        for i, (block_start, block_stop) in enumerate( remaining_rois ):
+            block_stop = numpy.minimum( block_stop, shape )
+            for inputSlot, fileset in zip( self.Inputs, filesets ):
+                if fileset.getBlockStatus( block_start ) == BlockwiseFileset.BLOCK_AVAILABLE:
+                    continue
+                data = inputSlot( block_start, block_stop ).wait()
+                fileset.writeData( (block_start, block_stop), data )
+
+                # Only a completely written block is marked as available
+                fileset.setBlockStatus( block_start, BlockwiseFileset.BLOCK_AVAILABLE )
+            logger.debug( "Exported block {}".format( (tuple(block_start), tuple(block_stop)) ) )
+            self.progressSignal( 100 * (i+1) / len(remaining_rois) )
+
+    @classmethod
+    def getTaskBlockRois(cls, fileset, taskIndex=0, taskCount=1):
+        """
+        The rois of the blocks that are exported by the given task, in order.
+        """
+        block_rois = sorted( fileset.getAllBlockRois(), key=lambda block_roi: tuple(block_roi[0]) )
+        return block_rois[taskIndex::taskCount]
+
+    def _prepareFileset(self, inputSlot, descriptionPath):
+        """
+        Adjust the fileset description to the image (axes, shape, dtype and blocks) and open the fileset.
+        If the blocking changed since the last export, all blocks are marked as not available.
+        """
+        # Other tasks may prepare the same fileset at the same time.
+        # The first one updates the description, the others find it up to date.
+        with FileLock( descriptionPath ):
+            return self._prepareLockedFileset( inputSlot, descriptionPath )
+
+    def _prepareLockedFileset(self, inputSlot, descriptionPath):
+        originalDescription = BlockwiseFileset.readDescription( descriptionPath )
+        datasetDescription = copy.deepcopy( originalDescription )
+
+        tagged_shape = inputSlot.meta.getTaggedShape()
+        datasetDescription.axes = "".join( tagged_shape.keys() )
+        datasetDescription.shape = list( tagged_shape.values() )
+        datasetDescription.view_shape = list( tagged_shape.values() )
+
+        block_shape_dict = self.BlockShape3dDict.value
+        block_shape = []
+        for k, n in tagged_shape.items():
+            if k in 'xyz':
+                block_shape.append( min( block_shape_dict[k], n ) )
+            elif k == 't':
+                block_shape.append( 1 )
+            else:
+                block_shape.append( n )
+        datasetDescription.block_shape = block_shape
+
+        dtype = inputSlot.meta.dtype
+        if type(dtype) is numpy.dtype:
+            dtype = dtype.type
+        datasetDescription.dtype = dtype().__class__.__name__
+
+        # A unique hash for this blocking scheme.
+        # If it changes, we can't use any previous data.
+        sha = hashlib.sha1()
+        sha.update( str( tuple( datasetDescription.block_shape ) ) )
+        sha.update( datasetDescription.axes )
+        sha.update( datasetDescription.block_file_name_format )
+        datasetDescription.hash_id = sha.hexdigest()
+
+        if datasetDescription != originalDescription:
+            logger.info( "Overwriting dataset description: {}".format( descriptionPath ) )
+            BlockwiseFileset.writeDescription( descriptionPath, datasetDescription )
+
+        fileset = BlockwiseFileset( descriptionPath, 'a' )
+        if datasetDescription.hash_id != originalDescription.hash_id:
+            # Make sure no blocks of a previous blocking scheme are used.
+            logger.info( "Blocking scheme changed, resetting all blocks of: {}".format( descriptionPath ) )
+            for block_start, block_stop in fileset.getAllBlockRois():
+                fileset.setBlockStatus( block_start, BlockwiseFileset.BLOCK_NOT_AVAILABLE )
+        return fileset
+
+    def propagateDirty(self, slot, subindex, roi):
+        self.ReturnCode.setDirty( slice(None) )
@@ -17,13 +17,15 @@
 # Built-in
 import logging
 import collections
+from functools import partial
 
 # Third-party
 import numpy
+import psutil
 
 # lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.request import RequestLock
+from lazyflow.request import Request, RequestLock, RequestPool
 from lazyflow.roi import getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice
 from lazyflow.operators import OpSubRegion
 from lazyflow.stype import Opaque
@@ -31,9 +33,10 @@ from lazyflow.rtype import List
 
 # ilastik
 from ilastik.utility import bind
-from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtraction
+from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtraction, max_margin
 from ilastik.applets.objectClassification.opObjectClassification import OpObjectPredict, OpRelabelSegmentation, OpMaxLabel
 from ilastik.applets.base.applet import DatasetConstraintError
+from objectStitching import block_objects, stitch_blocks
 
 logger = logging.getLogger(__name__)
 traceLogger = logging.getLogger("TRACE." + __name__)
@@ -48,6 +51,8 @@ class OpSingleBlockObjectPrediction( Operator ):
     LabelsCount = InputSlot()
     
     PredictionImage = OutputSlot()
+    LabelImage = OutputSlot() # The block's own object labels (without halo)
+    Predictions = OutputSlot(stype=Opaque, rtype=List) # Predicted class of each label, by time
     BlockwiseRegionFeatures = OutputSlot() # Indexed by (t,c)
 
     # Schematic:
@@ -121,6 +126,8 @@ class OpSingleBlockObjectPrediction( Operator ):
         self._opPredictionImage.Image.connect( self._opExtract.LabelImage ) 
         self._opPredictionImage.Features.connect( self._opExtract.RegionFeatures )
         self._opPredictionImage.ObjectMap.connect( self._opPredict.Predictions )
+
+        self.Predictions.connect( self._opPredict.Predictions )
         
     def setupOutputs(self):
         tagged_input_shape = self.RawImage.meta.getTaggedShape()
@@ -147,17 +154,22 @@ class OpSingleBlockObjectPrediction( Operator ):
         self.PredictionImage.meta.assignFrom( self._opPredictionImage.Output.meta )
         self.PredictionImage.meta.shape = tuple( numpy.subtract( self.block_roi[1], self.block_roi[0] ) )
 
+        self.LabelImage.meta.assignFrom( self._opExtract.LabelImage.meta )
+        self.LabelImage.meta.shape = self.PredictionImage.meta.shape
+
         # Forward dirty regions to our own output
         self._opPredictionImage.Output.notifyDirty( self._handleDirtyPrediction )
     
     def execute(self, slot, subindex, roi, destination):
-        assert slot == self.PredictionImage, "Unknown input slot"
-        assert (numpy.array(roi.stop) <= self.PredictionImage.meta.shape).all(), "Roi is out-of-bounds"
+        assert slot == self.PredictionImage or slot == self.LabelImage, "Unknown input slot"
+        assert (numpy.array(roi.stop) <= slot.meta.shape).all(), "Roi is out-of-bounds"
 
         # Extract from the output (discard halo)
         halo_offset = numpy.subtract(self.block_roi[0], self._halo_roi[0])
         adjusted_roi = ( halo_offset + roi.start,
                          halo_offset + roi.stop )
+        if slot == self.LabelImage:
+            return self._opExtract.LabelImage(*adjusted_roi).writeInto(destination).wait()
         return self._opPredictionImage.Output(*adjusted_roi).writeInto(destination).wait()
 
     def propagateDirty(self, slot, subindex, roi):
@@ -212,13 +224,42 @@ class OpBlockwiseObjectClassification( Operator ):
     BlockShape3dDict = InputSlot( value={'x' : 512, 'y' : 512, 'z' : 512} ) # A dict of SPATIAL block dims
     HaloPadding3dDict = InputSlot( value={'x' : 64, 'y' : 64, 'z' : 64} ) # A dict of spatial block dims
 
+    # If True, the halo is derived from the labeled training objects instead of HaloPadding3dDict:
+    # The largest extent of the labeled objects plus the margin of the selected features.
+    # Set to False to use HaloPadding3dDict as a manual override.
+    AutoHaloPadding = InputSlot( value=True )
+    TrainingObjectExtent = InputSlot( stype=Opaque, optional=True ) # See OpObjectClassification.LabeledObjectExtent
+
+    # Maximum number of block pipelines (and their caches) that are kept alive.
+    # The least recently used pipelines are deleted first.
+    # 0 means: as many as fit into half of the available memory.
+    MaxBlockPipelines = InputSlot( value=0 )
+
     PredictionImage = OutputSlot()
     BlockwiseRegionFeatures = OutputSlot()
+    BlockLabelImage = OutputSlot() # Object labels of each block, numbered separately per block (no stitching)
+
+    # Objects that cross block boundaries are stitched together into global objects.
+    # Note: The first request of these outputs processes all blocks of the volume.
+    LabelImage = OutputSlot() # Global object ids, numbered per time slice
+    StitchedPredictionImage = OutputSlot() # Each object has the predicted class of its largest block fragment
     
     def __init__(self, *args, **kwargs):
         super( self.__class__, self ).__init__(*args, **kwargs)
-        self._blockPipelines = {} # indexed by blockstart
+        self._blockPipelines = collections.OrderedDict() # indexed by blockstart, least recently used first
+        self._pipelineUsers = collections.defaultdict(int) # blockstart -> number of requests using the pipeline
+        self._retiredPipelines = {} # replaced pipelines that are still in use -> number of requests using them
         self._lock = RequestLock()
+
+        self._halo_padding_dict = None # See _getHaloPaddingDict()
+        self._haloLock = RequestLock()
+        self._pipeline_halo_padding_dict = None # The halo of the existing pipelines
+        self._budget = None # (halo padding dict, budget), see _getBudget()
+
+        self._stitching = None # (luts, predictions), see _getStitching()
+        self._stitchingGeneration = 0 # incremented whenever the stitching becomes invalid
+        self._stitchingLock = RequestLock() # held while stitching
+        self._stitchingStateLock = RequestLock() # guards _stitching and _stitchingGeneration
         
     def setupOutputs(self):
         # Check for preconditions.
@@ -238,8 +279,15 @@ class OpBlockwiseObjectClassification( Operator ):
         prediction_tagged_shape['c'] = 1
         self.PredictionImage.meta.shape = tuple( prediction_tagged_shape.values() )
 
+        self.StitchedPredictionImage.meta.assignFrom( self.PredictionImage.meta )
+        self.LabelImage.meta.assignFrom( self.PredictionImage.meta )
+        self.LabelImage.meta.dtype = numpy.uint32
+        self.BlockLabelImage.meta.assignFrom( self.LabelImage.meta )
+
         self._block_shape_dict = self.BlockShape3dDict.value
-        self._halo_padding_dict = self.HaloPadding3dDict.value
+        self._halo_padding_dict = None
+        self._budget = None
+        self._invalidateStitching()
 
         block_shape = self._getFullShape( self._block_shape_dict )
         
@@ -253,34 +301,223 @@ class OpBlockwiseObjectClassification( Operator ):
             return self._executePredictionImage( roi, destination )
         elif slot == self.BlockwiseRegionFeatures:
             return self._executeBlockwiseRegionFeatures( roi, destination )
+        elif slot == self.LabelImage or slot == self.StitchedPredictionImage:
+            return self._executeStitchedImage( slot, roi, destination )
+        elif slot == self.BlockLabelImage:
+            return self._executeBlockLabelImage( roi, destination )
         else:
             assert False, "Unknown output slot: {}".format( slot.name )
 
     def _executePredictionImage(self, roi, destination):
+        def write_prediction(opBlockPipeline, block_relative_roi, block_destination):
+            req = opBlockPipeline.PredictionImage( *block_relative_roi )
+            req.writeInto( block_destination )
+            req.wait()
+
+        self._processBlocks( roi, destination, write_prediction )
+        return destination
+
+    def _executeBlockLabelImage(self, roi, destination):
+        def write_labels(opBlockPipeline, block_relative_roi, block_destination):
+            req = opBlockPipeline.LabelImage( *block_relative_roi )
+            req.writeInto( block_destination )
+            req.wait()
+
+        self._processBlocks( roi, destination, write_labels )
+        return destination
+
+    def _executeStitchedImage(self, slot, roi, destination):
+        t_index = self.RawImage.meta.getAxisKeys().index('t')
+
+        def write_stitched(luts, predictions, opBlockPipeline, block_relative_roi, block_destination):
+            labels = opBlockPipeline.LabelImage( *block_relative_roi ).wait()
+            spatial_start = self._spatialBlockStart( opBlockPipeline.block_roi[0] )
+            t_start = opBlockPipeline.block_roi[0][t_index] + block_relative_roi[0][t_index]
+            for i in range(labels.shape[t_index]):
+                t = t_start + i
+                lut = luts[(spatial_start, t)]
+                if slot == self.StitchedPredictionImage:
+                    lut = predictions[t][lut]
+                labels_t = labels.take( [i], axis=t_index )
+                # Labels beyond the lut only occur if the block changed after the stitching,
+                # the result is discarded then (see below).
+                block_destination[ roiToSlice( *self._tSliceRoi( labels.shape, t_index, i ) ) ] = \
+                    lut.take( labels_t, mode='clip' )
+
+        # If a block changed while its labels were read, they may not match the stitching.
+        # Then the objects are stitched again and the blocks are read again.
+        while True:
+            with self._stitchingStateLock:
+                generation = self._stitchingGeneration
+            luts, predictions = self._getStitching()
+            self._processBlocks( roi, destination, partial( write_stitched, luts, predictions ) )
+            with self._stitchingStateLock:
+                if generation == self._stitchingGeneration:
+                    return destination
+            logger.debug( "Blocks changed while writing the stitched objects, trying again" )
+
+    @staticmethod
+    def _tSliceRoi(shape, t_index, i):
+        start = [0] * len(shape)
+        stop = list(shape)
+        start[t_index] = i
+        stop[t_index] = i+1
+        return start, stop
+
+    def _spatialBlockStart(self, block_start):
+        return tuple( s for k, s in zip( self.RawImage.meta.getAxisKeys(), block_start ) if k in 'xyz' )
+
+    def _processBlocks(self, roi, destination, func):
+        """
+        Call func(opBlockPipeline, block_relative_roi, block_destination) for each block that
+        intersects roi, in parallel.  block_destination is the view of destination that the
+        block's part of roi has to be written into (None if destination is None).
+        """
         # Determine intersecting blocks
         block_shape = self._getFullShape( self.BlockShape3dDict.value )
         block_starts = getIntersectingBlocks( block_shape, (roi.start, roi.stop) )
         block_starts = map( tuple, block_starts )
 
-        # Ensure that block pipelines exist (create first if necessary)
-        for block_start in block_starts:
-            self._ensurePipelineExists(block_start)
-
         # Retrieve result from each block, and write into the appropriate region of the destination
-        # TODO: Parallelize this loop
-        for block_start in block_starts:
-            opBlockPipeline = self._blockPipelines[block_start]
-            block_roi = opBlockPipeline.block_roi
-            block_intersection = getIntersection( block_roi, (roi.start, roi.stop) )
-            block_relative_intersection = numpy.subtract(block_intersection, block_roi[0])
-            destination_relative_intersection = numpy.subtract(block_intersection, roi.start)
-            
-            destination_slice = roiToSlice( *destination_relative_intersection )
-            req = opBlockPipeline.PredictionImage( *block_relative_intersection )
-            req.writeInto( destination[destination_slice] )
-            req.wait()
+        def process_blocks(starts):
+            for block_start in starts:
+                # Get the block pipeline (create first if necessary)
+                opBlockPipeline = self._acquirePipeline(block_start)
+                try:
+                    block_roi = opBlockPipeline.block_roi
+                    block_intersection = getIntersection( block_roi, (roi.start, roi.stop) )
+                    block_relative_intersection = numpy.subtract(block_intersection, block_roi[0])
+                    destination_relative_intersection = numpy.subtract(block_intersection, roi.start)
+
+                    block_destination = None
+                    if destination is not None:
+                        block_destination = destination[ roiToSlice( *destination_relative_intersection ) ]
+                    func( opBlockPipeline, block_relative_intersection, block_destination )
+                finally:
+                    self._releasePipeline(block_start, opBlockPipeline)
+
+        # Each request handles every nparallel-th block, so no more
+        # than nparallel blocks are processed at once.
+        # The blocks don't overlap, so they can be written in any order.
+        nparallel = min( len(block_starts), self._maxParallelBlocks() )
+        pool = RequestPool()
+        for i in range(nparallel):
+            pool.add( Request( partial(process_blocks, block_starts[i::nparallel]) ) )
+        pool.wait()
+        pool.clean()
+
+    def _getStitching(self):
+        """
+        The global object ids of all blocks, computed on first use and kept until a block becomes dirty.
 
-        return destination
+        :returns: (luts, predictions) where luts[(spatial block start, t)] maps the block's
+                  local labels to global object ids, and predictions[t] maps the global ids
+                  of time slice t to their predicted class.
+        """
+        with self._stitchingLock:
+            with self._stitchingStateLock:
+                generation = self._stitchingGeneration
+                stitching = self._stitching
+            if stitching is None:
+                stitching = self._computeStitching()
+                with self._stitchingStateLock:
+                    # Blocks that became dirty during the stitching invalidate it
+                    if generation == self._stitchingGeneration:
+                        self._stitching = stitching
+            return stitching
+
+    def _invalidateStitching(self):
+        with self._stitchingStateLock:
+            self._stitchingGeneration += 1
+            self._stitching = None
+
+    def _computeStitching(self):
+        axiskeys = self.RawImage.meta.getAxisKeys()
+        spatial_axes = [i for i, k in enumerate(axiskeys) if k in 'xyz']
+        assert len(spatial_axes) == 3, "Object stitching requires 3d blocks"
+
+        block_shape = self._getFullShape( self._block_shape_dict )
+        shape = self.PredictionImage.meta.shape
+        roi = ( (0,)*len(shape), shape )
+
+        # t -> spatial block start -> BlockObjects
+        summaries = dict( (t, {}) for t in range( shape[axiskeys.index('t')] ) )
+        def summarize_block(opBlockPipeline, block_relative_roi, block_destination):
+            labels = opBlockPipeline.LabelImage( *block_relative_roi ).wait()
+            predictions = opBlockPipeline.Predictions([]).wait()
+            spatial_start = self._spatialBlockStart( opBlockPipeline.block_roi[0] )
+            # 3d volumes of each time slice, with the spatial axes in the same order as the block starts
+            labels = labels.take( 0, axis=axiskeys.index('c') )
+            remaining_keys = [k for k in axiskeys if k != 'c']
+            labels = numpy.transpose( labels, [remaining_keys.index(k) for k in remaining_keys if k == 't'] +
+                                              [remaining_keys.index(k) for k in remaining_keys if k in 'xyz'] )
+            for t in range(labels.shape[0]):
+                objects = block_objects( labels[t], predictions.get(t, []) )
+                summaries[t][spatial_start] = objects
+
+        # The blocks are processed like a prediction request for the whole volume,
+        # but only the block summaries are kept.
+        self._processBlocks( roi, None, summarize_block )
+
+        spatial_block_shape = [ block_shape[i] for i in spatial_axes ]
+        luts = {}
+        predictions = {}
+        for t, blocks in summaries.iteritems():
+            block_luts, predictions[t] = stitch_blocks( spatial_block_shape, blocks )
+            for spatial_start, lut in block_luts.iteritems():
+                luts[(spatial_start, t)] = lut
+        logger.debug( "Stitched objects of {} blocks".format( len(luts) ) )
+        return luts, predictions
+
+    def _maxParallelBlocks(self):
+        """Estimate how many blocks (with halo) can be processed at the same time."""
+        return self._getBudget()[0]
+
+    def _maxPipelines(self):
+        """The number of block pipelines to keep, see MaxBlockPipelines."""
+        return self._getBudget()[1]
+
+    def _getBudget(self):
+        """
+        (number of blocks processed in parallel, number of pipelines kept), estimated
+        from the available memory once per configuration and halo.
+        """
+        halo_padding_dict = self._getHaloPaddingDict()
+        with self._haloLock:
+            if self._budget is not None and self._budget[0] == halo_padding_dict:
+                return self._budget[1]
+
+        nworkers = max(1, Request.global_thread_pool.num_workers)
+        blockBytes = self._blockBytes( halo_padding_dict )
+        availableBytes = psutil.virtual_memory().available
+
+        nparallel = int( max(1, min(nworkers, availableBytes // blockBytes)) )
+        maxPipelines = self.MaxBlockPipelines.value
+        if maxPipelines <= 0:
+            maxPipelines = int( max(nworkers, 0.5 * availableBytes // blockBytes) )
+        logger.debug( "Processing up to {} blocks in parallel, keeping up to {} pipelines ({:.1f} MB per block)"
+                      .format( nparallel, maxPipelines, blockBytes / 1e6 ) )
+
+        budget = (nparallel, maxPipelines)
+        with self._haloLock:
+            self._budget = (halo_padding_dict, budget)
+        return budget
+
+    def _blockBytes(self, halo_padding_dict):
+        """Estimate of the memory used by the pipeline of a single block."""
+        # A block needs the raw data with halo, a float32 copy of it for
+        # vigra, the binary image, the labels (uint32), the object masks
+        # (about as much again) and the prediction image.
+        block_shape = self._getFullShape( self._block_shape_dict )
+        halo_padding = self._getFullShape( halo_padding_dict )
+        voxels = 1
+        for k, b, h, n in zip( self.RawImage.meta.getAxisKeys(), block_shape, halo_padding, self.RawImage.meta.shape ):
+            if k in 'xyz':
+                voxels *= min( b + 2*h, n )
+            elif k == 't':
+                voxels *= n
+        nchannels = self.RawImage.meta.getTaggedShape()['c']
+        return voxels * ( nchannels * (self.RawImage.meta.getDtypeBytes() + 4) + 1 + 2*4 + 1 )
 
     def _executeBlockwiseRegionFeatures(self, roi, destination):
         """
@@ -290,7 +527,7 @@ class OpBlockwiseObjectClassification( Operator ):
                    (1,20,30,40,5) should be requested via roi [(1,2,3,4,5),(2,3,4,5,6)]
         
         Note: It is assumed that you will request these features for debug purposes, AFTER requesting the prediction image.
-              Therefore, it is considered an error to request features that are not already computed.
+              If the pipeline of a block has been deleted in the meantime (see MaxBlockPipelines), its features are computed again.
         """
         axiskeys = self.RawImage.meta.getAxisKeys()
         # Find the corresponding block start coordinates
@@ -300,8 +537,6 @@ class OpBlockwiseObjectClassification( Operator ):
         block_starts = map( tuple, block_starts )
         
         for block_start in block_starts:
-            assert block_start in self._blockPipelines, "Not allowed to request region features for blocks that haven't yet been processed." # See note above
-
             # Discard spatial axes to get (t,c) index for region slot roi
             tagged_block_start = zip( axiskeys, block_start )
             tagged_block_start_tc = filter( lambda (k,v): k in 'tc', tagged_block_start )
@@ -311,43 +546,133 @@ class OpBlockwiseObjectClassification( Operator ):
             destination_start = numpy.array(block_start) / block_shape - roi.start
             destination_stop = destination_start + numpy.array( [1]*len(axiskeys) )
 
-            opBlockPipeline = self._blockPipelines[block_start]
-            req = opBlockPipeline.BlockwiseRegionFeatures( *block_roi_tc )
-            req.writeInto( destination[ roiToSlice( destination_start, destination_stop ) ] )
-            req.wait()
+            opBlockPipeline = self._acquirePipeline(block_start)
+            try:
+                req = opBlockPipeline.BlockwiseRegionFeatures( *block_roi_tc )
+                req.writeInto( destination[ roiToSlice( destination_start, destination_stop ) ] )
+                req.wait()
+            finally:
+                self._releasePipeline(block_start, opBlockPipeline)
         
         return destination
 
-    def _ensurePipelineExists(self, block_start):
-        if block_start in self._blockPipelines:
-            return
+    def _acquirePipeline(self, block_start):
+        """
+        Return the pipeline of the given block (create first if necessary), and mark it as
+        the most recently used one.  It won't be deleted until _releasePipeline() is called.
+        If the halo changed since the pipelines were created, they are all rebuilt.
+        """
+        halo_padding_dict = self._getHaloPaddingDict()
         with self._lock:
-            if block_start in self._blockPipelines:
-                return
+            if halo_padding_dict != self._pipeline_halo_padding_dict:
+                if self._blockPipelines:
+                    logger.debug( "Halo changed to {}, rebuilding the pipelines".format( halo_padding_dict ) )
+                    self._invalidateStitching()
+                    self._cleanUpPipelines()
+                self._pipeline_halo_padding_dict = halo_padding_dict
+            opBlockPipeline = self._blockPipelines.pop(block_start, None)
+            if opBlockPipeline is None:
+                opBlockPipeline = self._createPipeline(block_start, halo_padding_dict)
+            self._blockPipelines[block_start] = opBlockPipeline
+            self._pipelineUsers[block_start] += 1
+            return opBlockPipeline
 
-            logger.debug( "Creating pipeline for block: {}".format( block_start ) )
+    def _releasePipeline(self, block_start, opBlockPipeline):
+        """
+        Counterpart of _acquirePipeline().  Deletes the least recently used pipelines
+        that are not in use, if there are more than allowed by MaxBlockPipelines.
+        A pipeline that was replaced while in use is deleted when its last user releases it.
+        """
+        maxPipelines = self._maxPipelines()
+        with self._lock:
+            if opBlockPipeline in self._retiredPipelines:
+                self._retiredPipelines[opBlockPipeline] -= 1
+                if self._retiredPipelines[opBlockPipeline] == 0:
+                    del self._retiredPipelines[opBlockPipeline]
+                    logger.debug( "Deleting replaced pipeline for block: {}".format( block_start ) )
+                    opBlockPipeline.cleanUp()
+            elif block_start in self._pipelineUsers:
+                self._pipelineUsers[block_start] -= 1
+                if self._pipelineUsers[block_start] == 0:
+                    del self._pipelineUsers[block_start]
+
+            excess = len(self._blockPipelines) - maxPipelines
+            for old_block_start in list(self._blockPipelines.keys()):
+                if excess <= 0:
+                    break
+                if old_block_start in self._pipelineUsers:
+                    continue
+                logger.debug( "Deleting pipeline for block: {}".format( old_block_start ) )
+                self._blockPipelines.pop(old_block_start).cleanUp()
+                excess -= 1
+
+    def _createPipeline(self, block_start, halo_padding_dict):
+        """
+        Create the pipeline of a single block.  Must be called with self._lock held.
+        """
+        logger.debug( "Creating pipeline for block: {}".format( block_start ) )
 
-            block_shape = self._getFullShape( self._block_shape_dict )
-            halo_padding = self._getFullShape( self._halo_padding_dict )
+        block_shape = self._getFullShape( self._block_shape_dict )
+        halo_padding = self._getFullShape( halo_padding_dict )
 
-            input_shape = self.RawImage.meta.shape
-            block_stop = getBlockBounds( input_shape, block_shape, block_start )[1]
-            block_roi = (block_start, block_stop)
+        input_shape = self.RawImage.meta.shape
+        block_stop = getBlockBounds( input_shape, block_shape, block_start )[1]
+        block_roi = (block_start, block_stop)
 
-            # Instantiate pipeline
-            opBlockPipeline = OpSingleBlockObjectPrediction( block_roi, halo_padding, parent=self )
-            opBlockPipeline.RawImage.connect( self.RawImage )
-            opBlockPipeline.BinaryImage.connect( self.BinaryImage )
-            opBlockPipeline.Classifier.connect( self.Classifier )
-            opBlockPipeline.LabelsCount.connect( self.LabelsCount )
-            opBlockPipeline.SelectedFeatures.connect( self.SelectedFeatures )
+        # Instantiate pipeline
+        opBlockPipeline = OpSingleBlockObjectPrediction( block_roi, halo_padding, parent=self )
+        opBlockPipeline.RawImage.connect( self.RawImage )
+        opBlockPipeline.BinaryImage.connect( self.BinaryImage )
+        opBlockPipeline.Classifier.connect( self.Classifier )
+        opBlockPipeline.LabelsCount.connect( self.LabelsCount )
+        opBlockPipeline.SelectedFeatures.connect( self.SelectedFeatures )
 
-            # Forward dirtyness
-            opBlockPipeline.PredictionImage.notifyDirty( bind(self._handleDirtyBlock, block_start ) )
-            
-            self._blockPipelines[block_start] = opBlockPipeline
+        # Forward dirtyness
+        opBlockPipeline.PredictionImage.notifyDirty( bind(self._handleDirtyBlock, block_start ) )
+        return opBlockPipeline
 
     
+    def _getHaloPaddingDict(self):
+        """
+        The halo of the blocks, determined on first use (see AutoHaloPadding).
+        """
+        with self._haloLock:
+            if self._halo_padding_dict is None:
+                self._halo_padding_dict = self._computeHaloPaddingDict()
+            return self._halo_padding_dict
+
+    def _computeHaloPaddingDict(self):
+        halo_padding_dict = dict( self.HaloPadding3dDict.value )
+        if not self.AutoHaloPadding.value or not self.TrainingObjectExtent.ready():
+            return halo_padding_dict
+
+        extent = self.TrainingObjectExtent.value
+        if not extent:
+            logger.debug( "No labeled objects, using the default halo: {}".format( halo_padding_dict ) )
+            return halo_padding_dict
+
+        # Objects up to the largest labeled one are completely inside the halo of each block
+        # they intersect, including the neighborhood that the selected features look at.
+        margin = list( max_margin( self.SelectedFeatures([]).wait() ) ) + [0, 0, 0]
+        for k, m in zip( 'xyz', margin ):
+            halo_padding_dict[k] = int( extent.get(k, 0) + m )
+        logger.info( "Halo derived from the labeled objects: {}".format( halo_padding_dict ) )
+        return halo_padding_dict
+
+    def _resetHaloPadding(self):
+        """
+        Forget an automatic halo.  It is recomputed when the next block is requested,
+        and the pipelines are rebuilt then if it changed (see _acquirePipeline()).
+        """
+        with self._haloLock:
+            old_halo_padding_dict = self._halo_padding_dict
+            self._halo_padding_dict = None
+        if old_halo_padding_dict is not None:
+            self.PredictionImage.setDirty( slice(None) )
+            self.BlockLabelImage.setDirty( slice(None) )
+            self.LabelImage.setDirty( slice(None) )
+            self.StitchedPredictionImage.setDirty( slice(None) )
+
     def _getFullShape(self, spatialShapeDict):
         # 't' should match raw input
         # 'c' should be 1 (output image has exactly 1 channel)
@@ -369,17 +694,37 @@ class OpBlockwiseObjectClassification( Operator ):
     
     def _deleteAllPipelines(self):
         logger.debug("Deleting all pipelines.")
-        oldBlockPipelines = self._blockPipelines
-        self._blockPipelines = {}
+        self._invalidateStitching()
         with self._lock:
-            for opBlockPipeline in oldBlockPipelines.values():
+            self._cleanUpPipelines()
+
+    def _cleanUpPipelines(self):
+        """
+        Delete all block pipelines.  Must be called with self._lock held.
+        Pipelines that other requests are still using are retired instead,
+        and deleted by _releasePipeline() once they are no longer in use.
+        """
+        oldBlockPipelines = self._blockPipelines
+        oldPipelineUsers = self._pipelineUsers
+        self._blockPipelines = collections.OrderedDict()
+        self._pipelineUsers = collections.defaultdict(int)
+        for block_start, opBlockPipeline in oldBlockPipelines.items():
+            if block_start in oldPipelineUsers:
+                self._retiredPipelines[opBlockPipeline] = oldPipelineUsers[block_start]
+            else:
                 opBlockPipeline.cleanUp()
     
     
     def propagateDirty(self, slot, subindex, roi):
-        if slot == self.BlockShape3dDict or slot == self.HaloPadding3dDict:
+        if slot == self.BlockShape3dDict or slot == self.HaloPadding3dDict or slot == self.AutoHaloPadding:
             self._deleteAllPipelines()
             self.PredictionImage.setDirty( slice(None) )
+            self.BlockLabelImage.setDirty( slice(None) )
+            self.LabelImage.setDirty( slice(None) )
+            self.StitchedPredictionImage.setDirty( slice(None) )
+        elif slot == self.TrainingObjectExtent or slot == self.SelectedFeatures:
+            if self.AutoHaloPadding.value:
+                self._resetHaloPadding()
     
     
     def _handleDirtyBlock(self, block_start, slot, roi):
@@ -388,6 +733,12 @@ class OpBlockwiseObjectClassification( Operator ):
         global_roi = block_relative_roi + numpy.array(block_start)
         logger.debug("Setting roi dirty: {}".format(global_roi))
         self.PredictionImage.setDirty( *global_roi )
+        self.BlockLabelImage.setDirty( *global_roi )
+
+        # Objects may have been split or merged anywhere, so the global ids are renumbered.
+        self._invalidateStitching()
+        self.LabelImage.setDirty( slice(None) )
+        self.StitchedPredictionImage.setDirty( slice(None) )
 
 
 
@@ -0,0 +1,198 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+"""Export of one table row per object: time, object id, bounding box,
+selected features, predicted class and class probabilities.
+
+The table is written in chunks of rows, so that the export of many
+objects never holds more than a single time slice in memory.
+
+"""
+
+import csv
+import logging
+
+import numpy
+import h5py
+
+from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
+from ilastik.applets.objectExtraction.objectFeatureTable import ObjectFeatureTable
+
+logger = logging.getLogger(__name__)
+
+# number of rows written at once
+EXPORT_CHUNK_ROWS = 2**14
+
+# number of table elements per hdf5 chunk (512 KB of float64)
+EXPORT_HDF5_CHUNK_ELEMENTS = 2**16
+
+
+def tableColumns(feature_columns, ndim, nclasses, label_names=None):
+    """Column names of the object table.
+
+    :param feature_columns: (plugin, feature) per selected feature
+      column, as returned by ObjectFeatureTable.select()
+    :param ndim: number of spatial dimensions of the bounding boxes
+    :param nclasses: number of classes
+    :param label_names: optional class names, used for the probability columns
+
+    """
+    axes = 'xyz'[:ndim]
+    columns = ['time', 'object_id']
+    columns += ['bbox_min_{}'.format(a) for a in axes]
+    columns += ['bbox_max_{}'.format(a) for a in axes]
+
+    # features with several channels get one column per channel
+    counts = dict()
+    for key in feature_columns:
+        counts[key] = counts.get(key, 0) + 1
+    channel = dict()
+    for plugin, featname in feature_columns:
+        name = '{}/{}'.format(plugin, featname)
+        if counts[(plugin, featname)] > 1:
+            c = channel.get((plugin, featname), 0)
+            channel[(plugin, featname)] = c + 1
+            name = '{}[{}]'.format(name, c)
+        columns.append(name)
+
+    columns.append('predicted_class')
+    if label_names is None or len(label_names) != nclasses:
+        label_names = [str(i + 1) for i in range(nclasses)]
+    columns += ['probability_{}'.format(name) for name in label_names]
+    return columns
+
+
+def objectTableChunks(t, feats, probs, selected, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Rows of the object table of time slice t, chunk by chunk.
+
+    :param feats: feature dictionary of time slice t, feats[plugin][feature]
+    :param probs: class probabilities, shape (nobj+1, nclasses)
+    :param selected: the selected features, selected[plugin][feature]
+    :returns: a generator of (feature columns, float64 matrix) pairs.
+      The background object 0 is never exported.
+
+    """
+    table = ObjectFeatureTable.from_features({t: feats})
+    cols, col_names = table.column_indices(selected)
+    rows = table.rows(t)
+    mins = table.feature(t, default_features_key, 'Coord<Minimum>')
+    maxs = table.feature(t, default_features_key, 'Coord<Maximum>')
+    probs = numpy.asarray(probs)
+    assert probs.shape[0] == rows.stop - rows.start, \
+        "got {} probabilities for {} objects".format(probs.shape[0], rows.stop - rows.start)
+
+    ndim = mins.shape[1]
+    nclasses = probs.shape[1]
+    ncols = 2 + 2 * ndim + len(cols) + 1 + nclasses
+
+    nobj = rows.stop - rows.start
+    for start in range(1, nobj, chunk_rows):
+        stop = min(start + chunk_rows, nobj)
+        chunk = numpy.empty((stop - start, ncols), dtype=numpy.float64)
+        chunk[:, 0] = t
+        chunk[:, 1] = numpy.arange(start, stop)
+        j = 2
+        chunk[:, j:j+ndim] = mins[start:stop]
+        j += ndim
+        chunk[:, j:j+ndim] = maxs[start:stop]
+        j += ndim
+        chunk[:, j:j+len(cols)] = table.data[rows.start + start:rows.start + stop][:, cols]
+        j += len(cols)
+        chunk[:, j] = 1 + numpy.argmax(probs[start:stop], axis=1)
+        chunk[:, j+1:] = probs[start:stop]
+        yield col_names, chunk
+
+
+class HDF5ObjectTableWriter(object):
+    """Writes the object table to an hdf5 group with the layout::
+
+        <internal_path>/data      (nobjects, ncols)  chunked, compressed float64 table
+        <internal_path>/columns   (ncols,)           name of each column
+
+    """
+    def __init__(self, path, columns, internal_path='objects'):
+        self._file = h5py.File(path, 'w')
+        group = self._file.create_group(internal_path)
+        group.create_dataset('columns', data=numpy.array(columns))
+        chunk_rows = max(1, EXPORT_HDF5_CHUNK_ELEMENTS // len(columns))
+        self._data = group.create_dataset('data', shape=(0, len(columns)), maxshape=(None, len(columns)),
+                                          chunks=(chunk_rows, len(columns)), dtype=numpy.float64,
+                                          compression=1)
+
+    def write(self, chunk):
+        n = self._data.shape[0]
+        self._data.resize(n + chunk.shape[0], axis=0)
+        self._data[n:] = chunk
+
+    def close(self):
+        self._file.close()
+
+
+class CSVObjectTableWriter(object):
+    """Writes the object table to a csv file with a header row."""
+    def __init__(self, path, columns):
+        self._file = open(path, 'wb')
+        csv.writer(self._file).writerow(columns)
+
+    def write(self, chunk):
+        # 9 significant digits preserve float32 values and print integers without decimals
+        numpy.savetxt(self._file, chunk, fmt='%.9g', delimiter=',')
+
+    def close(self):
+        self._file.close()
+
+
+def exportObjectTable(path, features_slot, probabilities_slot, selected, label_names=None,
+                      chunk_rows=EXPORT_CHUNK_ROWS):
+    """Export the object table of one image lane.
+
+    The file format is chosen by the extension of path: '.csv' files
+    are written as text, everything else as hdf5.
+
+    :param features_slot: the RegionFeatures of the lane
+    :param probabilities_slot: the object class probabilities of the lane,
+      e.g. OpObjectClassification.Probabilities[lane]
+    :param selected: the selected features, selected[plugin][feature]
+    :returns: the number of exported objects
+
+    """
+    writer = None
+    columns = None
+    count = 0
+    try:
+        for t in range(features_slot.meta.shape[0]):
+            feats = features_slot([t]).wait()[t]
+            probs = probabilities_slot([t]).wait()[t]
+            if len(probs) == 0:
+                raise Exception("no object predictions available, the classifier needs to be trained first")
+            for col_names, chunk in objectTableChunks(t, feats, probs, selected, chunk_rows):
+                if writer is None:
+                    ndim = len(feats[default_features_key]['Coord<Minimum>'][0])
+                    columns = tableColumns(col_names, ndim, probs.shape[1], label_names)
+                    if path.lower().endswith('.csv'):
+                        writer = CSVObjectTableWriter(path, columns)
+                    else:
+                        writer = HDF5ObjectTableWriter(path, columns)
+                elif chunk.shape[1] != len(columns):
+                    raise Exception('different time slices did not have same features.')
+                writer.write(chunk)
+                count += chunk.shape[0]
+            logger.debug("exported objects of time slice {}".format(t))
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        logger.warn("no objects to export to {}".format(path))
+    return count
@@ -18,7 +18,6 @@ import numpy
 import vigra
 import time
 import warnings
-import itertools
 from collections import defaultdict
 
 from lazyflow.graph import Operator, InputSlot, OutputSlot
@@ -31,6 +30,7 @@ from functools import partial
 from ilastik.utility import OperatorSubView, MultiLaneOperatorABC, OpMultiLaneWrapper
 from ilastik.utility.mode import mode
 from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
+from ilastik.applets.objectExtraction.objectFeatureTable import ObjectFeatureTable
 
 from ilastik.applets.base.applet import DatasetConstraintError
 
@@ -110,6 +110,9 @@ class OpObjectClassification(Operator, MultiLaneOperatorABC):
     LabelColors = OutputSlot()
     PmapColors = OutputSlot()
 
+    # The largest bounding box of the labeled objects, see OpLabeledObjectExtent
+    LabeledObjectExtent = OutputSlot(stype=Opaque)
+
 
     def __init__(self, *args, **kwargs):
         super(OpObjectClassification, self).__init__(*args, **kwargs)
@@ -142,6 +145,11 @@ class OpObjectClassification(Operator, MultiLaneOperatorABC):
         self.opMaxLabel = OpMaxLabel( parent=self )
         self.opMaxLabel.Inputs.connect( self.LabelInputs )
 
+        self.opLabeledObjectExtent = OpLabeledObjectExtent(parent=self)
+        self.opLabeledObjectExtent.Labels.connect(self.LabelInputs)
+        self.opLabeledObjectExtent.Features.connect(self.ObjectFeatures)
+        self.LabeledObjectExtent.connect(self.opLabeledObjectExtent.Output)
+
         self.opPredict.Features.connect(self.ObjectFeatures)
         self.opPredict.Classifier.connect(self.classifier_cache.Output)
         self.opPredict.SelectedFeatures.connect(self.SelectedFeatures)
@@ -439,91 +447,63 @@ class OpObjectClassification(Operator, MultiLaneOperatorABC):
         maxs_old = old_bboxes["Coord<Maximum>"]
         mins_new = new_bboxes["Coord<Minimum>"]
         maxs_new = new_bboxes["Coord<Maximum>"]
-        nobj_old = mins_old.shape[0]
         nobj_new = mins_new.shape[0]
         if axistags is None:
             axistags = "xyz"
-        
-        data2D = False
-        if mins_old.shape[1]==2:
-            data2D = True
-        class bbox():
-            def __init__(self, minmaxs, axistags):
-                self.xmin = minmaxs[0][axistags.index('x')]
-                self.ymin = minmaxs[0][axistags.index('y')]
-                if not data2D:
-                    self.zmin = minmaxs[0][axistags.index('z')]
-                else:
-                    self.zmin = 0
-                self.xmax = minmaxs[1][axistags.index('x')]
-                self.ymax = minmaxs[1][axistags.index('y')]
-                if not data2D:
-                    self.zmax = minmaxs[1][axistags.index('z')]
-                else:
-                    self.zmax = 0
-                self.rad_x = 0.5*(self.xmax - self.xmin)
-                self.cent_x = self.xmin+self.rad_x
-                self.rad_y = 0.5*(self.ymax-self.ymin)
-                self.cent_y = self.ymin+self.rad_y
-                self.rad_z = 0.5*(self.zmax-self.zmin)
-                self.cent_z = self.zmin+self.rad_z
-
-            @staticmethod
-            def overlap(bbox_tuple):
-                this = bbox_tuple[0]
-                that = bbox_tuple[1]
-                over_x = this.rad_x+that.rad_x - (abs(this.cent_x-that.cent_x))
-                over_y = this.rad_y+that.rad_y - (abs(this.cent_y-that.cent_y))
-                over_z = this.rad_z+that.rad_z - (abs(this.cent_z-that.cent_z))
-                if not data2D:
-                    if over_x>0 and over_y>0 and over_z>0:
-                        return over_x*over_y*over_z
-                else:
-                    if over_x>0 and over_y>0:
-                        return over_x*over_y
-                return 0
 
-        nonzeros = numpy.nonzero(old_labels)[0]
-        bboxes_old = [bbox(x, axistags) for x in zip(mins_old[nonzeros], maxs_old[nonzeros])]
-        bboxes_new = [bbox(x, axistags) for x in zip(mins_new, maxs_new)]
+        # columns in x, y, z order; 2D data has no z
+        axes = 'xy' if mins_old.shape[1]==2 else 'xyz'
+        columns = [axistags.index(a) for a in axes]
+
+        def centers(mins, maxs):
+            """(cent_x, cent_y, cent_z) of each box, cent_z is 0 for 2D data"""
+            mins = numpy.asarray(mins, dtype=numpy.float64)[:, columns]
+            maxs = numpy.asarray(maxs, dtype=numpy.float64)[:, columns]
+            result = numpy.zeros((mins.shape[0], 3))
+            result[:, :len(columns)] = mins + 0.5*(maxs - mins)
+            return result
 
+        nonzeros = numpy.nonzero(old_labels)[0]
         #remove background
         #FIXME: assuming background is 0 again
-        bboxes_new = bboxes_new[1:]
+        old_ids, new_ids, overlaps = _bbox_overlaps(
+            numpy.asarray(mins_old)[nonzeros][:, columns], numpy.asarray(maxs_old)[nonzeros][:, columns],
+            numpy.asarray(mins_new)[1:, columns], numpy.asarray(maxs_new)[1:, columns])
+        nold = len(nonzeros)
+        nnew = max(nobj_new - 1, 0)
 
-        double_for_loop = itertools.product(bboxes_old, bboxes_new)
-        overlaps = map(bbox.overlap, double_for_loop)
-
-        overlaps = numpy.asarray(overlaps)
-        overlaps = overlaps.reshape((len(bboxes_old), len(bboxes_new)))
         new_labels = numpy.zeros((nobj_new,), dtype=numpy.uint32)
         old_labels_lost = dict()
         old_labels_lost["full"]=[]
         old_labels_lost["partial"]=[]
         new_labels_lost = dict()
         new_labels_lost["conflict"]=[]
-        for iobj in range(overlaps.shape[0]):
-            #take the object with maximum overlap
-            overlapsum = numpy.sum(overlaps[iobj, :])
-            if overlapsum==0:
-                old_labels_lost["full"].append((bboxes_old[iobj].cent_x, bboxes_old[iobj].cent_y, bboxes_old[iobj].cent_z))
-                continue
-            newindex = numpy.argmax(overlaps[iobj, :])
-            if overlapsum-overlaps[iobj,newindex]>0:
-                #this object overlaps with more than one new object
-                old_labels_lost["partial"].append((bboxes_old[iobj].cent_x, bboxes_old[iobj].cent_y, bboxes_old[iobj].cent_z))
-
-            overlaps[iobj, :] = 0
-            overlaps[iobj, newindex] = 1 #doesn't matter what number>0
-
-        for iobj in range(overlaps.shape[1]):
-            labels = numpy.where(overlaps[:, iobj]>0)[0]
-            if labels.shape[0]==1:
-                new_labels[iobj+1]=old_labels[nonzeros[labels[0]]] #iobj+1 because of the background
-            elif labels.shape[0]>1:
-                new_labels_lost["conflict"].append((bboxes_new[iobj].cent_x, bboxes_new[iobj].cent_y, bboxes_new[iobj].cent_z))
-
-        new_labels = new_labels
+
+        #take the new object with maximum overlap (the first one, if there is a tie)
+        order = numpy.lexsort((new_ids, -overlaps, old_ids))
+        old_ids, new_ids, overlaps = old_ids[order], new_ids[order], overlaps[order]
+        first = numpy.ones(len(old_ids), dtype=bool)
+        first[1:] = old_ids[1:] != old_ids[:-1]
+        best_old = old_ids[first]
+        best_new = new_ids[first]
+        overlapsum = numpy.bincount(old_ids, weights=overlaps, minlength=nold)
+
+        old_centers = centers(numpy.asarray(mins_old)[nonzeros], numpy.asarray(maxs_old)[nonzeros])
+        matched = numpy.zeros(nold, dtype=bool)
+        matched[best_old] = True
+        #this object overlaps with more than one new object
+        partial = numpy.zeros(nold, dtype=bool)
+        partial[best_old] = overlapsum[best_old] - overlaps[first] > 0
+        old_labels_lost["full"] = [tuple(c) for c in old_centers[~matched]]
+        old_labels_lost["partial"] = [tuple(c) for c in old_centers[partial]]
+
+        nmatches = numpy.bincount(best_new, minlength=nnew)
+        unique = nmatches[best_new] == 1
+        new_labels[best_new[unique]+1] = numpy.asarray(old_labels)[nonzeros[best_old[unique]]] #+1 because of the background
+        conflicts = numpy.flatnonzero(nmatches > 1)
+        new_centers = centers(numpy.asarray(mins_new)[1:][conflicts], numpy.asarray(maxs_new)[1:][conflicts])
+        new_labels_lost["conflict"] = [tuple(c) for c in new_centers]
+
         new_labels[0]=0 #FIXME: hardcoded background value again
         return new_labels, old_labels_lost, new_labels_lost
 
@@ -553,6 +533,105 @@ class OpObjectClassification(Operator, MultiLaneOperatorABC):
         return OperatorSubView(self, laneIndex)
 
 
+def _bbox_overlaps(mins_a, maxs_a, mins_b, maxs_b):
+    """Find all overlapping pairs of bounding boxes in a and b.
+
+    Boxes overlap if their intervals [min, max] strictly intersect in
+    every axis. The overlap of a pair is the product over all axes of
+    rad_a + rad_b - |cent_a - cent_b|, where rad and cent are the
+    radius and center of the intervals.
+
+    Instead of comparing all pairs, the boxes of b are sorted along one
+    axis (the one that gives the fewest candidates). For each box in a,
+    only the boxes of b whose start along that axis lies within reach
+    are compared.
+
+    :returns: (indices into a, indices into b, overlaps) of the
+        overlapping pairs
+
+    """
+    mins_a = numpy.asarray(mins_a, dtype=numpy.float64)
+    maxs_a = numpy.asarray(maxs_a, dtype=numpy.float64)
+    mins_b = numpy.asarray(mins_b, dtype=numpy.float64)
+    maxs_b = numpy.asarray(maxs_b, dtype=numpy.float64)
+    empty = (numpy.zeros((0,), dtype=numpy.intp),) * 2 + (numpy.zeros((0,)),)
+    if len(mins_a) == 0 or len(mins_b) == 0:
+        return empty
+
+    # candidate window along each axis: mins_a - width_b < mins_b < maxs_a
+    best = None
+    for axis in range(mins_a.shape[1]):
+        order = numpy.argsort(mins_b[:, axis], kind='mergesort')
+        starts = mins_b[order, axis]
+        max_width = numpy.max(maxs_b[:, axis] - mins_b[:, axis])
+        lo = numpy.searchsorted(starts, mins_a[:, axis] - max_width, side='right')
+        hi = numpy.searchsorted(starts, maxs_a[:, axis], side='left')
+        hi = numpy.maximum(hi, lo)
+        if best is None or numpy.sum(hi - lo) < numpy.sum(best[2] - best[1]):
+            best = (order, lo, hi)
+    order, lo, hi = best
+
+    # enumerate the candidate pairs
+    counts = hi - lo
+    total = numpy.sum(counts)
+    if total == 0:
+        return empty
+    ia = numpy.repeat(numpy.arange(len(mins_a)), counts)
+    offsets = numpy.cumsum(counts) - counts
+    ib = order[numpy.arange(total) - numpy.repeat(offsets - lo, counts)]
+
+    rad_a = 0.5*(maxs_a - mins_a)
+    rad_b = 0.5*(maxs_b - mins_b)
+    cent_a = mins_a + rad_a
+    cent_b = mins_b + rad_b
+    over = rad_a[ia] + rad_b[ib] - numpy.abs(cent_a[ia] - cent_b[ib])
+    keep = numpy.all(over > 0, axis=1)
+    return ia[keep], ib[keep], numpy.prod(over[keep], axis=1)
+
+
+def coalesce_boxes(starts, stops, distance=0):
+    """Merge boxes that overlap or are at most distance apart
+    (along every axis) into their joint bounding boxes.
+
+    :param starts: array of shape (nboxes, ndim)
+    :param stops: array of shape (nboxes, ndim), exclusive
+    :returns: (starts, stops) of the merged boxes
+
+    """
+    starts = numpy.asarray(starts)
+    stops = numpy.asarray(stops)
+    while len(starts) > 1:
+        n = len(starts)
+        near = numpy.all((starts[:, None, :] <= stops[None, :, :] + distance) &
+                         (starts[None, :, :] <= stops[:, None, :] + distance), axis=2)
+
+        # connected components of the 'near' relation
+        parent = range(n)
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        for i, j in zip(*numpy.nonzero(numpy.triu(near, 1))):
+            ri, rj = find(i), find(j)
+            if ri != rj:
+                parent[max(ri, rj)] = min(ri, rj)
+        roots = numpy.array([find(i) for i in range(n)])
+        components, inverse = numpy.unique(roots, return_inverse=True)
+        if len(components) == n:
+            break
+
+        # joint box of each component: sort the boxes by component and
+        # reduce each run of boxes
+        order = numpy.argsort(inverse, kind='mergesort')
+        first = numpy.searchsorted(inverse[order], numpy.arange(len(components)))
+        new_starts = numpy.minimum.reduceat(starts[order], first, axis=0)
+        new_stops = numpy.maximum.reduceat(stops[order], first, axis=0)
+        # merged boxes may now be near other boxes, so repeat
+        starts, stops = new_starts, new_stops
+    return starts, stops
+
+
 def _atleast_nd(a, ndim):
     """Like numpy.atleast_1d and friends, but supports arbitrary ndim,
     always puts extra dimensions last, and resizes.
@@ -576,48 +655,35 @@ def _concatenate(arrays, axis):
     return numpy.concatenate(arrays, axis=axis)
 
 
-def make_feature_array(feats, selected, labels=None):
+def make_feature_array(tables, selected, labels=None):
+    """Assemble a feature matrix from per-time ObjectFeatureTables.
+
+    :param tables: dict of ObjectFeatureTable, indexed by time
+    :param selected: the selected features, selected[plugin name][feature name]
+    :param labels: optional dict of label arrays, indexed by time.
+        If given, only the labeled objects are included.
+
+    """
     featlist = []
     labellist = []
 
     row_names = []
-    col_names = []
+    col_names = None
 
-    for t in sorted(feats.keys()):
-        featsMatrix_tmp = []
+    for t in sorted(tables.keys()):
         index = None
         if labels is not None:
-            labellist_tmp = []
             lab = labels[t].squeeze()
-            index = numpy.nonzero(lab)
-            labellist_tmp.append(lab[index])
+            index = numpy.nonzero(lab)[0]
+            labellist.append(lab[index])
+            row_names.extend((t, obj) for obj in index)
 
-        timestep_col_names = []
-        for plugin in sorted(feats[t].keys()):
-            if plugin == default_features_key or plugin not in selected:
-                continue
-            for featname in sorted(feats[t][plugin].keys()):
-                if featname not in selected[plugin]:
-                    continue
-                value = feats[t][plugin][featname]
-                ft = numpy.asarray(value.squeeze())
-                if index is not None:
-                    ft = ft[index]
-                featsMatrix_tmp.append(ft)
-                timestep_col_names.extend([(plugin, featname)] * value.shape[1])
-        if not col_names:
+        ft, timestep_col_names = tables[t].select(selected, t, index)
+        if col_names is None:
             col_names = timestep_col_names
         elif col_names != timestep_col_names:
             raise Exception('different time slices did not have same features.')
-            
-        #FIXME: we can do it all with just arrays
-        featsMatrix_tmp_combined = _concatenate(featsMatrix_tmp, axis=1)
-        featlist.append(featsMatrix_tmp_combined)
-        if index is not None:
-            row_names.extend(list((t, obj) for obj in index[0]))
-        if labels is not None:
-            labellist_tmp_combined = _concatenate(labellist_tmp, axis=1)
-            labellist.append(labellist_tmp_combined)
+        featlist.append(ft)
 
     featMatrix = _concatenate(featlist, axis=0)
 
@@ -637,6 +703,52 @@ def replace_missing(a):
     return rows, cols
 
 
+class OpObjectFeatureTable(Operator):
+    """Converts the feature dictionaries of OpObjectExtraction into
+    ObjectFeatureTables, one per time slice, and caches them until the
+    features of that time slice become dirty.
+
+    """
+    name = "OpObjectFeatureTable"
+
+    Features = InputSlot(rtype=List, stype=Opaque)
+    Output = OutputSlot(rtype=List, stype=Opaque)
+
+    def __init__(self, *args, **kwargs):
+        super(OpObjectFeatureTable, self).__init__(*args, **kwargs)
+        self._cache = dict()
+
+    def setupOutputs(self):
+        self.Output.meta.shape = self.Features.meta.shape
+        self.Output.meta.dtype = object
+        self.Output.meta.axistags = None
+        self._cache = dict()
+
+    def execute(self, slot, subindex, roi, result):
+        times = roi._l
+        if len(times) == 0:
+            # we assume that 0-length requests are requesting everything
+            times = range(self.Output.meta.shape[0])
+
+        missing = [t for t in times if t not in self._cache]
+        if len(missing) > 0:
+            feats = self.Features(missing).wait()
+            for t in missing:
+                self._cache[t] = ObjectFeatureTable.from_features({t: feats[t]})
+        return dict((t, self._cache[t]) for t in times)
+
+    def propagateDirty(self, slot, subindex, roi):
+        if len(roi._l) == 0:
+            self._cache = dict()
+            self.Output.setDirty(())
+            return
+        # roi entries are time slices or (time, object) pairs
+        times = set(x[0] if isinstance(x, tuple) else x for x in roi._l)
+        for t in times:
+            self._cache.pop(t, None)
+        self.Output.setDirty(List(self.Output, sorted(times)))
+
+
 class OpObjectTrain(Operator):
     """Trains a random forest on all labeled objects."""
 
@@ -648,20 +760,37 @@ class OpObjectTrain(Operator):
     Features = InputSlot(level=1, rtype=List, stype=Opaque)
     SelectedFeatures = InputSlot(rtype=List, stype=Opaque)
     FixClassifier = InputSlot(stype="bool")
-    ForestCount = InputSlot(stype="int", value=1)
+
+    # total number of trees of the classifier
+    TreeCount = InputSlot(stype="int", value=100)
+
+    # the trees are split into this many forests, which are trained
+    # in parallel. 0 means one forest per worker thread.
+    ForestCount = InputSlot(stype="int", value=0)
 
     Classifier = OutputSlot()
     BadObjects = OutputSlot(stype=Opaque)
 
     def __init__(self, *args, **kwargs):
         super(OpObjectTrain, self).__init__(*args, **kwargs)
-        self._tree_count = 100
+        self._forest_sizes = [] # number of trees of each forest
         self.FixClassifier.setValue(False)
 
+        self._opFeatureTables = OperatorWrapper(OpObjectFeatureTable, parent=self)
+        self._opFeatureTables.Features.connect(self.Features)
+
+        # (lane, time) -> (labeled objects, their feature rows, column names)
+        self._trainingRows = dict()
+        self._trainingRowsLock = RequestLock()
+        # incremented whenever cached rows are invalidated
+        self._trainingRowsGeneration = 0
+        self.Features.notifyRemoved(lambda *args: self._invalidateTrainingRows())
+
     def setupOutputs(self):
         if self.inputs["FixClassifier"].value == False:
+            self._forest_sizes = self._forestSizes()
             self.outputs["Classifier"].meta.dtype = object
-            self.outputs["Classifier"].meta.shape = (self.ForestCount.value,)
+            self.outputs["Classifier"].meta.shape = (len(self._forest_sizes),)
             self.outputs["Classifier"].meta.axistags = None
 
         self.BadObjects.meta.shape = (1,)
@@ -672,6 +801,7 @@ class OpObjectTrain(Operator):
         featList = []
         all_col_names = []
         labelsList = []
+        row_names = []
 
         # will be available at slot self.Warnings
         all_bad_objects = defaultdict(lambda: defaultdict(list))
@@ -690,39 +820,24 @@ class OpObjectTrain(Operator):
             # but the current implementation of Slot.value() does not
             # do the right thing.
             labels_image = self.Labels[i]([]).wait()
-            labels_image_filtered = {}
-            nztimes = []
-            for timestep, labels_time in labels_image.iteritems():
-                nz = numpy.nonzero(labels_time)
-                if len(nz[0])==0:
+            labeled = dict()
+            for t in sorted(labels_image.keys()):
+                labels_time = numpy.asarray(labels_image[t]).reshape(-1)
+                objects = numpy.nonzero(labels_time)[0]
+                if len(objects) > 0:
+                    labeled[t] = (objects, labels_time[objects])
+
+            # only the rows of newly labeled objects are looked up
+            rows = self._getTrainingRows(i, dict((t, labeled[t][0]) for t in labeled), selected)
+            for t in sorted(labeled.keys()):
+                objects, labels = labeled[t]
+                feats, col_names = rows[t]
+                if feats.size == 0:
                     continue
-                else:
-                    nztimes.append(timestep)
-                    labels_image_filtered[timestep] = labels_time
-
-            if len(nztimes)==0:
-                continue
-            # compute the features if there are nonzero labels in this image
-            # and only for the time steps, which have labels
-            feats = self.Features[i](nztimes).wait()
-
-            featstmp, row_names, col_names, labelstmp = make_feature_array(feats, selected, labels_image_filtered)
-            if labelstmp.size == 0 or featstmp.size == 0:
-                continue
-
-            rows, cols = replace_missing(featstmp)
-
-            featList.append(featstmp)
-            all_col_names.append(tuple(col_names))
-            labelsList.append(labelstmp)
-
-            for idx in rows:
-                t, obj = row_names[idx]
-                all_bad_objects[i][t].append(obj)
-
-            for c in cols:
-                all_bad_feats.add(col_names[c])
-
+                featList.append(feats)
+                all_col_names.append(tuple(col_names))
+                labelsList.append(labels)
+                row_names.extend((i, t, obj) for obj in objects)
 
         if len(labelsList)==0:
             #no labels, return here
@@ -730,27 +845,40 @@ class OpObjectTrain(Operator):
             return
         
         
-        self._warnBadObjects(all_bad_objects, all_bad_feats)
-
         if not len(set(all_col_names)) == 1:
             raise Exception('different time slices did not have same features.')
 
         featMatrix = _concatenate(featList, axis=0)
         labelsMatrix = _concatenate(labelsList, axis=0)
+
+        rows, cols = replace_missing(featMatrix)
+        for idx in rows:
+            i, t, obj = row_names[idx]
+            all_bad_objects[i][t].append(obj)
+        col_names = all_col_names[0]
+        for c in cols:
+            all_bad_feats.add(col_names[c])
+
+        self._warnBadObjects(all_bad_objects, all_bad_feats)
         
         logger.info("training on matrix of shape {}".format(featMatrix.shape))
 
         if featMatrix.size == 0 or labelsMatrix.size == 0:
             result[:] = None
             return
-        oob = [0] * self.ForestCount.value
+        # converted once, all forests learn from the same arrays
+        featMatrix = featMatrix.astype(numpy.float32)
+        labelsMatrix = numpy.asarray(labelsMatrix, dtype=numpy.uint32)
+
+        forest_sizes = self._forest_sizes
+        oob = [0] * len(forest_sizes)
         try:
             # train and store forests in parallel
             pool = RequestPool()
-            for i in range(self.ForestCount.value):
+            for i in range(len(forest_sizes)):
                 def train_and_store(number):
-                    result[number] = vigra.learning.RandomForest(self._tree_count)
-                    oob[number] = result[number].learnRF(featMatrix.astype(numpy.float32), numpy.asarray(labelsMatrix, dtype=numpy.uint32))
+                    result[number] = vigra.learning.RandomForest(forest_sizes[number])
+                    oob[number] = result[number].learnRF(featMatrix, labelsMatrix)
                 req = Request( partial(train_and_store, i) )
                 pool.add( req )
             pool.wait()
@@ -758,14 +886,105 @@ class OpObjectTrain(Operator):
         except:
             logger.warn("couldn't learn classifier")
             raise
-        oob_total = numpy.mean(oob)
-        logger.info("training finished, out of bag error: {}".format(oob_total))
+        oob_total = numpy.average(oob, weights=forest_sizes)
+        logger.info("training finished, {} trees in {} forests, out of bag error: {}".format(
+            sum(forest_sizes), len(forest_sizes), oob_total))
         return result
 
+    def _forestSizes(self):
+        """Split TreeCount trees into forests of (almost) equal size,
+        one per worker thread unless ForestCount is given."""
+        ntrees = max(1, self.TreeCount.value)
+        nforests = self.ForestCount.value
+        if nforests <= 0:
+            nforests = max(1, Request.global_thread_pool.num_workers)
+        nforests = min(nforests, ntrees)
+        sizes = [ntrees // nforests] * nforests
+        for i in range(ntrees % nforests):
+            sizes[i] += 1
+        return sizes
+
+    def _getTrainingRows(self, lane, labeled, selected):
+        """Selected features of the labeled objects of a lane.
+
+        The rows are cached per lane and time slice. When the labeled
+        objects change, the rows of objects that are still labeled are
+        reused, and only the newly labeled objects are looked up in the
+        feature tables, which are requested for all time slices at once.
+
+        :param labeled: dictionary of (time, sorted labeled objects)
+        :returns: dictionary of (time, (feature matrix, column names));
+            NaNs are not replaced
+
+        """
+        with self._trainingRowsLock:
+            generation = self._trainingRowsGeneration
+            # time slices without labels don't need their rows anymore
+            for key in self._trainingRows.keys():
+                if key[0] == lane and key[1] not in labeled:
+                    del self._trainingRows[key]
+            cached = dict((t, self._trainingRows.get((lane, t))) for t in labeled)
+
+        rows = dict()
+        missing = []
+        for t, objects in labeled.items():
+            if cached[t] is not None and numpy.array_equal(cached[t][0], objects):
+                rows[t] = cached[t][1], cached[t][2]
+            else:
+                missing.append(t)
+        if len(missing) == 0:
+            return rows
+
+        tables = self._opFeatureTables.Output[lane](sorted(missing)).wait()
+        new_rows = dict()
+        for t in missing:
+            objects = labeled[t]
+            if cached[t] is None:
+                added = numpy.ones(len(objects), dtype=bool)
+            else:
+                cached_objects, cached_feats, col_names = cached[t]
+                pos = numpy.minimum(numpy.searchsorted(cached_objects, objects), len(cached_objects) - 1)
+                added = cached_objects[pos] != objects
+
+            new_feats, new_col_names = tables[t].select(selected, t, objects[added])
+            if cached[t] is None:
+                feats, col_names = new_feats, new_col_names
+            else:
+                assert new_col_names == col_names
+                feats = numpy.empty((len(objects), new_feats.shape[1]), dtype=new_feats.dtype)
+                feats[added] = new_feats
+                feats[~added] = cached_feats[pos[~added]]
+            rows[t] = feats, col_names
+            new_rows[(lane, t)] = (objects, feats, col_names)
+
+        with self._trainingRowsLock:
+            # rows looked up in tables that became dirty meanwhile are not kept
+            if generation == self._trainingRowsGeneration:
+                self._trainingRows.update(new_rows)
+        return rows
+
+    def _invalidateTrainingRows(self, lane=None, times=None):
+        """Forget the cached training rows of the given lane and time
+        slices (all of them, if None)."""
+        with self._trainingRowsLock:
+            self._trainingRowsGeneration += 1
+            for key in self._trainingRows.keys():
+                if (lane is None or key[0] == lane) and (times is None or key[1] in times):
+                    del self._trainingRows[key]
+
     def propagateDirty(self, slot, subindex, roi):
+        if slot is self.SelectedFeatures:
+            self._invalidateTrainingRows()
+        elif slot is self.Features:
+            times = None
+            if len(roi._l) > 0:
+                # roi entries are time slices or (time, object) pairs
+                times = set(x[0] if isinstance(x, tuple) else x for x in roi._l)
+            self._invalidateTrainingRows(subindex[0], times)
+
         if slot is not self.FixClassifier and \
            self.inputs["FixClassifier"].value == False:
-            slcs = (slice(0, self.ForestCount.value, None),)
+            slcs = (slice(0, len(self._forest_sizes), None),)
             self.outputs["Classifier"].setDirty(slcs)
 
     def _warnBadObjects(self, bad_objects, bad_feats):
@@ -803,6 +1022,11 @@ class OpObjectPredict(Operator):
 
     #SegmentationThreshold = 0.5
 
+    def __init__(self, *args, **kwargs):
+        super(OpObjectPredict, self).__init__(*args, **kwargs)
+        self._opFeatureTable = OpObjectFeatureTable(parent=self)
+        self._opFeatureTable.Features.connect(self.Features)
+
     def setupOutputs(self):
         self.Predictions.meta.shape = self.Features.meta.shape
         self.Predictions.meta.dtype = object
@@ -829,9 +1053,15 @@ class OpObjectPredict(Operator):
                 oslot.meta.axistags = None
                 oslot.meta.mapping_dtype = numpy.float32
 
+        # self.lock guards self._time_locks and self._generation; each
+        # time slice has its own lock
         self.lock = RequestLock()
+        self._time_locks = dict()
         self.prob_cache = dict()
         self.bad_objects = dict()
+        # incremented whenever the cache is cleared, so that predictions
+        # started before are not stored in the new cache
+        self._generation = 0
 
     def execute(self, slot, subindex, roi, result):
         assert slot in [self.Predictions,
@@ -848,101 +1078,146 @@ class OpObjectPredict(Operator):
         if slot is self.CachedProbabilities:
             return {t: self.prob_cache[t] for t in times if t in self.prob_cache}
 
+        # before the classifier is requested, see _predict()
+        generation = self._getGeneration()
+
         forests=self.inputs["Classifier"][:].wait()
         if forests is None or forests[0] is None:
             # this happens if there was no data to train with
             return dict((t, numpy.array([])) for t in times)
 
-        feats = {}
-        prob_predictions = {}
-
         selected = self.SelectedFeatures([]).wait()
 
-        # FIXME: self.prob_cache is shared, so we need to block.
-        # However, this makes prediction single-threaded.
+        # predict the missing time slices in parallel
+        probs = dict()
+        bad_objects = dict()
+        def predict_time(t):
+            probs[t], bad_objects[t] = self._predict(t, forests, selected, generation)
+
+        pool = RequestPool()
+        for t in times:
+            pool.add( Request( partial(predict_time, t) ) )
+        pool.wait()
+        pool.clean()
+
+        if slot == self.Probabilities:
+            return probs
+        elif slot == self.Predictions:
+            # FIXME: Support SegmentationThreshold again...
+            labels = dict()
+            for t in times:
+                labels[t] = 1 + numpy.argmax(probs[t], axis=1)
+                labels[t][0] = 0 # Background gets the zero label
+            
+            return labels
+
+        elif slot == self.ProbabilityChannels:
+            try:
+                prob_single_channel = {t: probs[t][:, subindex[0]]
+                                       for t in times}
+            except:
+                # no probabilities available for this class; return zeros
+                prob_single_channel = {t: numpy.zeros((probs[t].shape[0], 1))
+                                       for t in times}
+            return prob_single_channel
+
+        elif slot == self.BadObjects:
+            return bad_objects
+
+        else:
+            assert False, "Unknown input slot"
+
+    def _timeLock(self, t):
+        """The lock that prevents time slice t from being predicted twice."""
         self.lock.acquire()
         try:
-            for t in times:
-                if t in self.prob_cache:
-                    continue
+            return self._time_locks.setdefault(t, RequestLock())
+        finally:
+            self.lock.release()
 
-                tmpfeats = self.Features([t]).wait()
-                ftmatrix, _, col_names = make_feature_array(tmpfeats, selected)
-                rows, cols = replace_missing(ftmatrix)
-                self.bad_objects[t] = numpy.zeros((ftmatrix.shape[0],))
-                self.bad_objects[t][rows] = 1
-                feats[t] = ftmatrix
-                prob_predictions[t] = [0] * len(forests)
+    def _getGeneration(self):
+        self.lock.acquire()
+        try:
+            return self._generation
+        finally:
+            self.lock.release()
+
+    def _predict(self, t, forests, selected, generation):
+        """Predict all objects in time slice t, unless they are
+        cached already.
+
+        Different time slices are predicted concurrently; requests for
+        the same time slice wait for each other. The result is only
+        cached if the cache was not cleared since generation, i.e. if
+        forests is still the current classifier.
 
-            def predict_forest(_t, forest_index):
+        :returns: (probabilities, bad objects): the averaged probabilities of
+          all forests, shape (nobj, nclasses), and which objects had missing features
+
+        """
+        time_lock = self._timeLock(t)
+        time_lock.acquire()
+        try:
+            if t in self.prob_cache:
+                return self.prob_cache[t], self.bad_objects.get(t)
+
+            table = self._opFeatureTable.Output([t]).wait()[t]
+            ftmatrix, col_names = table.select(selected, t)
+            rows, cols = replace_missing(ftmatrix)
+            bad_objects = numpy.zeros((ftmatrix.shape[0],))
+            bad_objects[rows] = 1
+            ftmatrix = ftmatrix.astype(numpy.float32)
+
+            prob_predictions = [0] * len(forests)
+            def predict_forest(forest_index):
                 # Note: We can't use RandomForest.predictLabels() here because we're training in parallel,
                 #        and we have to average the PROBABILITIES from all forests.
                 #       Averaging the label predictions from each forest is NOT equivalent.
                 #       For details please see wikipedia:
                 #       http://en.wikipedia.org/wiki/Electoral_College_%28United_States%29#Irrelevancy_of_national_popular_vote
                 #       (^-^)
-                prob_predictions[_t][forest_index] = forests[forest_index].predictProbabilities(feats[_t].astype(numpy.float32))
+                prob_predictions[forest_index] = forests[forest_index].predictProbabilities(ftmatrix)
 
             # predict the data with all the forests in parallel
             pool = RequestPool()
-            for t in times:
-                if t in self.prob_cache:
-                    continue
-                for i, f in enumerate(forests):
-                    req = Request( partial(predict_forest, t, i) )
-                    pool.add(req)
-
+            for i in range(len(forests)):
+                pool.add( Request( partial(predict_forest, i) ) )
             pool.wait()
             pool.clean()
 
-            for t in times:
-                if t not in self.prob_cache:
-                    # prob_predictions is a dict-of-lists-of-arrays, indexed as follows:
-                    # prob_predictions[t][forest_index][object_index, class_index]
-
-                    # Stack the forests together and average them.
-                    stacked_predictions = numpy.array( prob_predictions[t] )
-                    averaged_predictions = numpy.average( stacked_predictions, axis=0 )
-                    assert averaged_predictions.shape[0] == len(feats[t])
+            # prob_predictions is a list-of-arrays, indexed as follows:
+            # prob_predictions[forest_index][object_index, class_index]
+
+            # Stack the forests together and average them. The forests
+            # may have different numbers of trees, so weight them by
+            # tree count to get the prediction of the merged forest.
+            stacked_predictions = numpy.array( prob_predictions )
+            tree_counts = [forest.treeCount() for forest in forests]
+            averaged_predictions = numpy.average( stacked_predictions, axis=0, weights=tree_counts )
+            assert averaged_predictions.shape[0] == len(ftmatrix)
+            averaged_predictions[0] = 0 # Background probability is always zero
+
+            self.lock.acquire()
+            try:
+                if generation == self._generation:
+                    self.bad_objects[t] = bad_objects
                     self.prob_cache[t] = averaged_predictions
-
-                    self.prob_cache[t][0] = 0 # Background probability is always zero
-
-
-            if slot == self.Probabilities:
-                return { t : self.prob_cache[t] for t in times }
-            elif slot == self.Predictions:
-                # FIXME: Support SegmentationThreshold again...
-                labels = dict()
-                for t in times:
-                    prob_sum = numpy.sum(self.prob_cache[t], axis=1)
-                    labels[t] = 1 + numpy.argmax(self.prob_cache[t], axis=1)
-                    labels[t][0] = 0 # Background gets the zero label
-                
-                return labels
-
-            elif slot == self.ProbabilityChannels:
-                try:
-                    prob_single_channel = {t: self.prob_cache[t][:, subindex[0]]
-                                           for t in times}
-                except:
-                    # no probabilities available for this class; return zeros
-                    prob_single_channel = {t: numpy.zeros((self.prob_cache[t].shape[0], 1))
-                                           for t in times}
-                return prob_single_channel
-
-            elif slot == self.BadObjects:
-                return { t : self.bad_objects[t] for t in times }
-
-            else:
-                assert False, "Unknown input slot"
+            finally:
+                self.lock.release()
+            return averaged_predictions, bad_objects
         finally:
-            self.lock.release()
+            time_lock.release()
 
     def propagateDirty(self, slot, subindex, roi):
-        self.prob_cache = {}
+        prob_cache = {}
         if slot is self.InputProbabilities:
-            self.prob_cache = self.InputProbabilities([]).wait()
+            prob_cache = self.InputProbabilities([]).wait()
+        self.lock.acquire()
+        try:
+            self._generation += 1
+            self.prob_cache = prob_cache
+        finally:
+            self.lock.release()
         self.Predictions.setDirty(())
         self.Probabilities.setDirty(())
         self.ProbabilityChannels.setDirty(())
@@ -964,9 +1239,102 @@ class OpRelabelSegmentation(Operator):
     loggingName = __name__ + ".OpRelabelSegmentation"
     logger = logging.getLogger(loggingName)
 
+    # bounding boxes of changed objects that are at most this many
+    # pixels apart are set dirty together
+    DirtyMergeDistance = 16
+
+    # if more objects change, the whole time slice is set dirty
+    MaxDirtyObjects = 256
+
+    def __init__(self, *args, **kwargs):
+        super(OpRelabelSegmentation, self).__init__(*args, **kwargs)
+        self._luts = dict() # t -> lookup table, see _makeLut()
+        self._boxes = dict() # t -> (mins, maxs) of the object bounding boxes, see _makeBoxes()
+
+        # self._lock guards the caches and the generations, which are
+        # incremented whenever (a time slice of) the caches is cleared,
+        # so that tables computed before are not stored
+        self._lock = RequestLock()
+        self._generation = 0
+        self._frameGenerations = defaultdict(int) # t -> generation
+
     def setupOutputs(self):
         self.Output.meta.assignFrom(self.Image.meta)
         self.Output.meta.dtype = self.ObjectMap.meta.mapping_dtype
+        self._invalidate(luts=True, boxes=True)
+
+    def _getLut(self, t):
+        """The object map of time slice t, followed by a zero for all
+        labels that are not in the map (see execute()). Cached until
+        the object map or the segmentation becomes dirty.
+
+        :returns: the lookup table, or None if there are no objects
+
+        """
+        with self._lock:
+            if t in self._luts:
+                return self._luts[t]
+            generation = (self._generation, self._frameGenerations[t])
+            haveBoxes = t in self._boxes
+        lut = self._makeLut(t)
+        boxes = None
+        if not haveBoxes:
+            boxes = self._makeBoxes(t)
+        with self._lock:
+            if generation == (self._generation, self._frameGenerations[t]):
+                self._luts[t] = lut
+                if boxes is not None:
+                    self._boxes[t] = boxes
+        return lut
+
+    def _invalidate(self, times=None, luts=False, boxes=False):
+        """Drop the cached lookup tables and/or bounding boxes of the
+        given time slices (of all time slices if times is None)."""
+        with self._lock:
+            if times is None:
+                self._generation += 1
+                if luts:
+                    self._luts = dict()
+                if boxes:
+                    self._boxes = dict()
+                return
+            for t in times:
+                self._frameGenerations[t] += 1
+                if luts:
+                    self._luts.pop(t, None)
+                if boxes:
+                    self._boxes.pop(t, None)
+
+    def _makeBoxes(self, t):
+        """The bounding boxes of the objects in time slice t, so that
+        propagateDirty can set only the boxes of changed objects dirty
+        without requesting anything. Cached until the features or the
+        segmentation become dirty.
+
+        :returns: (mins, maxs), or None if the features are not ready
+
+        """
+        if not self.Features.ready():
+            return None
+        feats = self.Features([t]).wait()[t][default_features_key]
+        return (numpy.asarray(feats['Coord<Minimum>']),
+                numpy.asarray(feats['Coord<Maximum>']))
+
+    def _makeLut(self, t):
+        map_ = self.ObjectMap([t]).wait()
+        tmap = map_[t]
+        # FIXME: necessary because predictions are returned
+        # enclosed in a list.
+        if isinstance(tmap, list):
+            tmap = tmap[0]
+        tmap = numpy.asarray(tmap).squeeze()
+        if tmap.ndim==0:
+            # no objects, nothing to paint
+            lut = None
+        else:
+            lut = numpy.zeros((len(tmap) + 1,), dtype=tmap.dtype)
+            lut[:len(tmap)] = tmap
+        return lut
 
     def execute(self, slot, subindex, roi, result):
         tStart = time.time()
@@ -974,68 +1342,101 @@ class OpRelabelSegmentation(Operator):
         tIMG = time.time()
         img = self.Image(roi.start, roi.stop).wait()
         tIMG = 1000.0*(time.time()-tIMG)
-        
+
+        tLUT = 0.0
+        tWORK = 0.0
         for t in range(roi.start[0], roi.stop[0]):
-            
-            tMAP = time.time()
-            map_ = self.ObjectMap([t]).wait()
-            tmap = map_[t]
-            # FIXME: necessary because predictions are returned
-            # enclosed in a list.
-            if isinstance(tmap, list):
-                tmap = tmap[0]
-            tmap = tmap.squeeze()
-            if tmap.ndim==0:
-                # no objects, nothing to paint
+            tLUT -= time.time()
+            lut = self._getLut(t)
+            tLUT += time.time()
+            if lut is None:
                 result[t-roi.start[0]][:] = 0
-                return result
-            
-            tMAP = 1000.0*(time.time()-tMAP)
-            #FIXME: This should be cached (and reset when the input becomes dirty)")
-            tMAX = time.time()
-            idx = img.max()
-            
-            if len(tmap) <= idx:
-                newTmap = numpy.zeros((idx + 1,)) # And maybe this should be cached, too?
-                newTmap[:len(tmap)] = tmap[:]
-                tmap = newTmap
-            tMAX = 1000.0*(time.time()-tMAX)
+                continue
             
             #do the work thing
-            tWORK = time.time()
-            result[t-roi.start[0]] = tmap[img[t-roi.start[0]]]
-            tWORK = 1000.0*(time.time()-tWORK)
+            tWORK -= time.time()
+            # labels without an entry in the map get the trailing zero
+            result[t-roi.start[0]] = lut.take(img[t-roi.start[0]], mode='clip')
+            tWORK += time.time()
             
         if self.logger.getEffectiveLevel() >= logging.DEBUG:
             tStart = 1000.0*(time.time()-tStart)
-            self.logger.debug("took %f msec. (img: %f, wait ObjectMap: %f, do work: %f, max: %f)" % (tStart, tIMG, tMAP, tWORK, tMAX))
+            self.logger.debug("took %f msec. (img: %f, lookup tables: %f, do work: %f)" % (tStart, tIMG, 1000.0*tLUT, 1000.0*tWORK))
         
         return result
 
     def propagateDirty(self, slot, subindex, roi):
+        # Nothing is requested here: the changed objects are taken from
+        # the roi, and their boxes from the cache filled by execute().
         if slot is self.Image:
+            self._invalidate(range(roi.start[0], roi.stop[0]), luts=True, boxes=True)
             self.Output.setDirty(roi)
 
-        elif slot is self.ObjectMap or slot is self.Features:
+        elif slot is self.ObjectMap:
             # this is hacky. the gui's onClick() function calls
             # setDirty with a (time, object) pair, while elsewhere we
-            # call setDirty with ().
+            # call setDirty with () or with time slices.
+            if len(roi._l) == 0:
+                self._invalidate(luts=True)
+                self.Output.setDirty(slice(None))
+                return
+
+            frames = set()
+            objects = defaultdict(list)
+            for x in roi._l:
+                if isinstance(x, tuple):
+                    objects[x[0]].append(x[1])
+                else:
+                    frames.add(x)
+            for t in frames:
+                self._invalidate([t], luts=True)
+                self._setFrameDirty(t)
+            for t, objs in objects.items():
+                if t not in frames:
+                    self._invalidate([t], luts=True)
+                    self._setObjectsDirty(t, objs)
+
+        elif slot is self.Features:
             if len(roi._l) == 0:
+                self._invalidate(boxes=True)
                 self.Output.setDirty(slice(None))
-            elif isinstance(roi._l[0], int):
-                for t in roi._l:
-                    self.Output.setDirty(slice(t))
             else:
-                assert len(roi._l[0]) == 2
-                # for each dirty object, only set its bounding box dirty
-                ts = list(set(t for t, _ in roi._l))
-                feats = self.Features(ts).wait()
-                for t, obj in roi._l:
-                    min_coords = feats[t][default_features_key]['Coord<Minimum>'][obj].astype(numpy.uint32)
-                    max_coords = feats[t][default_features_key]['Coord<Maximum>'][obj].astype(numpy.uint32)
-                    slcs = list(slice(*args) for args in zip(min_coords, max_coords))
-                    slcs = [slice(t, t+1),] + slcs + [slice(None),]
-                    self.Output.setDirty(slcs)
+                for t in set(x[0] if isinstance(x, tuple) else x for x in roi._l):
+                    self._invalidate([t], boxes=True)
+                    self._setFrameDirty(t)
+
+    def _setFrameDirty(self, t):
+        slicing = [slice(t, t+1)] + [slice(None)] * (len(self.Output.meta.shape) - 1)
+        self.Output.setDirty(slicing)
+
+    def _setObjectsDirty(self, t, objects):
+        """Set the bounding boxes of objects in time slice t dirty.
+
+        Nearby boxes are merged, so that a few larger rois are set
+        dirty instead of many small ones. If too many objects changed,
+        the whole time slice is set dirty.
+
+        """
+        objects = numpy.asarray(objects, dtype=numpy.intp)
+        objects = objects[objects > 0]
+        if len(objects) == 0:
+            return
+        boxes = self._boxes.get(t)
+        if boxes is None or len(objects) > self.MaxDirtyObjects:
+            self._setFrameDirty(t)
+            return
+
+        mins, maxs = boxes
+        objects = objects[objects < len(mins)]
+        if len(objects) == 0:
+            return
+        starts = mins[objects].astype(numpy.int64)
+        stops = maxs[objects].astype(numpy.int64) + 1 # Coord<Maximum> is inclusive
+        starts, stops = coalesce_boxes(starts, stops, self.DirtyMergeDistance)
+        for start, stop in zip(starts, stops):
+            slicing = [slice(t, t+1)] + [slice(a, b) for a, b in zip(start, stop)] + [slice(None)]
+            self.Output.setDirty(slicing)
+
 
 class OpMultiRelabelSegmentation(Operator):
     """Takes a segmentation image and multiple mappings and returns the
@@ -1116,6 +1517,58 @@ class OpMaxLabel(Operator):
         self._output = int(maxValue)
 
 
+class OpLabeledObjectExtent(Operator):
+    """Finds the largest bounding box of the labeled objects in all
+    images.
+
+    The output is a dictionary of the largest extent (in pixels) along
+    each spatial axis, e.g. {'x': 12, 'y': 9, 'z': 4}.  It is empty if
+    no object has been labeled yet.
+
+    """
+    name = "OpLabeledObjectExtent"
+    Labels = InputSlot(level=1, rtype=List, stype=Opaque)
+    Features = InputSlot(level=1, rtype=List, stype=Opaque)
+    Output = OutputSlot(stype=Opaque)
+
+    def setupOutputs(self):
+        self.Output.meta.shape = (1,)
+        self.Output.meta.dtype = object
+
+    def execute(self, slot, subindex, roi, result):
+        extent = None
+        for labelSlot, featureSlot in zip(self.Labels, self.Features):
+            if not labelSlot.ready() or not featureSlot.ready():
+                continue
+            labels = labelSlot[:].wait()
+            for t, t_labels in labels.iteritems():
+                labeled = numpy.flatnonzero(t_labels)
+                if len(labeled) == 0:
+                    continue
+                feats = featureSlot([t]).wait()[t][default_features_key]
+                mins = numpy.asarray(feats["Coord<Minimum>"])
+                maxs = numpy.asarray(feats["Coord<Maximum>"])
+                labeled = labeled[labeled < len(mins)]
+                if len(labeled) == 0:
+                    continue
+                # Coord<Maximum> is inclusive
+                t_extent = numpy.max(maxs[labeled] - mins[labeled] + 1, axis=0)
+                if extent is None:
+                    extent = t_extent
+                else:
+                    extent = numpy.maximum(extent, t_extent)
+
+        if extent is None:
+            result[0] = dict()
+        else:
+            # coordinates are in xyz order
+            result[0] = dict(zip('xyz', map(int, extent)))
+        return result
+
+    def propagateDirty(self, slot, subindex, roi):
+        self.Output.setDirty(slice(None))
+
+
 class OpBadObjectsToWarningMessage(Operator):
     """Parses an input dictionary of bad objects and bad features, and
     sets an informative warning message to its output slot.
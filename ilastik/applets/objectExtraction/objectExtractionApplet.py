@@ -38,7 +38,7 @@ class ObjectExtractionApplet(StandardApplet):
 
     @property
     def broadcastingSlots(self):
-        return ['Features']
+        return ['Features', 'SizeRange']
 
     @property
     def singleLaneGuiClass(self):
@@ -26,7 +26,7 @@ from ilastik.applets.layerViewer.layerViewerGui import LayerViewerGui
 from functools import partial
 from ilastik.applets.objectExtraction.opObjectExtraction import max_margin
 
-from ilastik.plugins import pluginManager
+from ilastik.plugins import objectFeatureCatalogs
 from ilastik.utility.gui import threadRouted
 from ilastik.config import cfg as ilastik_config
 
@@ -293,7 +293,6 @@ class ObjectExtractionGui(LayerViewerGui):
         self.applet = self.topLevelOperatorView.parent.parent.objectExtractionApplet
 
     def _selectFeaturesButtonPressed(self):
-        featureDict = {}
         mainOperator = self.topLevelOperatorView
         if not mainOperator.RawImage.ready():
             mexBox=QMessageBox()
@@ -313,8 +312,6 @@ class ObjectExtractionGui(LayerViewerGui):
         else:
             selectedFeatures = None
 
-        plugins = pluginManager.getPluginsOfCategory('ObjectFeatures')
-
         taggedShape = mainOperator.RawImage.meta.getTaggedShape()
         fakeimg = None
         fakeimgshp = [taggedShape['x'], taggedShape['y']]
@@ -345,8 +342,7 @@ class ObjectExtractionGui(LayerViewerGui):
             else:
                 fakeimg = vigra.taggedView(fakeimg, 'xy')
         
-        for pluginInfo in plugins:
-            featureDict[pluginInfo.name] = pluginInfo.plugin_object.availableFeatures(fakeimg, fakelabels)
+        featureDict = objectFeatureCatalogs(fakeimg, fakelabels)
         dlg = FeatureSelectionDialog(featureDict=featureDict,
                                      selectedFeatures=selectedFeatures, ndim=ndim)
         dlg.exec_()
@@ -14,11 +14,13 @@
 #
 # Copyright 2011-2014, the ilastik developers
 
+import itertools
 import logging
 import warnings
 from functools import partial
 
 import numpy
+import h5py
 
 from lazyflow.rtype import SubRegion
 from lazyflow.roi import getIntersectingBlocks, TinyVector, getBlockBounds, roiToSlice
@@ -26,11 +28,110 @@ from lazyflow.request import Request, RequestLock, RequestPool
 
 from ilastik.applets.base.appletSerializer import AppletSerializer,\
     deleteIfPresent, getOrCreateGroup, SerialSlot, SerialHdf5BlockSlot, SerialDictSlot
+from ilastik.applets.objectExtraction.objectFeatureTable import ObjectFeatureTable
 
 logger = logging.getLogger(__name__)
 
+# number of table elements per hdf5 chunk (256 KB of float32)
+FEATURE_TABLE_CHUNK_ELEMENTS = 2**16
+
+def writeFeatureTables(group, block_starts, region_features):
+    """Store the region features of several blocks as one table per plugin.
+
+    The layout inside group is::
+
+        blockStarts           (nblocks, ndim) start of each block roi
+        offsets               (nblocks + 1,)  rows of block k are offsets[k]:offsets[k+1]
+        <plugin>/data         (nrows, ncols)  chunked and compressed float32 table
+        <plugin>/columns      (ncols,)        feature name of each column
+
+    All blocks must contain the same features, otherwise an exception
+    is raised (see ObjectFeatureTable.from_features).
+
+    """
+    table = ObjectFeatureTable.from_features(dict(enumerate(region_features)))
+    group.create_dataset('blockStarts', data=numpy.asarray(block_starts, dtype=numpy.int64))
+    group.create_dataset('offsets', data=numpy.asarray(table.offsets, dtype=numpy.int64))
+
+    plugins = set(region_features[0].keys()) if region_features else set()
+    columns_by_plugin = itertools.groupby(enumerate(table.columns), lambda (j, (plugin, featname)): plugin)
+    for plugin, cols in columns_by_plugin:
+        cols = list(cols)
+        first, last = cols[0][0], cols[-1][0] + 1
+        featnames = [featname for _, (_, featname) in cols]
+
+        plugin_group = group.create_group(plugin)
+        plugin_group.create_dataset('columns', data=numpy.array(featnames))
+        data = table.data[:, first:last]
+        chunk_rows = max(1, min(data.shape[0], FEATURE_TABLE_CHUNK_ELEMENTS // data.shape[1]))
+        plugin_group.create_dataset('data', data=data, chunks=(chunk_rows, data.shape[1]), compression=1)
+        plugins.discard(plugin)
+
+    # plugins without any features are kept as empty groups
+    for plugin in plugins:
+        group.create_group(plugin)
+
+def readFeatureTables(group, blocks=None, selected=None):
+    """Load region features stored by writeFeatureTables().
+
+    :param blocks: optional list of block indices to load. Consecutive
+      blocks are read with a single hdf5 access.
+    :param selected: optional selected[plugin name][feature name]; only
+      the columns of these features are read.
+    :returns: list of (block start, region features) pairs
+
+    """
+    block_starts = group['blockStarts'][...]
+    offsets = group['offsets'][...]
+    if blocks is None:
+        blocks = range(len(block_starts))
+    blocks = sorted(set(blocks))
+
+    region_features = dict((k, {}) for k in blocks)
+    for plugin, plugin_group in group.iteritems():
+        if not isinstance(plugin_group, h5py.Group):
+            continue
+        if selected is not None and plugin not in selected:
+            continue
+        for k in blocks:
+            region_features[k][plugin] = {}
+        if 'data' not in plugin_group:
+            continue
+
+        featnames = map(str, plugin_group['columns'][...])
+        features = []
+        for featname, cols in itertools.groupby(enumerate(featnames), lambda (j, featname): featname):
+            if selected is not None and featname not in selected[plugin]:
+                continue
+            cols = list(cols)
+            features.append((featname, slice(cols[0][0], cols[-1][0] + 1)))
+        if not features:
+            continue
+        colslice = slice(features[0][1].start, features[-1][1].stop)
+
+        dataset = plugin_group['data']
+        for _, run in itertools.groupby(enumerate(blocks), lambda (i, k): k - i):
+            run = [k for _, k in run]
+            first = offsets[run[0]]
+            data = dataset[first:offsets[run[-1] + 1], colslice]
+            for k in run:
+                rows = slice(offsets[k] - first, offsets[k + 1] - first)
+                for featname, cols in features:
+                    cols = slice(cols.start - colslice.start, cols.stop - colslice.start)
+                    region_features[k][plugin][featname] = data[rows, cols]
+
+    return [(tuple(block_starts[k]), region_features[k]) for k in blocks]
+
+
 class SerialObjectFeaturesSlot(SerialSlot):
+    """Serializes the blockwise region features of OpObjectExtraction.
 
+    The features of all clean blocks of a lane are stored as chunked
+    tables, see writeFeatureTables(). Projects saved with the previous
+    layout, which had one group per block roi and one dataset per
+    feature, can still be loaded.
+
+    """
     def __init__(self, slot, inslot, blockslot, name=None,
                  subname=None, default=None, depends=None,
                  selfdepends=True):
@@ -52,39 +153,65 @@ class SerialObjectFeaturesSlot(SerialSlot):
             subgroup = getOrCreateGroup(group, str(i))
 
             cleanBlockRois = self.blockslot[i].value
+            block_starts = []
+            region_features = []
             for roi in cleanBlockRois:
                 region_features_arr = self.slot[i]( *roi ).wait()
                 assert region_features_arr.shape == (1,)
-                region_features = region_features_arr[0]
-                roi_grp = subgroup.create_group(name=str(roi))
-                logger.debug('Saving region features into group: "{}"'.format( roi_grp.name ))
-                for key, val in region_features.iteritems():
-                    plugin_group = getOrCreateGroup(roi_grp, key)
-                    for featname, featval in val.iteritems():
-                        plugin_group.create_dataset(name=featname, data=featval)
+                block_starts.append(roi[0])
+                region_features.append(region_features_arr[0])
+
+            logger.debug('Saving region features into group: "{}"'.format( subgroup.name ))
+            try:
+                writeFeatureTables(subgroup, block_starts, region_features)
+            except Exception as e:
+                # blocks with different features can not share a table
+                logger.warn('Could not store region features as a table ({}), '
+                            'falling back to one dataset per feature'.format(e))
+                for name in subgroup.keys():
+                    del subgroup[name]
+                self._serializeBlocks(subgroup, cleanBlockRois, region_features)
 
         self.dirty = False
 
+    def _serializeBlocks(self, subgroup, cleanBlockRois, region_features):
+        for roi, feats in zip(cleanBlockRois, region_features):
+            roi_grp = subgroup.create_group(name=str(roi))
+            for key, val in feats.iteritems():
+                plugin_group = getOrCreateGroup(roi_grp, key)
+                for featname, featval in val.iteritems():
+                    plugin_group.create_dataset(name=featname, data=featval)
+
     def deserialize(self, group):
         if not self.name in group:
             return
         opgroup = group[self.name]
         for i, (_, subgroup) in enumerate( sorted(opgroup.items() ) ):
-            for roiString, roi_grp in subgroup.iteritems():
-                logger.debug('Loading region features from dataset: "{}"'.format( roi_grp.name ))
-                roi = eval(roiString)
-
-                region_features = {}
-                for key, val in roi_grp.iteritems():
-                    region_features[key] = {}
-                    for featname, featval in val.iteritems():
-                        region_features[key][featname] = featval[...]
-
+            logger.debug('Loading region features from group: "{}"'.format( subgroup.name ))
+            if 'blockStarts' in subgroup:
+                blocks = [((start, tuple(s + 1 for s in start)), feats)
+                          for start, feats in readFeatureTables(subgroup)]
+            else:
+                blocks = self._deserializeBlocks(subgroup)
+
+            for roi, region_features in blocks:
                 slicing = roiToSlice( *roi )
                 self.inslot[i][slicing] = numpy.array([region_features])
 
         self.dirty = False
 
+    def _deserializeBlocks(self, subgroup):
+        """Read the old layout: one group per block roi, one dataset per feature."""
+        for roiString, roi_grp in subgroup.iteritems():
+            roi = eval(roiString)
+
+            region_features = {}
+            for key, val in roi_grp.iteritems():
+                region_features[key] = {}
+                for featname, featval in val.iteritems():
+                    region_features[key][featname] = featval[...]
+            yield roi, region_features
+
 
 class ObjectExtractionSerializer(AppletSerializer):
     def __init__(self, operator, projectFileGroupName):
@@ -94,6 +221,7 @@ class ObjectExtractionSerializer(AppletSerializer):
                                 operator.CleanLabelBlocks,
                                 name="LabelImage"),
             SerialDictSlot(operator.Features, transform=str),
+            SerialSlot(operator.SizeRange),
             SerialObjectFeaturesSlot(operator.BlockwiseRegionFeatures,
                                      operator.RegionFeaturesCacheInput,
                                      operator.RegionFeaturesCleanBlocks,
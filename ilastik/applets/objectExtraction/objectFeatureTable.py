@@ -0,0 +1,150 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import itertools
+from collections import OrderedDict
+
+import numpy
+
+from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
+
+
+def _nchannels(value):
+    """number of columns a feature array occupies in the table"""
+    return int(numpy.prod(value.shape[1:]))
+
+
+class ObjectFeatureTable(object):
+    """Object features of one or more time slices in columnar form.
+
+    All features are stored in a single contiguous float32 matrix
+    with one row per object and one column per feature channel.
+
+    Rows are grouped by time slice: the objects of time slice
+    times[i] are stored in rows offsets[i]:offsets[i+1], and the
+    first row of each group belongs to the background object 0 (as in
+    the feature dictionaries of OpObjectExtraction).
+
+    columns[j] is the (plugin name, feature name) pair that column j
+    belongs to. Features with several channels occupy consecutive
+    columns.
+
+    """
+    def __init__(self, data, columns, times, offsets):
+        assert data.ndim == 2
+        assert data.shape[1] == len(columns)
+        assert len(offsets) == len(times) + 1
+        assert offsets[-1] == data.shape[0]
+
+        self.data = data
+        self.columns = list(columns)
+        self.times = list(times)
+        self.offsets = numpy.asarray(offsets, dtype=numpy.intp)
+
+        self._time_index = dict((t, i) for i, t in enumerate(self.times))
+
+        # (plugin name, feature name) -> slice of columns
+        self._column_index = OrderedDict()
+        for key, group in itertools.groupby(enumerate(self.columns), lambda (j, key): key):
+            js = [j for j, _ in group]
+            assert key not in self._column_index, "columns of feature {} are not consecutive".format(key)
+            self._column_index[key] = slice(js[0], js[-1] + 1)
+
+    @classmethod
+    def from_features(cls, feats):
+        """Build a table from the nested feature dictionaries of
+        OpObjectExtraction.RegionFeatures, i.e. feats[t][plugin name][feature name].
+
+        Columns are ordered by plugin name, then by feature name.
+
+        """
+        times = sorted(feats.keys())
+
+        # first pass: find the table layout
+        columns = None
+        offsets = [0]
+        for t in times:
+            t_columns = []
+            nobj = None
+            for plugin in sorted(feats[t].keys()):
+                for featname in sorted(feats[t][plugin].keys()):
+                    value = numpy.asarray(feats[t][plugin][featname])
+                    if nobj is None:
+                        nobj = value.shape[0]
+                    elif value.shape[0] != nobj:
+                        raise Exception('feature {} does not have enough rows, {} instead of {}'.format(featname, value.shape[0], nobj))
+                    t_columns.extend([(plugin, featname)] * _nchannels(value))
+            if columns is None:
+                columns = t_columns
+            elif columns != t_columns:
+                raise Exception('different time slices did not have same features.')
+            offsets.append(offsets[-1] + (nobj or 0))
+
+        if columns is None:
+            columns = []
+
+        # second pass: copy the features into the table
+        data = numpy.empty((offsets[-1], len(columns)), dtype=numpy.float32)
+        result = cls(data, columns, times, offsets)
+        for t in times:
+            rows = result.rows(t)
+            for plugin, pfeats in feats[t].iteritems():
+                for featname, value in pfeats.iteritems():
+                    value = numpy.asarray(value)
+                    value = value.reshape(value.shape[0], _nchannels(value))
+                    data[rows, result._column_index[(plugin, featname)]] = value
+        return result
+
+    def rows(self, t):
+        """Slice of the rows belonging to time slice t."""
+        i = self._time_index[t]
+        return slice(self.offsets[i], self.offsets[i+1])
+
+    def feature(self, t, plugin, featname):
+        """View of a single feature in time slice t, shape (nobj, nchannels)."""
+        return self.data[self.rows(t), self._column_index[(plugin, featname)]]
+
+    def column_indices(self, selected):
+        """Find the columns of the features in selected[plugin name][feature name].
+
+        The default features are never selected.
+
+        :returns: (array of column indices, list of (plugin, feature) per column)
+
+        """
+        cols = []
+        for (plugin, featname), slc in self._column_index.iteritems():
+            if plugin == default_features_key:
+                continue
+            if plugin in selected and featname in selected[plugin]:
+                cols.extend(range(slc.start, slc.stop))
+        cols = numpy.asarray(cols, dtype=numpy.intp)
+        return cols, [self.columns[j] for j in cols]
+
+    def select(self, selected, t, objects=None):
+        """Copy the selected features of time slice t into a new matrix.
+
+        :param selected: selected[plugin name][feature name], see column_indices()
+        :param objects: optional array of object ids; only these rows are copied
+        :returns: (float32 matrix, list of (plugin, feature) per column)
+
+        """
+        cols, col_names = self.column_indices(selected)
+        rows = self.rows(t)
+        if objects is None:
+            objects = numpy.arange(rows.stop - rows.start)
+        objects = numpy.asarray(objects, dtype=numpy.intp) + rows.start
+        return self.data[numpy.ix_(objects, cols)], col_names
@@ -0,0 +1,120 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import itertools
+
+import numpy
+import vigra
+
+
+class ObjectIndex(object):
+    """Bounding boxes and block membership of the objects in a single
+    3d label image (one time slice).
+
+    The label image is divided into blocks of blockShape. For each
+    object, the index knows its bounding box and the blocks it
+    touches, so that consumers can request just these blocks or crops
+    instead of scanning the whole label image.
+
+    Object 0 is the background and is not indexed.
+
+    """
+    def __init__(self, shape, blockShape, bboxes, block_offsets, block_objects):
+        """
+        :param shape: xyz shape of the label image
+        :param blockShape: xyz shape of the blocks
+        :param bboxes: array of shape (nobj+1, 2, 3); bboxes[i] holds
+          the start and stop of object i. Objects that do not occur in
+          the label image have an empty box.
+        :param block_offsets: the objects of flat block index k are
+          block_objects[block_offsets[k]:block_offsets[k+1]]
+        :param block_objects: concatenated, sorted object ids per block
+
+        """
+        self.shape = tuple(shape)
+        self.blockShape = tuple(blockShape)
+        self.gridShape = tuple(-(-s // b) for s, b in zip(self.shape, self.blockShape))
+        self.bboxes = numpy.asarray(bboxes)
+        self.block_offsets = numpy.asarray(block_offsets, dtype=numpy.intp)
+        self.block_objects = numpy.asarray(block_objects)
+
+        # invert the block membership: object -> flat block indices
+        nblocks = len(self.block_offsets) - 1
+        block_of_entry = numpy.repeat(numpy.arange(nblocks), numpy.diff(self.block_offsets))
+        order = numpy.argsort(self.block_objects, kind='mergesort')
+        self._object_blocks = block_of_entry[order]
+        self._object_offsets = numpy.searchsorted(self.block_objects[order],
+                                                  numpy.arange(self.nobjects + 2))
+
+    @property
+    def nobjects(self):
+        """Number of objects, without the background."""
+        return len(self.bboxes) - 1
+
+    @classmethod
+    def from_labels(cls, labels, blockShape):
+        """Build the index of a 3d (xyz) label image."""
+        labels = numpy.asarray(labels)
+        assert labels.ndim == 3
+        blockShape = tuple(min(b, s) for b, s in zip(blockShape, labels.shape))
+        gridShape = tuple(-(-s // b) for s, b in zip(labels.shape, blockShape))
+
+        # objects per block
+        block_offsets = [0]
+        block_objects = []
+        for block in itertools.product(*map(range, gridShape)):
+            slicing = tuple(slice(i*b, (i+1)*b) for i, b in zip(block, blockShape))
+            objects = numpy.unique(labels[slicing])
+            objects = objects[objects != 0]
+            block_objects.append(objects)
+            block_offsets.append(block_offsets[-1] + len(objects))
+        block_objects = numpy.concatenate(block_objects) if block_objects else numpy.zeros((0,), dtype=labels.dtype)
+
+        # bounding boxes
+        nobj = int(labels.max()) if labels.size else 0
+        bboxes = numpy.zeros((nobj + 1, 2, 3), dtype=numpy.intp)
+        if nobj > 0:
+            labels32 = labels.astype(numpy.uint32)
+            feats = vigra.analysis.extractRegionFeatures(labels32.astype(numpy.float32), labels32,
+                                                         ['Coord<Minimum>', 'Coord<Maximum>'],
+                                                         ignoreLabel=0)
+            present = numpy.zeros(nobj + 1, dtype=bool)
+            present[block_objects] = True
+            present[0] = False
+            mins = numpy.asarray(feats['Coord<Minimum>'])[:nobj+1]
+            maxs = numpy.asarray(feats['Coord<Maximum>'])[:nobj+1]
+            bboxes[present, 0] = mins[present]
+            bboxes[present, 1] = maxs[present] + 1
+
+        return cls(labels.shape, blockShape, bboxes, block_offsets, block_objects)
+
+    def bbox(self, obj, margin=(0, 0, 0)):
+        """Slicing of the bounding box of object obj, enlarged by margin
+        and clipped to the label image."""
+        start = numpy.maximum(self.bboxes[obj, 0] - margin, 0)
+        stop = numpy.minimum(self.bboxes[obj, 1] + margin, self.shape)
+        return tuple(slice(a, b) for a, b in zip(start, stop))
+
+    def blocks(self, obj):
+        """Start coordinates of the blocks that contain object obj, shape (n, 3)."""
+        flat = self._object_blocks[self._object_offsets[obj]:self._object_offsets[obj+1]]
+        return numpy.transpose(numpy.unravel_index(flat, self.gridShape)) * self.blockShape
+
+    def objects(self, blockStart):
+        """Ids of the objects in the block starting at blockStart."""
+        block = tuple(s // b for s, b in zip(blockStart, self.blockShape))
+        k = numpy.ravel_multi_index(block, self.gridShape)
+        return self.block_objects[self.block_offsets[k]:self.block_offsets[k+1]]
@@ -17,18 +17,22 @@
 #Python
 from copy import copy
 import collections
+import itertools
 from collections import defaultdict
+from functools import partial
 
 #SciPy
 import numpy as np
 import vigra.analysis
+import psutil
 
 #lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot, OperatorWrapper
 from lazyflow.stype import Opaque
 from lazyflow.rtype import List, SubRegion
 from lazyflow.roi import roiToSlice, sliceToRoi
-from lazyflow.operators import OpCachedLabelImage, OpMultiArraySlicer2, OpMultiArrayStacker, OpArrayCache, OpCompressedCache
+from lazyflow.operators import OpCachedLabelImage, OpMultiArraySlicer2, OpArrayCache, OpCompressedCache
+from lazyflow.request import Request, RequestPool
 
 import logging
 logger = logging.getLogger(__name__)
@@ -40,6 +44,7 @@ except:
     logger.warn('could not import pluginManager')
 
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.applets.objectExtraction.objectIndex import ObjectIndex
 
 # These features are always calculated, but not used for prediction.
 # They are needed by our gui, or by downstream applets.
@@ -53,6 +58,10 @@ default_features = {'Coord<Minimum>':{}, 'Coord<Maximum>':{}, 'RegionCenter': {}
 # to distinguish them, they go in their own category with this name
 default_features_key = 'Default features'
 
+# local features are computed for this many objects per plugin call
+# (see ObjectFeaturesPlugin.compute_local_batch)
+local_features_batch_size = 256
+
 def max_margin(d, default=(0, 0, 0)):
     """find any parameter named 'margin' in the nested feature
     dictionary 'd' and return the max.
@@ -78,6 +87,25 @@ def max_margin(d, default=(0, 0, 0)):
                 continue
     return margin
 
+def fill_missing_objects(value, keep):
+    """Expand the feature rows of the objects where keep is True to
+    one row per object. The rows of the other objects are NaN.
+
+    value either has one row per kept object, or one row per object
+    up to the largest kept one (as computed by a plugin on a label
+    image without the other objects).
+
+    """
+    value = np.asarray(value)
+    result = np.empty((len(keep),) + value.shape[1:], dtype=np.float32)
+    result[...] = np.nan
+    kept = np.flatnonzero(keep)
+    if value.shape[0] == len(kept):
+        result[kept] = value
+    else:
+        result[kept] = value[kept]
+    return result
+
 def make_bboxes(binary_bbox, margin):
     """Return binary label arrays for an object with margin.
 
@@ -121,6 +149,11 @@ class OpRegionFeatures3d(Operator):
     * Features : a nested dictionary of features to compute.
       Features[plugin name][feature name][parameter name] = parameter value
 
+    * SizeRange : optional (min, max) number of voxels, both inclusive.
+      Objects outside of this range keep their IDs and default
+      features, but the plugin features are not computed for them and
+      are NaN instead.
+
     Outputs:
 
     * Output : a nested dictionary of features.
@@ -130,6 +163,7 @@ class OpRegionFeatures3d(Operator):
     RawVolume = InputSlot()
     LabelVolume = InputSlot()
     Features = InputSlot(rtype=List, stype=Opaque)
+    SizeRange = InputSlot(optional=True)
 
     Output = OutputSlot()
 
@@ -244,6 +278,21 @@ class OpRegionFeatures3d(Operator):
 
         feature_names = self.Features([]).wait()
 
+        # objects outside of the size range are removed from the label
+        # image that is passed to the plugins
+        keep = None
+        plugin_labels = labels
+        if self.SizeRange.ready():
+            minSize, maxSize = self.SizeRange.value
+            counts = np.bincount(np.asarray(labels, dtype=np.intp).ravel())
+            keep = (counts >= minSize) & (counts <= maxSize)
+            keep[0] = False
+            lut = np.where(keep, np.arange(len(counts)), 0).astype(labels.dtype)
+            plugin_labels = labels.copy()
+            plugin_labels[...] = lut[np.asarray(labels)]
+            logger.debug("{} of {} objects are within the size range {}".format(
+                np.count_nonzero(keep), len(counts) - 1, (minSize, maxSize)))
+
         # do global features
         logger.debug("computing global features")
         extra_features_computed = False
@@ -251,13 +300,13 @@ class OpRegionFeatures3d(Operator):
         selected_vigra_features = []
         for plugin_name, feature_dict in feature_names.iteritems():
             plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
-            if plugin_name == "Standard Object Features":
+            if plugin_name == "Standard Object Features" and keep is None:
                 #expand the feature list by our default features
                 logger.debug("attaching default features {} to vigra features {}".format(default_features, feature_dict))
                 selected_vigra_features = feature_dict.keys()
                 feature_dict.update(default_features)
                 extra_features_computed = True
-            global_features[plugin_name] = plugin.plugin_object.compute_global(image, labels, feature_dict, axes)
+            global_features[plugin_name] = plugin.plugin_object.compute_global(image, plugin_labels, feature_dict, axes)
         
         extrafeats = {}
         if extra_features_computed:
@@ -287,14 +336,18 @@ class OpRegionFeatures3d(Operator):
         mincoords = extrafeats["Coord<Minimum>"]
         maxcoords = extrafeats["Coord<Maximum>"]
         nobj = mincoords.shape[0]
-        
-        # local features: loop over all objects
-        def dictextend(a, b):
-            for key in b:
-                a[key].append(b[key])
-            return a
-        
 
+        if keep is None:
+            objects = range(nobj)
+        else:
+            # without background
+            keep = keep[1:]
+            assert len(keep) == nobj
+            objects = np.flatnonzero(keep)
+            for pfeats in global_features.itervalues():
+                for key, value in pfeats.items():
+                    pfeats[key] = fill_missing_objects(value, keep)
+        
         local_features = defaultdict(lambda: defaultdict(list))
         margin = max_margin(feature_names)
         has_local_features = {}
@@ -307,19 +360,25 @@ class OpRegionFeatures3d(Operator):
             
                             
         if np.any(margin) > 0:
+            # local features: loop over all objects, a batch at a time
             #starting from 0, we stripped 0th background object in global computation
-            for i in range(0, nobj):
-                logger.debug("processing object {}".format(i))
-                extent = self.compute_extent(i, image, mincoords, maxcoords, axes, margin)
-                rawbbox = self.compute_rawbbox(image, extent, axes)
-                #it's i+1 here, because the background has label 0
-                binary_bbox = np.where(labels[tuple(extent)] == i+1, 1, 0).astype(np.bool)
+            for batch_start in range(0, len(objects), local_features_batch_size):
+                batch = objects[batch_start:batch_start + local_features_batch_size]
+                logger.debug("processing objects {} to {}".format(batch[0], batch[-1]))
+                rawbboxes = []
+                binary_bboxes = []
+                for i in batch:
+                    extent = self.compute_extent(i, image, mincoords, maxcoords, axes, margin)
+                    rawbboxes.append(self.compute_rawbbox(image, extent, axes))
+                    #it's i+1 here, because the background has label 0
+                    binary_bboxes.append(np.where(labels[tuple(extent)] == i+1, 1, 0).astype(np.bool))
                 for plugin_name, feature_dict in feature_names.iteritems():
                     if not has_local_features[plugin_name]:
                         continue
                     plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
-                    feats = plugin.plugin_object.compute_local(rawbbox, binary_bbox, feature_dict, axes)
-                    local_features[plugin_name] = dictextend(local_features[plugin_name], feats)
+                    feats = plugin.plugin_object.compute_local_batch(rawbboxes, binary_bboxes, feature_dict, axes)
+                    for key, value in feats.iteritems():
+                        local_features[plugin_name][key].append(value)
 
         logger.debug("computing done, removing failures")
         # remove local features that failed
@@ -327,10 +386,17 @@ class OpRegionFeatures3d(Operator):
             for key in pfeats.keys():
                 value = pfeats[key]
                 try:
-                    pfeats[key] = np.vstack(list(v.reshape(1, -1) for v in value))
+                    rows = np.vstack(list(np.asarray(v).reshape(len(v), -1) for v in value))
                 except:
                     logger.warn('feature {} failed'.format(key))
                     del pfeats[key]
+                    continue
+                if rows.shape[0] != len(objects):
+                    raise Exception('feature {} does not have enough rows, {} instead of {}'.format(
+                        key, rows.shape[0], len(objects)))
+                if keep is not None:
+                    rows = fill_missing_objects(rows, keep)
+                pfeats[key] = rows
 
         # merge the global and local features
         logger.debug("removed failed, merging")
@@ -364,7 +430,7 @@ class OpRegionFeatures3d(Operator):
         return all_features
 
     def propagateDirty(self, slot, subindex, roi):
-        if slot is self.Features:
+        if slot is self.Features or slot is self.SizeRange:
             self.Output.setDirty(slice(None))
         else:
             axes = self.RawVolume.meta.getTaggedShape().keys()
@@ -384,18 +450,31 @@ class OpRegionFeatures3d(Operator):
 
             self.Output.setDirty(dirtyStart.values(), dirtyStop.values())
 
+def frame_size_bytes(slot):
+    """Number of bytes occupied by a single time slice of the data in 'slot'."""
+    taggedShape = slot.meta.getTaggedShape()
+    taggedShape['t'] = 1
+    return np.prod(taggedShape.values()) * slot.meta.getDtypeBytes()
+
 class OpRegionFeatures(Operator):
-    """Computes region features on a 5D volume."""
+    """Computes region features on a 5D volume.
+
+    Time slices are computed in parallel. The number of slices
+    processed at the same time is limited by the size of the thread
+    pool and by the memory needed per time slice.
+
+    """
     RawImage = InputSlot()
     LabelImage = InputSlot()
     Features = InputSlot(rtype=List, stype=Opaque)
+    SizeRange = InputSlot(optional=True)
     Output = OutputSlot()
 
     # Schematic:
     #
     # RawImage ----> opRawTimeSlicer ----
     #                                    \
-    # LabelImage --> opLabelTimeSlicer --> opRegionFeatures3dBlocks --> opTimeStacker -> Output
+    # LabelImage --> opLabelTimeSlicer --> opRegionFeatures3dBlocks --(parallel, via execute())--> Output
 
     def __init__(self, *args, **kwargs):
         super(OpRegionFeatures, self).__init__(*args, **kwargs)
@@ -418,24 +497,57 @@ class OpRegionFeatures(Operator):
         self.opRegionFeatures3dBlocks.RawVolume.connect(self.opRawTimeSlicer.Slices)
         self.opRegionFeatures3dBlocks.LabelVolume.connect(self.opLabelTimeSlicer.Slices)
         self.opRegionFeatures3dBlocks.Features.connect(self.Features)
+        self.opRegionFeatures3dBlocks.SizeRange.connect(self.SizeRange)
         assert self.opRegionFeatures3dBlocks.Output.level == 1
 
-        self.opTimeStacker = OpMultiArrayStacker(parent=self)
-        self.opTimeStacker.AxisFlag.setValue('t')
-        assert self.opTimeStacker.Images.level == 1
-        self.opTimeStacker.Images.connect(self.opRegionFeatures3dBlocks.Output)
-
-        # Connect our outputs
-        self.Output.connect(self.opTimeStacker.Output)
-
     def setupOutputs(self):
-        pass
+        # One element per time slice
+        self.Output.meta.shape = (self.LabelImage.meta.getTaggedShape()['t'],)
+        self.Output.meta.axistags = vigra.defaultAxistags('t')
+        self.Output.meta.dtype = object
 
     def execute(self, slot, subindex, roi, destination):
-        assert False, "Shouldn't get here."
+        assert slot == self.Output, "Unknown output slot"
+        times = range(roi.start[0], roi.stop[0])
+        nparallel = min(len(times), self._maxParallelTimeSlices())
+
+        def compute_times(ts):
+            for t in ts:
+                req = self.opRegionFeatures3dBlocks.Output[t]([0], [1])
+                req.writeInto(destination[t-roi.start[0]:t-roi.start[0]+1])
+                req.wait()
+
+        # Each request handles every nparallel-th time slice, so no more
+        # than nparallel time slices are held in memory at once.
+        pool = RequestPool()
+        for i in range(nparallel):
+            pool.add(Request(partial(compute_times, times[i::nparallel])))
+        pool.wait()
+        pool.clean()
+        return destination
+
+    def _maxParallelTimeSlices(self):
+        """Estimate how many time slices can be computed at the same time."""
+        nworkers = max(1, Request.global_thread_pool.num_workers)
+
+        # A time slice needs the raw data, a float32 copy of it for vigra,
+        # the labels and about as much again for the object masks.
+        rawBytes = frame_size_bytes(self.RawImage)
+        rawVoxels = rawBytes / self.RawImage.meta.getDtypeBytes()
+        frameBytes = rawBytes + 4*rawVoxels + 2*frame_size_bytes(self.LabelImage)
+        availableBytes = psutil.virtual_memory().available
+
+        nparallel = int(max(1, min(nworkers, availableBytes // frameBytes)))
+        logger.debug("Computing region features for up to {} time slices in parallel"
+                     " ({:.1f} MB per time slice)".format(nparallel, frameBytes / 1e6))
+        return nparallel
 
     def propagateDirty(self, slot, subindex, roi):
-        pass # Nothing to do...
+        if slot is self.Features or slot is self.SizeRange:
+            self.Output.setDirty(slice(None))
+        else:
+            timeIndex = slot.meta.axistags.index('t')
+            self.Output.setDirty(slice(roi.start[timeIndex], roi.stop[timeIndex]))
 
 class OpCachedRegionFeatures(Operator):
     """Caches the region features computed by OpRegionFeatures."""
@@ -443,6 +555,7 @@ class OpCachedRegionFeatures(Operator):
     LabelImage = InputSlot()
     CacheInput = InputSlot(optional=True)
     Features = InputSlot(rtype=List, stype=Opaque)
+    SizeRange = InputSlot(optional=True)
 
     Output = OutputSlot()
     CleanBlocks = OutputSlot()
@@ -463,6 +576,7 @@ class OpCachedRegionFeatures(Operator):
         self._opRegionFeatures.RawImage.connect(self.RawImage)
         self._opRegionFeatures.LabelImage.connect(self.LabelImage)
         self._opRegionFeatures.Features.connect(self.Features)
+        self._opRegionFeatures.SizeRange.connect(self.SizeRange)
 
         # Hook up the cache.
         self._opCache = OpArrayCache(parent=self)
@@ -525,19 +639,23 @@ class OpAdaptTimeListRoi(Operator):
         if len(roi) == 0:
             roi = range(taggedShape['t'])
 
-        taggedShape['t'] = 1
         timeIndex = taggedShape.keys().index('t')
 
+        # Request each run of consecutive time slices at once, so that
+        # upstream operators can compute them in parallel.
         result = {}
-        for t in roi:
+        times = sorted(set(roi))
+        for _, run in itertools.groupby(enumerate(times), lambda (i, t): t - i):
+            run = [t for _, t in run]
             start = [0] * len(taggedShape)
             stop = taggedShape.values()
-            start[timeIndex] = t
-            stop[timeIndex] = t + 1
+            start[timeIndex] = run[0]
+            stop[timeIndex] = run[-1] + 1
 
             val = self.Input(start, stop).wait()
-            assert val.shape == (1,)
-            result[t] = val[0]
+            assert val.shape == (len(run),)
+            for t, v in zip(run, val):
+                result[t] = v
 
         return result
 
@@ -555,55 +673,131 @@ class OpObjectCenterImage(Operator):
     RegionCenters = InputSlot(rtype=List, stype=Opaque)
     Output = OutputSlot()
 
+    def __init__(self, *args, **kwargs):
+        super(OpObjectCenterImage, self).__init__(*args, **kwargs)
+        self._centerCache = dict()
+
     def setupOutputs(self):
         self.Output.meta.assignFrom(self.BinaryImage.meta)
+        self._centerCache = dict()
 
-    @staticmethod
-    def __contained_in_subregion(roi, coords):
-        b = True
-        for i in range(len(coords)):
-            b = b and (roi.start[i] <= coords[i] and coords[i] < roi.stop[i])
-        return b
+    def _getCenters(self, t):
+        """Integer xyz coordinates of the object centers in time slice t,
+        without the background object. Cached until the region centers
+        of this time slice become dirty.
 
-    @staticmethod
-    def __make_key(roi, coords):
-        key = [int(coords[i] - roi.start[i]) for i in range(len(roi.start))]
-        return tuple(key)
+        """
+        try:
+            return self._centerCache[t]
+        except KeyError:
+            pass
 
-    def execute(self, slot, subindex, roi, result):
-        assert slot == self.Output, "Unknown output slot"
-        
-        result[:] = 0
         ndim = 3
         taggedShape = self.BinaryImage.meta.getTaggedShape()
         if 'z' not in taggedShape or taggedShape['z']==1:
             ndim = 2
+
+        obj_features = self.RegionCenters([t]).wait()
+        centers = np.asarray(obj_features[t][default_features_key]['RegionCenter'])
+        coords = np.zeros((max(centers.shape[0] - 1, 0), 3), dtype=np.intp)
+        if centers.size:
+            # truncate, as int() would
+            coords[:, :ndim] = centers[1:, :ndim]
+
+        self._centerCache[t] = coords
+        return coords
+
+    def execute(self, slot, subindex, roi, result):
+        assert slot == self.Output, "Unknown output slot"
+
+        result[:] = 0
+        #FIXME: this assumes txyzc axis order
+        spatialStart = np.asarray(roi.start[1:4])
+        spatialStop = np.asarray(roi.stop[1:4])
         for t in range(roi.start[0], roi.stop[0]):
-            obj_features = self.RegionCenters([t]).wait()
-            #FIXME: this assumes that channel is the last axis
-            for ch in range(roi.start[-1], roi.stop[-1]):
-                centers = obj_features[t][default_features_key]['RegionCenter']
-                if centers.size:
-                    centers = centers[1:, :]
-                for center in centers:
-                    if ndim==3:
-                        x, y, z = center[0:3]
-                        c = (t, x, y, z, ch)
-                    elif ndim==2:
-                        x, y = center[0:2]
-                        c = (t, x, y, 0, ch)
-                    if self.__contained_in_subregion(roi, c):
-                        result[self.__make_key(roi, c)] = 1
+            coords = self._getCenters(t)
+            inside = np.all((coords >= spatialStart) & (coords < spatialStop), axis=1)
+            local = coords[inside] - spatialStart
+            # all requested channels at once
+            result[t - roi.start[0], local[:, 0], local[:, 1], local[:, 2]] = 1
 
         return result
 
     def propagateDirty(self, slot, subindex, roi):
         # the roi here is a list of time steps 
         if slot is self.RegionCenters:
+            if len(roi._l) == 0:
+                self._centerCache = dict()
+                self.Output.setDirty(slice(None))
             for t in roi:
+                self._centerCache.pop(t, None)
                 self.Output.setDirty(slice(t, t+1, None))
                                   
 
+class OpObjectIndex(Operator):
+    """Builds an ObjectIndex (bounding boxes and block membership of
+    all objects) for each time slice of a label image.
+
+    The output is a dictionary of (time, ObjectIndex) pairs, as for
+    OpAdaptTimeListRoi. Indexes are cached until the corresponding
+    time slice of the label image becomes dirty.
+
+    """
+    LabelImage = InputSlot()
+    BlockShape = InputSlot(value=(64, 64, 64)) # xyz
+    Output = OutputSlot(stype=Opaque, rtype=List)
+
+    def __init__(self, *args, **kwargs):
+        super(OpObjectIndex, self).__init__(*args, **kwargs)
+        self._cache = dict()
+
+    def setupOutputs(self):
+        taggedShape = self.LabelImage.meta.getTaggedShape()
+        if set(taggedShape.keys()) != set('txyzc') or taggedShape['c'] != 1:
+            raise Exception("Label image must have txyzc axes and a single channel.")
+        self.Output.meta.shape = (taggedShape['t'],)
+        self.Output.meta.dtype = object
+        self._cache = dict()
+
+    def _getIndex(self, t):
+        try:
+            return self._cache[t]
+        except KeyError:
+            pass
+
+        taggedShape = self.LabelImage.meta.getTaggedShape()
+        timeIndex = taggedShape.keys().index('t')
+        start = [0] * len(taggedShape)
+        stop = taggedShape.values()
+        start[timeIndex] = t
+        stop[timeIndex] = t + 1
+        labels = self.LabelImage(start, stop).wait()
+        labels = labels.view(vigra.VigraArray)
+        labels.axistags = self.LabelImage.meta.axistags
+        labels = labels.withAxes(*'xyz')
+
+        index = ObjectIndex.from_labels(labels, self.BlockShape.value)
+        self._cache[t] = index
+        return index
+
+    def execute(self, slot, subindex, roi, result):
+        assert slot == self.Output, "Unknown output slot"
+        times = roi._l
+        if len(times) == 0:
+            times = range(self.Output.meta.shape[0])
+        return dict((t, self._getIndex(t)) for t in times)
+
+    def propagateDirty(self, slot, subindex, roi):
+        if slot is self.BlockShape:
+            self._cache = dict()
+            self.Output.setDirty(())
+        elif slot is self.LabelImage:
+            timeIndex = self.LabelImage.meta.axistags.index('t')
+            times = range(roi.start[timeIndex], roi.stop[timeIndex])
+            for t in times:
+                self._cache.pop(t, None)
+            self.Output.setDirty(List(self.Output, times))
+
 class OpObjectExtraction(Operator):
     """The top-level operator for the object extraction applet.
 
@@ -622,6 +816,10 @@ class OpObjectExtraction(Operator):
     # for example {"Standard Object Features": {"Mean in neighborhood":{"margin": (5, 5, 2)}}}
     Features = InputSlot(rtype=List, stype=Opaque, value={})
 
+    # optional (min, max) object size in voxels, both inclusive. Plugin
+    # features are only computed for objects within this range.
+    SizeRange = InputSlot(optional=True)
+
     LabelImage = OutputSlot()
     ObjectCenterImage = OutputSlot()
 
@@ -633,6 +831,10 @@ class OpObjectExtraction(Operator):
     # pass through the 'Features' input slot
     ComputedFeatureNames = OutputSlot(rtype=List, stype=Opaque)
 
+    # bounding boxes and block membership of all objects.
+    # dictionary with format: dict[t] = ObjectIndex
+    ObjectIndex = OutputSlot(stype=Opaque, rtype=List)
+
     BlockwiseRegionFeatures = OutputSlot() # For compatibility with tracking workflow, the RegionFeatures output
                                            # has rtype=List, indexed by t.
                                            # For other workflows, output has rtype=ArrayLike, indexed by (t)
@@ -649,8 +851,10 @@ class OpObjectExtraction(Operator):
     # BackgroundLabels              LabelImage
     #                 \            /
     # BinaryImage ---> opLabelImage ---> opRegFeats ---> opRegFeatsAdaptOutput ---> RegionFeatures
-    #                                   /                                     \
-    # RawImage--------------------------                      BinaryImage ---> opObjectCenterImage --> opCenterCache --> ObjectCenterImage
+    #                     |             /                                     \
+    # RawImage------------|-------------                      BinaryImage ---> opObjectCenterImage --> opCenterCache --> ObjectCenterImage
+    #                     |
+    #                      ------------> opObjectIndex ---> ObjectIndex
 
     def __init__(self, *args, **kwargs):
 
@@ -662,6 +866,7 @@ class OpObjectExtraction(Operator):
         self._opRegFeats = OpCachedRegionFeatures(parent=self)
         self._opRegFeatsAdaptOutput = OpAdaptTimeListRoi(parent=self)
         self._opObjectCenterImage = OpObjectCenterImage(parent=self)
+        self._opObjectIndex = OpObjectIndex(parent=self)
 
         # connect internal operators
         self._opLabelImage.Input.connect(self.BinaryImage)
@@ -671,12 +876,15 @@ class OpObjectExtraction(Operator):
         self._opRegFeats.RawImage.connect(self.RawImage)
         self._opRegFeats.LabelImage.connect(self._opLabelImage.Output)
         self._opRegFeats.Features.connect(self.Features)
+        self._opRegFeats.SizeRange.connect(self.SizeRange)
         self.RegionFeaturesCleanBlocks.connect(self._opRegFeats.CleanBlocks)
 
         self._opRegFeats.CacheInput.connect(self.RegionFeaturesCacheInput)
 
         self._opRegFeatsAdaptOutput.Input.connect(self._opRegFeats.Output)
 
+        self._opObjectIndex.LabelImage.connect(self._opLabelImage.Output)
+
         self._opObjectCenterImage.BinaryImage.connect(self.BinaryImage)
         self._opObjectCenterImage.RegionCenters.connect(self._opRegFeatsAdaptOutput.Output)
 
@@ -692,6 +900,7 @@ class OpObjectExtraction(Operator):
         self.LabelOutputHdf5.connect(self._opLabelImage.OutputHdf5)
         self.CleanLabelBlocks.connect(self._opLabelImage.CleanBlocks)
         self.ComputedFeatureNames.connect(self.Features)
+        self.ObjectIndex.connect(self._opObjectIndex.Output)
 
         # As soon as input data is available, check its constraints
         self.RawImage.notifyReady( self._checkConstraints )
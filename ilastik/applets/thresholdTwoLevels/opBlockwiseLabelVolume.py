@@ -0,0 +1,222 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+# Built-in
+import logging
+import collections
+from functools import partial
+
+# Third-party
+import numpy
+import vigra
+
+# Lazyflow
+from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.operators import OpCompressedCache
+from lazyflow.request import Request, RequestLock, RequestPool
+from lazyflow.roi import getIntersectingBlocks, getIntersection, roiToSlice
+
+# ilastik
+from ilastik.applets.blockwiseObjectClassification.objectStitching import block_objects, stitch_blocks
+
+logger = logging.getLogger(__name__)
+
+
+## Connected component labeling, block by block
+#
+# Each block of a time slice is labeled independently.  The labels that
+# touch across block faces are merged with a union-find pass (see
+# objectStitching), which yields a lookup table from the local labels of
+# each block to the labels of the whole time slice.
+#
+# Only these lookup tables (and the sizes of the objects) are kept.  A
+# requested block is labeled again and relabeled with its lookup table, so
+# no more than one block per request is held in memory.  CachedOutput keeps
+# the relabeled blocks in a compressed cache with the same block shape.
+#
+# ComponentSizes has one element per time slice and channel: the voxel
+# count of each label (index 0 is the background), so that the objects can
+# be filtered by size without reading the whole time slice again.
+#
+# The objects are the same as those of vigra's labelVolumeWithBackground
+# (6-neighborhood), numbered consecutively per time slice and channel in
+# block order.
+#
+# The input must have 5 dimensions (txyzc), 0 is the background.
+class OpBlockwiseLabelVolume(Operator):
+    name = "OpBlockwiseLabelVolume"
+
+    Input = InputSlot()
+    BlockShape3dDict = InputSlot(value={'x': 256, 'y': 256, 'z': 256})
+
+    Output = OutputSlot()
+    CachedOutput = OutputSlot()
+    ComponentSizes = OutputSlot()
+
+    def __init__(self, *args, **kwargs):
+        super(OpBlockwiseLabelVolume, self).__init__(*args, **kwargs)
+        self._opCache = OpCompressedCache(parent=self)
+        self._opCache.name = "OpBlockwiseLabelVolume._opCache"
+        self._opCache.Input.connect(self.Output)
+        self.CachedOutput.connect(self._opCache.Output)
+
+        self._luts = dict()  # (t, c) -> (block start -> lut, component sizes)
+        self._lock = RequestLock()
+        self._sliceLocks = collections.defaultdict(RequestLock)
+        # incremented whenever (a slice of) self._luts is cleared, so that
+        # lookup tables computed before are not stored, see _getLuts()
+        self._generation = 0
+        self._sliceGenerations = collections.defaultdict(int)
+
+    def setupOutputs(self):
+        assert "".join(self.Input.meta.getAxisKeys()) == 'txyzc', \
+            "Input must have axes txyzc, not {}".format(self.Input.meta.getAxisKeys())
+        self.Output.meta.assignFrom(self.Input.meta)
+        self.Output.meta.dtype = numpy.uint32
+        self.Output.meta.drange = None
+
+        shape = self.Input.meta.shape
+        block_shape = self.BlockShape3dDict.value
+        self._block_shape = tuple(min(block_shape[k], n) for k, n in zip('xyz', shape[1:4]))
+        self._opCache.BlockShape.setValue((1,) + self._block_shape + (1,))
+
+        self.ComponentSizes.meta.shape = (shape[0], shape[4])
+        self.ComponentSizes.meta.dtype = object
+        self.ComponentSizes.meta.axistags = None
+
+        with self._lock:
+            self._luts = dict()
+            self._sliceLocks = collections.defaultdict(RequestLock)
+            self._generation += 1
+
+    def execute(self, slot, subindex, roi, result):
+        if slot == self.ComponentSizes:
+            for t in range(roi.start[0], roi.stop[0]):
+                for c in range(roi.start[1], roi.stop[1]):
+                    result[t - roi.start[0], c - roi.start[1]] = self._getLuts(t, c)[1]
+            return result
+
+        assert slot == self.Output
+        roi_start = numpy.asarray(roi.start)
+        roi_stop = numpy.asarray(roi.stop)
+        spatial_roi = (roi_start[1:4], roi_stop[1:4])
+        block_starts = map(tuple, getIntersectingBlocks(self._block_shape, spatial_roi))
+
+        def relabel_block(t, c, block_start):
+            luts = self._getLuts(t, c)[0]
+            block_roi = self._blockRoi(block_start)
+            labels = self._labelBlock(t, c, block_roi)
+            intersection = getIntersection(block_roi, spatial_roi)
+            block_slicing = roiToSlice(*numpy.subtract(intersection, block_roi[0]))
+            result_slicing = roiToSlice(*numpy.subtract(intersection, spatial_roi[0]))
+            # labels beyond the table only occur if the input changed
+            # after the table was computed, the output is dirty then
+            result[(t - roi_start[0],) + result_slicing + (c - roi_start[4],)] = \
+                luts[block_start].take(labels[block_slicing], mode='clip')
+
+        pool = RequestPool()
+        for t in range(roi_start[0], roi_stop[0]):
+            for c in range(roi_start[4], roi_stop[4]):
+                for block_start in block_starts:
+                    pool.add(Request(partial(relabel_block, t, c, block_start)))
+        pool.wait()
+        pool.clean()
+        return result
+
+    def _blockRoi(self, block_start):
+        shape = self.Input.meta.shape[1:4]
+        block_stop = numpy.minimum(numpy.add(block_start, self._block_shape), shape)
+        return (numpy.asarray(block_start), block_stop)
+
+    def _labelBlock(self, t, c, block_roi):
+        """The local labels of a single 3d block."""
+        start = (t,) + tuple(block_roi[0]) + (c,)
+        stop = (t+1,) + tuple(block_roi[1]) + (c+1,)
+        data = self.Input(start, stop).wait()[0, ..., 0]
+        data = numpy.asarray(data).astype(numpy.uint8)
+        if data.shape[2] == 1:
+            labels = vigra.analysis.labelImageWithBackground(data[..., 0])
+            return numpy.asarray(labels).reshape(data.shape)
+        return numpy.asarray(vigra.analysis.labelVolumeWithBackground(data))
+
+    def _getLuts(self, t, c):
+        """
+        The lookup tables of all blocks of time slice t and channel c and
+        the sizes of the objects, computed by labeling all their blocks on
+        first use.
+        """
+        with self._lock:
+            sliceLock = self._sliceLocks[(t, c)]
+        with sliceLock:
+            with self._lock:
+                luts = self._luts.get((t, c))
+                generation = (self._generation, self._sliceGenerations[(t, c)])
+            if luts is None:
+                luts = self._computeLuts(t, c)
+                with self._lock:
+                    if generation == (self._generation, self._sliceGenerations[(t, c)]):
+                        self._luts[(t, c)] = luts
+            return luts
+
+    def _computeLuts(self, t, c):
+        shape = self.Input.meta.shape[1:4]
+        block_starts = map(tuple, getIntersectingBlocks(self._block_shape, ((0, 0, 0), shape)))
+        summaries = dict()
+
+        def summarize_blocks(starts):
+            for block_start in starts:
+                labels = self._labelBlock(t, c, self._blockRoi(block_start))
+                summaries[block_start] = block_objects(labels, [])
+
+        # Each request handles every nparallel-th block, so no more
+        # than nparallel blocks are held in memory at once.
+        nparallel = min(len(block_starts), max(1, Request.global_thread_pool.num_workers))
+        pool = RequestPool()
+        for i in range(nparallel):
+            pool.add(Request(partial(summarize_blocks, block_starts[i::nparallel])))
+        pool.wait()
+        pool.clean()
+
+        luts, _ = stitch_blocks(self._block_shape, summaries)
+
+        # the sizes of the fragments add up to the sizes of the objects
+        nlabels = max(lut.max() for lut in luts.values()) + 1
+        sizes = numpy.zeros((nlabels,), dtype=numpy.int64)
+        for block_start, lut in luts.items():
+            sizes += numpy.bincount(lut, weights=summaries[block_start].sizes,
+                                    minlength=nlabels).astype(numpy.int64)
+        logger.debug("Labeled {} blocks of time slice {}, channel {}".format(len(luts), t, c))
+        return luts, sizes
+
+    def propagateDirty(self, slot, subindex, roi):
+        shape = self.Input.meta.shape
+        if slot == self.Input:
+            # Objects may merge or split anywhere, so the whole time
+            # slice (and channel) is relabeled.
+            with self._lock:
+                for t in range(roi.start[0], roi.stop[0]):
+                    for c in range(roi.start[4], roi.stop[4]):
+                        self._luts.pop((t, c), None)
+                        self._sliceGenerations[(t, c)] += 1
+            start = (roi.start[0], 0, 0, 0, roi.start[4])
+            stop = (roi.stop[0],) + tuple(shape[1:4]) + (roi.stop[4],)
+            self.Output.setDirty(start, stop)
+            self.ComponentSizes.setDirty((roi.start[0], roi.start[4]), (roi.stop[0], roi.stop[4]))
+        elif slot == self.BlockShape3dDict:
+            self.Output.setDirty(slice(None))
+            self.ComponentSizes.setDirty(slice(None))
+        else:
+            assert False, "Unknown input slot: {}".format(slot.name)
@@ -15,40 +15,53 @@
 # Copyright 2011-2014, the ilastik developers
 
 # Built-in
-import gc
 import warnings
 import logging
+import collections
 from functools import partial
 
 # Third-party
 import numpy
 import vigra
-import psutil
 
 # Lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.operators import OpMultiArraySlicer2, OpPixelOperator, OpLabelVolume, OpFilterLabels, \
+from lazyflow.operators import OpMultiArraySlicer2, OpPixelOperator, OpLabelVolume, \
                                OpCompressedCache, OpColorizeLabels, OpSingleChannelSelector, OperatorWrapper, \
                                OpMultiArrayStacker, OpMultiArraySlicer, OpReorderAxes
-from lazyflow.roi import extendSlice, TinyVector
+from lazyflow.roi import extendSlice, TinyVector, getIntersectingBlocks
 from lazyflow.rtype import SubRegion
-from lazyflow.request import Request, RequestPool
+from lazyflow.request import Request, RequestPool, RequestLock
 
 # ilastik
 from lazyflow.utility.timer import Timer
+from opBlockwiseLabelVolume import OpBlockwiseLabelVolume
 
 logger = logging.getLogger(__name__)
 
 
-def getMemoryUsageMb():
+def _connectIf(condition, slot, partner):
     """
-    Get the current memory usage for the whole system (not just python).
+    Connect slot to partner if condition is True, disconnect it otherwise.
+    The labelers that are not used stay disconnected, they only accept 5d input.
     """
-    # Collect garbage first
-    gc.collect()
-    vmem = psutil.virtual_memory()
-    mem_usage_mb = (vmem.total - vmem.available) / 1e6
-    return mem_usage_mb
+    if not condition:
+        slot.disconnect()
+    elif slot.partner != partner:
+        slot.connect(partner)
+
+
+def _labelCacheBlockShape(tagged_shape, blockShape3dDict=None):
+    """
+    The block shape of a cache of labels with the given tagged shape: whole
+    time slices, or the blocks of blockwise labeling (see BlockwiseLabeling).
+    """
+    block_shape = collections.OrderedDict(tagged_shape)
+    block_shape['t'] = 1
+    if blockShape3dDict is not None:
+        for k in 'xyz':
+            block_shape[k] = min(blockShape3dDict[k], tagged_shape[k])
+    return block_shape
 
 
 #TODO: hide this operator somewhere. deep.
@@ -202,6 +215,10 @@ class OpAnisotropicGaussianSmoothing(Operator):
 #
 #   Given two label images, produce a copy of BigLabels, EXCEPT first remove all labels 
 #   from BigLabels that do not overlap with any labels in SmallLabels.
+#
+#   If BlockShape3dDict is given (5d input, labeled blockwise), the overlapping labels
+#   are found block by block on whole time slices, and keep their ids, so that every
+#   requested block agrees on them and the component sizes of BigLabels still apply.
 class OpSelectLabels(Operator):
 
     ## The smaller clusters
@@ -212,75 +229,150 @@ class OpSelectLabels(Operator):
     # i.e. results of low thresholding
     BigLabels = InputSlot()
 
+    BlockShape3dDict = InputSlot(optional=True)
+
     Output = OutputSlot()
 
+    def __init__(self, *args, **kwargs):
+        super(OpSelectLabels, self).__init__(*args, **kwargs)
+        self._luts = dict()  # (t, c) -> lut, see BlockShape3dDict
+        self._lock = RequestLock()
+        self._sliceLocks = collections.defaultdict(RequestLock)
+        # incremented whenever (a slice of) self._luts is cleared, so that
+        # lookup tables computed before are not stored, see _getLut()
+        self._generation = 0
+        self._sliceGenerations = collections.defaultdict(int)
+
     def setupOutputs(self):
         self.Output.meta.assignFrom(self.BigLabels.meta)
         self.Output.meta.dtype = numpy.uint32
         self.Output.meta.drange = (0, 1)
 
+        if self.BlockShape3dDict.ready():
+            assert "".join(self.BigLabels.meta.getAxisKeys()) == 'txyzc', \
+                "Blockwise selection needs axes txyzc, not {}".format(self.BigLabels.meta.getAxisKeys())
+            shape = self.BigLabels.meta.shape
+            block_shape = self.BlockShape3dDict.value
+            self._block_shape = tuple(min(block_shape[k], n) for k, n in zip('xyz', shape[1:4]))
+        with self._lock:
+            self._luts = dict()
+            self._generation += 1
+
     def execute(self, slot, subindex, roi, result):
         assert slot == self.Output
+        if self.BlockShape3dDict.ready():
+            return self._executeBlockwise(roi, result)
 
         # This operator is typically used with very big rois, so be extremely memory-conscious:
         # - Don't request the small and big inputs in parallel.
         # - Clean finished requests immediately (don't wait for this function to exit)
-        # - Delete intermediate results as soon as possible.
-
-        if logger.isEnabledFor(logging.DEBUG):
-            dtypeBytes = self.SmallLabels.meta.getDtypeBytes()
-            roiShape = roi.stop - roi.start
-            logger.debug("Roi shape is {} = {} MB".format(roiShape, numpy.prod(roiShape) * dtypeBytes / 1e6 ))
-            starting_memory_usage_mb = getMemoryUsageMb()
-            logger.debug("Starting with memory usage: {} MB".format(starting_memory_usage_mb))
-
-        def logMemoryIncrease(msg):
-            """Log a debug message about the RAM usage compared to when this function started execution."""
-            if logger.isEnabledFor(logging.DEBUG):
-                memory_increase_mb = getMemoryUsageMb() - starting_memory_usage_mb
-                logger.debug("{}, memory increase is: {} MB".format(msg, memory_increase_mb))
+        # - Don't create any intermediate volumes besides the mask of the small labels.
 
         smallLabelsReq = self.SmallLabels(roi.start, roi.stop)
-        smallLabels = smallLabelsReq.wait()
+        smallNonZero = smallLabelsReq.wait() != 0
         smallLabelsReq.clean()
-        logMemoryIncrease("After obtaining small labels")
 
-        smallNonZero = numpy.ndarray(shape=smallLabels.shape, dtype=bool)
-        smallNonZero[...] = (smallLabels != 0)
-        del smallLabels
-
-        logMemoryIncrease("Before obtaining big labels")
-        bigLabels = self.BigLabels(roi.start, roi.stop).wait()
-        logMemoryIncrease("After obtaining big labels")
-
-        prod = smallNonZero * bigLabels
+        bigLabelsReq = self.BigLabels(roi.start, roi.stop)
+        bigLabels = numpy.asarray(bigLabelsReq.wait())
+        bigLabelsReq.clean()
 
+        # count how many voxels of each big label overlap a small label,
+        # the labels with any overlap pass (0 is not a valid label)
+        overlap = numpy.bincount(bigLabels[smallNonZero].ravel(),
+                                 minlength=int(bigLabels.max())+1)
         del smallNonZero
+        passed = overlap > 0
+        passed[0] = False
 
-        # get labels that passed the masking
-        passed = numpy.unique(prod)
-        # 0 is not a valid label
-        passed = numpy.setdiff1d(passed, (0,))
-
-        logMemoryIncrease("After taking product")
-        del prod
+        # map the passed labels to consecutive new ones, all others to zero
+        lut = numpy.cumsum(passed, dtype=numpy.uint32)
+        lut[~passed] = 0
+        result[:] = lut[bigLabels]
+        return result
 
-        all_label_values = numpy.zeros((bigLabels.max()+1,),
-                                       dtype=numpy.uint32)
+    def _executeBlockwise(self, roi, result):
+        def selectSlice(t, c, resView):
+            lut = self._getLut(t, c)
+            start = (t,) + tuple(roi.start[1:4]) + (c,)
+            stop = (t+1,) + tuple(roi.stop[1:4]) + (c+1,)
+            bigLabels = numpy.asarray(self.BigLabels(start, stop).wait())
+            resView[:] = lut.take(bigLabels, mode='clip')
 
-        for i, l in enumerate(passed):
-            all_label_values[l] = i+1
-        all_label_values[0] = 0
+        pool = RequestPool()
+        for t in range(roi.start[0], roi.stop[0]):
+            for c in range(roi.start[4], roi.stop[4]):
+                resView = result[t-roi.start[0]:t-roi.start[0]+1, ..., c-roi.start[4]:c-roi.start[4]+1]
+                pool.add(Request(partial(selectSlice, t, c, resView)))
+        pool.wait()
+        pool.clean()
+        return result
 
-        # tricky: map the old labels to the new ones, labels that didnt pass 
-        # are mapped to zero
-        result[:] = all_label_values[bigLabels]
+    def _getLut(self, t, c):
+        """
+        Maps the big labels of time slice t and channel c that overlap a small
+        label to themselves and all others to 0, computed on first use.
+        The last entry is 0 for labels that were not seen (see _executeBlockwise()).
+        """
+        with self._lock:
+            sliceLock = self._sliceLocks[(t, c)]
+        with sliceLock:
+            with self._lock:
+                lut = self._luts.get((t, c))
+                generation = (self._generation, self._sliceGenerations[(t, c)])
+            if lut is None:
+                lut = self._computeLut(t, c)
+                with self._lock:
+                    if generation == (self._generation, self._sliceGenerations[(t, c)]):
+                        self._luts[(t, c)] = lut
+            return lut
+
+    def _computeLut(self, t, c):
+        shape = self.BigLabels.meta.shape[1:4]
+        block_starts = map(tuple, getIntersectingBlocks(self._block_shape, ((0, 0, 0), shape)))
+        passed = []
+        maxLabels = [0]
+
+        def selectBlocks(starts):
+            for block_start in starts:
+                block_stop = numpy.minimum(numpy.add(block_start, self._block_shape), shape)
+                start = (t,) + tuple(block_start) + (c,)
+                stop = (t+1,) + tuple(block_stop) + (c+1,)
+                smallNonZero = self.SmallLabels(start, stop).wait() != 0
+                bigLabels = numpy.asarray(self.BigLabels(start, stop).wait())
+                passed.append(numpy.unique(bigLabels[smallNonZero]))
+                maxLabels.append(int(bigLabels.max()))
+
+        # Each request handles every nparallel-th block, so no more
+        # than nparallel blocks are held in memory at once.
+        nparallel = min(len(block_starts), max(1, Request.global_thread_pool.num_workers))
+        pool = RequestPool()
+        for i in range(nparallel):
+            pool.add(Request(partial(selectBlocks, block_starts[i::nparallel])))
+        pool.wait()
+        pool.clean()
 
-        logMemoryIncrease("Just before return")
-        return result
+        lut = numpy.zeros((max(maxLabels)+2,), dtype=numpy.uint32)
+        for labels in passed:
+            lut[labels] = labels
+        lut[0] = 0
+        return lut
 
     def propagateDirty(self, slot, subindex, roi):
-        if slot == self.SmallLabels or slot == self.BigLabels:
+        if (slot == self.SmallLabels or slot == self.BigLabels) and self.BlockShape3dDict.ready():
+            # the selection of the dirty time slices and channels may change anywhere
+            with self._lock:
+                for t in range(roi.start[0], roi.stop[0]):
+                    for c in range(roi.start[4], roi.stop[4]):
+                        self._luts.pop((t, c), None)
+                        self._sliceGenerations[(t, c)] += 1
+            shape = self.Output.meta.shape
+            start = (roi.start[0], 0, 0, 0, roi.start[4])
+            stop = (roi.stop[0],) + tuple(shape[1:4]) + (roi.stop[4],)
+            self.Output.setDirty(start, stop)
+        elif slot == self.SmallLabels or slot == self.BigLabels or slot == self.BlockShape3dDict:
+            with self._lock:
+                self._luts = dict()
+                self._generation += 1
             self.Output.setDirty(slice(None))
         else:
             assert False, "Unknown input slot: {}".format(slot.name)
@@ -302,6 +394,11 @@ class OpThresholdTwoLevels(Operator):
     Channel = InputSlot(value=0)
     CurOperator = InputSlot(stype='int', value=0)
 
+    # Label the connected components block by block instead of
+    # a whole time slice at once (see OpBlockwiseLabelVolume)
+    BlockwiseLabeling = InputSlot(stype='bool', value=False)
+    LabelingBlockShape3dDict = InputSlot(value={'x': 256, 'y': 256, 'z': 256})
+
     Output = OutputSlot()
 
     CachedOutput = OutputSlot()  # For the GUI (blockwise-access)
@@ -348,23 +445,32 @@ class OpThresholdTwoLevels(Operator):
         self._smoothStacker.AxisFlag.setValue('t')
         self._smoothStacker.Images.connect(self._opSmoother.Output)
 
+        # cache the smoothed image, it doesn't depend on the thresholds
+        self._opSmoothedCache = OpCompressedCache(parent=self)
+        self._opSmoothedCache.name = "OpThresholdTwoLevels._opSmoothedCache"
+        self._opSmoothedCache.Input.connect(self._smoothStacker.Output)
+
         # debug output
-        self.Smoothed.connect(self._smoothStacker.Output)
+        self.Smoothed.connect(self._opSmoothedCache.Output)
 
         # single threshold operator
         self.opThreshold1 = _OpThresholdOneLevel(parent=self)
-        self.opThreshold1.InputImage.connect(self._smoothStacker.Output)
+        self.opThreshold1.InputImage.connect(self._opSmoothedCache.Output)
         self.opThreshold1.Threshold.connect(self.SingleThreshold)
         self.opThreshold1.MinSize.connect(self.MinSize)
         self.opThreshold1.MaxSize.connect(self.MaxSize)
+        self.opThreshold1.BlockwiseLabeling.connect(self.BlockwiseLabeling)
+        self.opThreshold1.LabelingBlockShape3dDict.connect(self.LabelingBlockShape3dDict)
 
         # double threshold operator
         self.opThreshold2 = _OpThresholdTwoLevels(parent=self)
-        self.opThreshold2.InputImage.connect(self._smoothStacker.Output)
+        self.opThreshold2.InputImage.connect(self._opSmoothedCache.Output)
         self.opThreshold2.MinSize.connect(self.MinSize)
         self.opThreshold2.MaxSize.connect(self.MaxSize)
         self.opThreshold2.LowThreshold.connect(self.LowThreshold)
         self.opThreshold2.HighThreshold.connect(self.HighThreshold)
+        self.opThreshold2.BlockwiseLabeling.connect(self.BlockwiseLabeling)
+        self.opThreshold2.LabelingBlockShape3dDict.connect(self.LabelingBlockShape3dDict)
 
         # HACK: For backwards compatibility with old projects, 
         #       the cache must by in xyzct order,
@@ -402,12 +508,26 @@ class OpThresholdTwoLevels(Operator):
         t_index = self.InputImage.meta.axistags.index('t')
         self._smoothStacker.AxisIndex.setValue(t_index)
         self._inputStacker.AxisIndex.setValue(t_index)
+
+        # Blockshape is the entire block, except only 1 time slice.
+        # The smoothed image has a single channel, and the axes of the
+        # time slices with t inserted at t_index (see _smoothStacker).
+        tagged_shape = self._opReorder1.Output.meta.getTaggedShape()
+        tagged_shape['t'] = 1
+        tagged_shape['c'] = 1
+        smoothed_axes = list('xyzc')
+        smoothed_axes.insert(t_index, 't')
+        self._opSmoothedCache.BlockShape.setValue(tuple(tagged_shape[k] for k in smoothed_axes))
         self._opReorder2.AxisOrder.setValue("".join(self.InputImage.meta.getAxisKeys()))
 
         # propagate drange
         self.opThreshold1.InputImage.meta.drange = self.InputImage.meta.drange
         self.opThreshold2.InputImage.meta.drange = self.InputImage.meta.drange
 
+        blockShape3dDict = None
+        if self.BlockwiseLabeling.value:
+            blockShape3dDict = self.LabelingBlockShape3dDict.value
+
         curIndex = self.CurOperator.value
         if curIndex == 0:
             # disconnect all operators that are not needed for SingleThreshold
@@ -421,9 +541,9 @@ class OpThresholdTwoLevels(Operator):
 
             # connect the operators for SingleThreshold
             self._opReorder2.Input.connect(self.opThreshold1.Output)
-            # Blockshape is the entire block, except only 1 time slice
-            tagged_shape = self.opThreshold1.Output.meta.getTaggedShape()
-            tagged_shape['t'] = 1
+            # Blockshape is the entire block (or the labeling block), except only 1 time slice
+            tagged_shape = _labelCacheBlockShape(self.opThreshold1.Output.meta.getTaggedShape(),
+                                                 blockShape3dDict)
             
             # Blockshape must correspond to cache input order
             blockshape = map( lambda k: tagged_shape[k], 'xyzct' )
@@ -448,9 +568,9 @@ class OpThresholdTwoLevels(Operator):
 
             # connect the operators for TwoLevelThreshold
             self._opReorder2.Input.connect(self.opThreshold2.Output)
-            # Blockshape is the entire block, except only 1 time slice
-            tagged_shape = self.opThreshold2.Output.meta.getTaggedShape()
-            tagged_shape['t'] = 1
+            # Blockshape is the entire block (or the labeling block), except only 1 time slice
+            tagged_shape = _labelCacheBlockShape(self.opThreshold2.Output.meta.getTaggedShape(),
+                                                 blockShape3dDict)
 
             # Blockshape must correspond to cache input order
             blockshape = map( lambda k: tagged_shape[k], 'xyzct' )
@@ -493,6 +613,8 @@ class _OpThresholdOneLevel(Operator):
     MinSize = InputSlot(stype='int', value=0)
     MaxSize = InputSlot(stype='int', value=1000000)
     Threshold = InputSlot(stype='float', value=0.5)
+    BlockwiseLabeling = InputSlot(stype='bool', value=False)
+    LabelingBlockShape3dDict = InputSlot(value={'x': 256, 'y': 256, 'z': 256})
 
     Output = OutputSlot()
 
@@ -508,10 +630,11 @@ class _OpThresholdOneLevel(Operator):
         self._opLabeler = OpLabelVolume( parent=self )
         self._opLabeler.Input.connect(self._opThresholder.Output)
 
-        self.BeforeSizeFilter.connect( self._opLabeler.CachedOutput )
+        self._opBlockwiseLabeler = OpBlockwiseLabelVolume( parent=self )
+        self._opBlockwiseLabeler.BlockShape3dDict.connect(self.LabelingBlockShape3dDict)
 
+        # The labeler is chosen (and connected) in setupOutputs()
         self._opFilter = _OpFilterLabels5d( parent=self )
-        self._opFilter.Input.connect(self._opLabeler.CachedOutput )
         self._opFilter.MinLabelSize.connect( self.MinSize )
         self._opFilter.MaxLabelSize.connect( self.MaxSize )
         self._opFilter.BinaryOut.setValue(False)
@@ -535,6 +658,20 @@ class _OpThresholdOneLevel(Operator):
 
         self._opThresholder.Function.setValue(
             partial(thresholdToUint8, self.Threshold.value))
+
+        blockwiseLabeling = self.BlockwiseLabeling.value
+        _connectIf(blockwiseLabeling, self._opBlockwiseLabeler.Input, self._opThresholder.Output)
+
+        if blockwiseLabeling:
+            labels = self._opBlockwiseLabeler.CachedOutput
+        else:
+            labels = self._opLabeler.CachedOutput
+        if self._opFilter.Input.partner != labels:
+            self._opFilter.Input.connect(labels)
+            self.BeforeSizeFilter.connect(labels)
+        # the blockwise labeler knows the sizes of its objects
+        _connectIf(blockwiseLabeling, self._opFilter.ComponentSizes, self._opBlockwiseLabeler.ComponentSizes)
+
         # Copy the input metadata to the output
         self.Output.meta.assignFrom(self.InputImage.meta)
         self.Output.meta.dtype=numpy.uint32
@@ -563,6 +700,8 @@ class _OpThresholdTwoLevels(Operator):
     MaxSize = InputSlot(stype='int', value=1000000)
     HighThreshold = InputSlot(stype='float', value=0.5)
     LowThreshold = InputSlot(stype='float', value=0.2)
+    BlockwiseLabeling = InputSlot(stype='bool', value=False)
+    LabelingBlockShape3dDict = InputSlot(value={'x': 256, 'y': 256, 'z': 256})
 
     Output = OutputSlot()
     CachedOutput = OutputSlot()  # For the GUI (blockwise-access)
@@ -604,15 +743,20 @@ class _OpThresholdTwoLevels(Operator):
         self._opHighLabeler = OpLabelVolume(parent=self)
         self._opHighLabeler.Input.connect(self._opHighThresholder.Output)
 
+        self._opLowBlockwiseLabeler = OpBlockwiseLabelVolume(parent=self)
+        self._opLowBlockwiseLabeler.BlockShape3dDict.connect(self.LabelingBlockShape3dDict)
+
+        self._opHighBlockwiseLabeler = OpBlockwiseLabelVolume(parent=self)
+        self._opHighBlockwiseLabeler.BlockShape3dDict.connect(self.LabelingBlockShape3dDict)
+
+        # The labelers are chosen (and connected) in setupOutputs()
         self._opHighLabelSizeFilter = _OpFilterLabels5d(parent=self)
-        self._opHighLabelSizeFilter.Input.connect(self._opHighLabeler.CachedOutput)
         self._opHighLabelSizeFilter.MinLabelSize.connect(self.MinSize)
         self._opHighLabelSizeFilter.MaxLabelSize.connect(self.MaxSize)
         self._opHighLabelSizeFilter.BinaryOut.setValue(False)  # we do the binarization in opSelectLabels
                                                                # this way, we get to display pretty colors
 
         self._opSelectLabels = OpSelectLabels( parent=self )        
-        self._opSelectLabels.BigLabels.connect( self._opLowLabeler.CachedOutput )
         self._opSelectLabels.SmallLabels.connect( self._opHighLabelSizeFilter.Output )
 
         #remove the remaining very large objects - 
@@ -677,13 +821,38 @@ class _OpThresholdTwoLevels(Operator):
         self._opHighThresholder.Function.setValue(
             partial(thresholdToUint8, self.HighThreshold.value))
 
+        blockwiseLabeling = self.BlockwiseLabeling.value
+        _connectIf(blockwiseLabeling, self._opLowBlockwiseLabeler.Input, self._opLowThresholder.Output)
+        _connectIf(blockwiseLabeling, self._opHighBlockwiseLabeler.Input, self._opHighThresholder.Output)
+
+        if blockwiseLabeling:
+            lowLabels = self._opLowBlockwiseLabeler.CachedOutput
+            highLabels = self._opHighBlockwiseLabeler.CachedOutput
+        else:
+            lowLabels = self._opLowLabeler.CachedOutput
+            highLabels = self._opHighLabeler.CachedOutput
+        if self._opSelectLabels.BigLabels.partner != lowLabels:
+            self._opSelectLabels.BigLabels.connect(lowLabels)
+        if self._opHighLabelSizeFilter.Input.partner != highLabels:
+            self._opHighLabelSizeFilter.Input.connect(highLabels)
+
+        # With blockwise labeling, the labels are selected block by block and
+        # keep the ids of the low labels, so the labelers know all object sizes.
+        _connectIf(blockwiseLabeling, self._opSelectLabels.BlockShape3dDict, self.LabelingBlockShape3dDict)
+        _connectIf(blockwiseLabeling, self._opHighLabelSizeFilter.ComponentSizes,
+                   self._opHighBlockwiseLabeler.ComponentSizes)
+        _connectIf(blockwiseLabeling, self._opFinalLabelSizeFilter.ComponentSizes,
+                   self._opLowBlockwiseLabeler.ComponentSizes)
+
         # Copy the input metadata to the output
         self.Output.meta.assignFrom(self.InputImage.meta)
         self.Output.meta.dtype = numpy.uint32
 
-        # Blockshape is the entire block, except only 1 time slice
-        tagged_shape = self.Output.meta.getTaggedShape()
-        tagged_shape['t'] = 1
+        # Blockshape is the entire block (or the labeling block), except only 1 time slice
+        blockShape3dDict = None
+        if blockwiseLabeling:
+            blockShape3dDict = self.LabelingBlockShape3dDict.value
+        tagged_shape = _labelCacheBlockShape(self.Output.meta.getTaggedShape(), blockShape3dDict)
         self._opCache.BlockShape.setValue(
             tuple(tagged_shape.values()))
         self._opBigRegionCache.BlockShape.setValue(
@@ -707,9 +876,15 @@ class _OpThresholdTwoLevels(Operator):
         #  so all calls to __setitem__ are forwarded automatically
 
 
-## wrapper for OpFilterLabels
-# Wraps OpFilterLabels in time and channel dimension beacuse we want to filer
-# objects by size only in spatial dimensions.
+## size filter for labels
+# Filters objects by size only in spatial dimensions, for each time/channel
+# slice separately.
+#
+# The component sizes (a histogram of the labels) of each time/channel slice
+# are cached until the slice becomes dirty, so changing the size bounds only
+# applies a new lookup table to the labels.  If ComponentSizes is connected
+# (see OpBlockwiseLabelVolume), the sizes are taken from there instead of
+# counting the labels of the whole slice.
 # Spawns a new request for each time/channel slice
 class _OpFilterLabels5d(Operator):
     name = "OpFilterLabels5d"
@@ -721,6 +896,7 @@ class _OpFilterLabels5d(Operator):
     MinLabelSize = InputSlot(stype='int')
     MaxLabelSize = InputSlot(optional=True, stype='int')
     BinaryOut = InputSlot(optional=True, value=False, stype='bool')
+    ComponentSizes = InputSlot(optional=True)  # shape (t, c)
 
     _ReorderedOutput = OutputSlot()
     Output = OutputSlot()
@@ -732,17 +908,17 @@ class _OpFilterLabels5d(Operator):
         self._reorder1.AxisOrder.setValue('txyzc')
         self._reorder1.Input.connect(self.Input)
 
-        self._op = OpFilterLabels(parent=self)
-        self._op.Input.connect(self._reorder1.Output)
-        #self._op.Input.connect(self.Input)
-        self._op.MinLabelSize.connect(self.MinLabelSize)
-        self._op.MaxLabelSize.connect(self.MaxLabelSize)
-        self._op.BinaryOut.connect(self.BinaryOut)
-
         self._reorder2 = OpReorderAxes(parent=self)
         self._reorder2.Input.connect(self._ReorderedOutput)
         self.Output.connect(self._reorder2.Output)
-        #self.Output.connect(self._)
+
+        self._sizes = dict()  # (t, c) -> component sizes
+        self._lock = RequestLock()
+        self._sliceLocks = collections.defaultdict(RequestLock)
+        # incremented whenever (a slice of) self._sizes is cleared, so that
+        # sizes counted before are not stored, see _getSizes()
+        self._generation = 0
+        self._sliceGenerations = collections.defaultdict(int)
 
     def setupOutputs(self):
         assert len(self._reorder1.Output.meta.shape) == 5
@@ -751,33 +927,88 @@ class _OpFilterLabels5d(Operator):
         order = "".join(self.Input.meta.getAxisKeys())
         self._reorder2.AxisOrder.setValue(order)
 
+        with self._lock:
+            self._sizes = dict()
+            self._generation += 1
+
     def execute(self, slot, subindex, roi, result):
         assert slot == self._ReorderedOutput
-        pool = RequestPool()
+        minSize = self.MinLabelSize.value
+        maxSize = None
+        if self.MaxLabelSize.ready():
+            maxSize = self.MaxLabelSize.value
+        binaryOut = self.BinaryOut.value
+
+        # shortcut: no component can be too small or too large
+        sliceSize = numpy.prod(self._reorder1.Output.meta.shape[1:4])
+        keepAll = minSize <= 0 and (maxSize is None or maxSize >= sliceSize)
+
+        def filterSlice(t, c, resView):
+            start = (t,) + tuple(roi.start[1:4]) + (c,)
+            stop = (t+1,) + tuple(roi.stop[1:4]) + (c+1,)
+            labels = numpy.asarray(self._reorder1.Output(start, stop).wait())
+            if keepAll:
+                lut = None
+            else:
+                lut = self._sizeFilterLut(self._getSizes(t, c), minSize, maxSize)
+            if binaryOut:
+                if lut is None:
+                    resView[:] = labels != 0
+                else:
+                    resView[:] = lut.take(labels, mode='clip') != 0
+            elif lut is None:
+                resView[:] = labels
+            else:
+                resView[:] = lut.take(labels, mode='clip')
 
-        t_ind = 0
-        for t in range(roi.start[0], roi.stop[0]):
-            c_ind = 0
-            for c in range(roi.start[-1], roi.stop[-1]):
-                newroi = roi.copy()
-                newroi.start[0] = t
-                newroi.stop[0] = t+1
-                newroi.start[-1] = c
-                newroi.stop[-1] = c+1
-
-                req = self._op.Output.get(newroi)
+        pool = RequestPool()
+        for t_ind, t in enumerate(range(roi.start[0], roi.stop[0])):
+            for c_ind, c in enumerate(range(roi.start[-1], roi.stop[-1])):
                 resView = result[t_ind:t_ind+1, ..., c_ind:c_ind+1]
-                req.writeInto(resView)
-
-                pool.add(req)
-
-                c_ind += 1
-
-            t_ind += 1
-
+                pool.add(Request(partial(filterSlice, t, c, resView)))
         pool.wait()
         pool.clean()
 
+    @staticmethod
+    def _sizeFilterLut(sizes, minSize, maxSize):
+        """
+        Maps each label to itself if its size is within the bounds, to 0 otherwise.
+        The last entry is 0 for the labels that were not counted (see execute()).
+        """
+        good = sizes >= minSize
+        if maxSize is not None:
+            numpy.logical_and(good, sizes <= maxSize, out=good)
+        good[0] = False
+        lut = numpy.zeros((len(sizes) + 1,), dtype=numpy.uint32)
+        lut[:len(sizes)][good] = numpy.nonzero(good)[0]
+        return lut
+
+    def _getSizes(self, t, c):
+        """
+        The sizes of all components of time slice t and channel c (index 0 is the
+        background), counted on the whole slice on first use.
+        """
+        if self.ComponentSizes.ready():
+            return self.ComponentSizes[t:t+1, c:c+1].wait()[0, 0]
+
+        with self._lock:
+            sliceLock = self._sliceLocks[(t, c)]
+        with sliceLock:
+            with self._lock:
+                sizes = self._sizes.get((t, c))
+                generation = (self._generation, self._sliceGenerations[(t, c)])
+            if sizes is None:
+                shape = self._reorder1.Output.meta.shape
+                start = (t, 0, 0, 0, c)
+                stop = (t+1,) + tuple(shape[1:4]) + (c+1,)
+                labels = self._reorder1.Output(start, stop).wait()
+                sizes = numpy.bincount(numpy.asarray(labels).ravel())
+                del labels
+                with self._lock:
+                    if generation == (self._generation, self._sliceGenerations[(t, c)]):
+                        self._sizes[(t, c)] = sizes
+            return sizes
+
     def propagateDirty(self, slot, subindex, roi):
         inStop = numpy.asarray(self.Input.meta.shape)
         inStart = inStop*0
@@ -789,6 +1020,18 @@ class _OpFilterLabels5d(Operator):
             inStop[t_ind] = roi.stop[t_ind]
             inStart[c_ind] = roi.start[c_ind]
             inStop[c_ind] = roi.stop[c_ind]
+            with self._lock:
+                for t in range(roi.start[t_ind], roi.stop[t_ind]):
+                    for c in range(roi.start[c_ind], roi.stop[c_ind]):
+                        self._sizes.pop((t, c), None)
+                        self._sliceGenerations[(t, c)] += 1
+        elif slot == self.ComponentSizes:
+            t_ind = self.Input.meta.axistags.index('t')
+            c_ind = self.Input.meta.axistags.index('c')
+            inStart[t_ind] = roi.start[0]
+            inStop[t_ind] = roi.stop[0]
+            inStart[c_ind] = roi.start[1]
+            inStop[c_ind] = roi.stop[1]
         elif slot == self.MinLabelSize or slot == self.MaxLabelSize\
                 or slot == self.BinaryOut:
             # changes in the size affect the entire volume including all time
@@ -40,7 +40,9 @@ class ThresholdTwoLevelsApplet( StandardApplet ):
                  'SmootherSigma',
                  'CurOperator',
                  'SingleThreshold',
-                 'Channel' ]
+                 'Channel',
+                 'BlockwiseLabeling',
+                 'LabelingBlockShape3dDict' ]
     
     @property
     def singleLaneGuiClass(self):
@@ -26,6 +26,8 @@ class ThresholdTwoLevelsSerializer(AppletSerializer):
                  SerialSlot(operator.SingleThreshold, selfdepends=True),
                  SerialDictSlot(operator.SmootherSigma, selfdepends=True),
                  SerialSlot(operator.Channel, selfdepends=True),
+                 SerialSlot(operator.BlockwiseLabeling, selfdepends=True),
+                 SerialDictSlot(operator.LabelingBlockShape3dDict, selfdepends=True),
                  SerialHdf5BlockSlot(operator.OutputHdf5,
                                      operator.InputHdf5,
                                      operator.CleanBlocks,
@@ -14,15 +14,22 @@
 #
 # Copyright 2011-2014, the ilastik developers
 
+import ilastik
 from ilastik.config import cfg
 
 from yapsy.IPlugin import IPlugin
 from yapsy.PluginManager import PluginManager
 
 import os
+import json
+import threading
 from collections import namedtuple
 from functools import partial
 import numpy
+import vigra
+
+import logging
+logger = logging.getLogger(__name__)
 
 # these directories are searched for plugins
 plugin_paths = cfg.get('ilastik', 'plugin_directories')
@@ -89,6 +96,44 @@ class ObjectFeaturesPlugin(IPlugin):
         """
         return dict()
 
+    def compute_local_batch(self, images, binary_bboxes, features, axes):
+        """Calculate features on several objects at once.
+
+        OpRegionFeatures3d always calls this method. The default
+        implementation calls compute_local() for each object; plugins
+        that can process many objects at once (e.g. in C++) should
+        override it to avoid the per-call overhead.
+
+        :param images: list of np.ndarray, one image[expanded bounding box] per object
+        :param binary_bboxes: list of binarize(labels[expanded bounding box]), one per object
+        :param features: which features to compute
+        :param axes: axis tags
+
+        :returns: a dictionary with one entry per feature.
+            dict[feature_name] is a numpy.ndarray with ndim=2 and
+            shape[0] == number of objects, or None if the rows of the
+            objects have different lengths (the feature is then left out
+            with a warning, like a failed feature of compute_local()).
+
+        A feature that is computed for some of the objects only is an
+        error, as it was when compute_local() was called per object.
+
+        """
+        results = [self.compute_local(image, binary_bbox, features, axes)
+                   for image, binary_bbox in zip(images, binary_bboxes)]
+        keys = set(sum((r.keys() for r in results), []))
+        result = dict()
+        for key in keys:
+            missing = sum(1 for r in results if key not in r)
+            if missing > 0:
+                raise Exception('feature {} was not computed for {} of {} objects'.format(
+                    key, missing, len(results)))
+            try:
+                result[key] = numpy.vstack([numpy.asarray(r[key]).reshape(1, -1) for r in results])
+            except ValueError:
+                result[key] = None
+        return result
+
     @staticmethod
     def combine_dicts(ds):
         return dict(sum((d.items() for d in ds), []))
@@ -134,13 +179,156 @@ class ObjectFeaturesPlugin(IPlugin):
 # the manager #
 ###############
 
-pluginManager = PluginManager()
-pluginManager.setPluginPlaces(plugin_paths)
-
-pluginManager.setCategoriesFilter({
+plugin_categories = {
    "ObjectFeatures" : ObjectFeaturesPlugin,
-   })
-
-pluginManager.collectPlugins()
-for pluginInfo in pluginManager.getAllPlugins():
-    pluginManager.activatePluginByName(pluginInfo.name)
+   }
+
+class LazyPluginManager(object):
+    """A yapsy PluginManager that only collects and activates the
+    plugins when it is used for the first time, so that importing this
+    module does not import every plugin.
+
+    All attribute access is forwarded to the PluginManager.
+
+    """
+    def __init__(self, paths, categories):
+        self._paths = paths
+        self._categories = categories
+        self._manager = None
+        self._lock = threading.Lock()
+
+    def _getManager(self):
+        with self._lock:
+            if self._manager is None:
+                manager = PluginManager()
+                manager.setPluginPlaces(self._paths)
+                manager.setCategoriesFilter(self._categories)
+                manager.collectPlugins()
+                for pluginInfo in manager.getAllPlugins():
+                    manager.activatePluginByName(pluginInfo.name)
+                self._manager = manager
+            return self._manager
+
+    def __getattr__(self, name):
+        return getattr(self._getManager(), name)
+
+pluginManager = LazyPluginManager(plugin_paths, plugin_categories)
+
+
+###########################
+# object feature catalogs #
+###########################
+
+# catalogs of the available object features, see objectFeatureCatalogs()
+feature_catalog_cache = os.path.expanduser(os.path.join('~', '.ilastik', 'object_feature_catalogs.json'))
+
+def _pluginModificationTimes():
+    """Find the plugins without importing them.
+
+    :returns: dict[plugin name] = last modification time of the
+        plugin's info file and module
+
+    """
+    locator = PluginManager()
+    locator.setPluginPlaces(plugin_paths)
+    locator.locatePlugins()
+    result = {}
+    for infofile, path, pluginInfo in locator.getPluginCandidates():
+        paths = [infofile, path, path + '.py']
+        result[pluginInfo.name] = max(os.path.getmtime(p) for p in paths if os.path.exists(p))
+    return result
+
+def _imageSignature(image, labels):
+    """What availableFeatures() may depend on: axes, channels and dtypes."""
+    try:
+        axes = "".join(image.axistags.keys())
+        nchannels = image.shape[image.axistags.index('c')] if 'c' in axes else 1
+    except AttributeError:
+        axes = str(image.ndim)
+        nchannels = 1
+    return "{} c={} {} {}".format(axes, nchannels, image.dtype, labels.dtype)
+
+def _versions():
+    """The catalogs may also change with the versions of ilastik and vigra."""
+    return "ilastik {} vigra {}".format(ilastik.__version__, vigra.version)
+
+def _asStr(value):
+    """json returns unicode, but feature names are passed on as str."""
+    if isinstance(value, dict):
+        return dict((_asStr(k), _asStr(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [_asStr(v) for v in value]
+    if isinstance(value, unicode):
+        return str(value)
+    return value
+
+def _loadCatalogs():
+    try:
+        with open(feature_catalog_cache) as f:
+            return _asStr(json.load(f))
+    except (IOError, ValueError):
+        return {}
+
+def _saveCatalogs(catalogs):
+    try:
+        directory = os.path.dirname(feature_catalog_cache)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(feature_catalog_cache, 'w') as f:
+            json.dump(catalogs, f)
+    except (IOError, OSError, TypeError, ValueError) as e:
+        logger.warn("could not save the object feature catalogs: {}".format(e))
+
+def objectFeatureCatalogs(image, labels):
+    """Returns dict[plugin name] = plugin.availableFeatures(image, labels)
+    for all object feature plugins.
+
+    The catalogs are cached on disk and reused as long as the plugin
+    files have not been modified and ilastik and vigra have the same
+    versions, so the plugins are only imported and probed if a catalog
+    is missing or out of date.  Plugins that could not be imported are
+    remembered as well, and not imported again until they change.
+
+    """
+    versions = _versions()
+    signature = "{} {}".format(versions, _imageSignature(image, labels))
+    mtimes = _pluginModificationTimes()
+    cache = _loadCatalogs()
+
+    def cachedEntry(name):
+        entry = cache.get(name, {})
+        if entry.get('mtime') != mtimes[name]:
+            entry = {'mtime': mtimes[name], 'catalogs': {}}
+        return entry
+
+    result = {}
+    missing = []
+    for name in mtimes:
+        entry = cachedEntry(name)
+        if signature in entry['catalogs']:
+            result[name] = entry['catalogs'][signature]
+        elif entry.get('failed') != versions:
+            missing.append(name)
+
+    if len(missing) > 0:
+        plugins = pluginManager.getPluginsOfCategory('ObjectFeatures')
+        for pluginInfo in plugins:
+            if pluginInfo.name not in missing:
+                continue
+            catalog = pluginInfo.plugin_object.availableFeatures(image, labels)
+            result[pluginInfo.name] = catalog
+
+            entry = cachedEntry(pluginInfo.name)
+            entry['catalogs'][signature] = catalog
+            entry.pop('failed', None)
+            cache[pluginInfo.name] = entry
+
+        # the plugins that were found, but not loaded
+        for name in set(missing) - set(p.name for p in plugins):
+            logger.warn("object feature plugin '{}' could not be loaded".format(name))
+            entry = cachedEntry(name)
+            entry['failed'] = versions
+            cache[name] = entry
+        _saveCatalogs(cache)
+
+    return result
@@ -14,6 +14,7 @@
 #
 # Copyright 2011-2014, the ilastik developers
 
+import os
 import warnings
 import argparse
 
@@ -27,9 +28,11 @@ from ilastik.applets.pixelClassification.opPixelClassification import OpPredicti
 from ilastik.applets.thresholdTwoLevels import ThresholdTwoLevelsApplet, OpThresholdTwoLevels
 from ilastik.applets.objectExtraction import ObjectExtractionApplet
 from ilastik.applets.objectClassification import ObjectClassificationApplet, ObjectClassificationDataExportApplet
+from ilastik.applets.objectClassification.objectTableExport import exportObjectTable
 from ilastik.applets.fillMissingSlices import FillMissingSlicesApplet
 from ilastik.applets.fillMissingSlices.opFillMissingSlices import OpFillMissingSlicesNoCache
 from ilastik.applets.blockwiseObjectClassification import BlockwiseObjectClassificationApplet, OpBlockwiseObjectClassification
+from ilastik.applets.blockwiseObjectClassification.opBlockwiseFilesetExport import OpBlockwiseFilesetExport
 
 from lazyflow.graph import Graph, OperatorWrapper
 from lazyflow.operators.opReorderAxes import OpReorderAxes
@@ -58,6 +61,14 @@ class ObjectClassificationWorkflow(Workflow):
         parser.add_argument('--fillmissing', help="use 'fill missing' applet with chosen detection method", choices=['classic', 'svm', 'none'], default='none')
         parser.add_argument('--filter', help="pixel feature filter implementation.", choices=['Original', 'Refactored', 'Interpolated'], default='Original')
         parser.add_argument('--nobatch', help="do not append batch applets", action='store_true', default=False)
+        parser.add_argument('--export_object_table', help="headless: export one row per object (features and predictions) "
+                            "of each input image to this hdf5 or .csv file", default=None)
+        parser.add_argument('--blockwise_fileset_predictions', help="headless: export the blockwise object predictions "
+                            "to the blockwise fileset with this description file (resumes an interrupted export)", default=None)
+        parser.add_argument('--blockwise_fileset_labels', help="headless: export the object labels of each block "
+                            "to the blockwise fileset with this description file", default=None)
+        parser.add_argument('--blockwise_fileset_task', help="headless: export only the blocks of task INDEX/COUNT "
+                            "to the blockwise filesets, e.g. 2/8", default='0/1')
         
         parsed_creation_args, unused_args = parser.parse_known_args(project_creation_args)
 
@@ -72,6 +83,10 @@ class ObjectClassificationWorkflow(Workflow):
             logger.error( "Ignoring --filter cmdline arg.  Can't specify a different filter setting after the project has already been created." )
 
         self.batch = not parsed_args.nobatch
+        self.export_object_table = parsed_args.export_object_table
+        self.blockwise_fileset_predictions = parsed_args.blockwise_fileset_predictions
+        self.blockwise_fileset_labels = parsed_args.blockwise_fileset_labels
+        self.blockwise_fileset_task = map( int, parsed_args.blockwise_fileset_task.split('/') )
         
         if unused_args:
             warnings.warn("Unused command-line args: {}".format( unused_args ))
@@ -178,6 +193,7 @@ class ObjectClassificationWorkflow(Workflow):
             opBlockwiseObjectClassification.Classifier.connect(opObjClassification.Classifier)
             opBlockwiseObjectClassification.LabelsCount.connect(opObjClassification.NumLabels)
             opBlockwiseObjectClassification.SelectedFeatures.connect(opObjClassification.SelectedFeatures)
+            opBlockwiseObjectClassification.TrainingObjectExtent.connect(opObjClassification.LabeledObjectExtent)
 
     def _initBatchWorkflow(self):
         # Access applet operators from the training workflow
@@ -200,6 +216,8 @@ class ObjectClassificationWorkflow(Workflow):
             opBatchThreshold.SmootherSigma.connect(opInteractiveThreshold.SmootherSigma)
             opBatchThreshold.Channel.connect(opInteractiveThreshold.Channel)
             opBatchThreshold.CurOperator.connect(opInteractiveThreshold.CurOperator)
+            opBatchThreshold.BlockwiseLabeling.connect(opInteractiveThreshold.BlockwiseLabeling)
+            opBatchThreshold.LabelingBlockShape3dDict.connect(opInteractiveThreshold.LabelingBlockShape3dDict)
 
         # OpDataSelectionGroup.ImageGroup is indexed by [laneIndex][roleIndex],
         # but we need a slot that is indexed by [roleIndex][laneIndex]
@@ -223,6 +241,8 @@ class ObjectClassificationWorkflow(Workflow):
         opBatchClassify.SelectedFeatures.connect(opObjectTrainingTopLevel.SelectedFeatures)
         opBatchClassify.BlockShape3dDict.connect(opBlockwiseObjectClassification.BlockShape3dDict)
         opBatchClassify.HaloPadding3dDict.connect(opBlockwiseObjectClassification.HaloPadding3dDict)
+        opBatchClassify.AutoHaloPadding.connect(opBlockwiseObjectClassification.AutoHaloPadding)
+        opBatchClassify.TrainingObjectExtent.connect(opObjectTrainingTopLevel.LabeledObjectExtent)
 
         #  but image pathway is from the batch pipeline
         op5Raw = OperatorWrapper(OpReorderAxes, parent=self)
@@ -272,6 +292,83 @@ class ObjectClassificationWorkflow(Workflow):
             return [self.opBatchClassify.BlockwiseRegionFeatures]
         raise Exception("Unknown headless output slot")
 
+    def onProjectLoaded(self, projectManager):
+        """
+        Overridden from Workflow base class.  Called by the Project Manager.
+
+        In headless mode, export the object table and the blockwise filesets if requested on the command line.
+        """
+        if self._headless and self.export_object_table:
+            self._exportObjectTables(self.export_object_table)
+        if self._headless and (self.blockwise_fileset_predictions or self.blockwise_fileset_labels):
+            self._exportBlockwiseFilesets()
+
+    def _exportBlockwiseFilesets(self):
+        """
+        Export the blockwise predictions (and the labels of each block) of each input image
+        to blockwise filesets, see OpBlockwiseFilesetExport.  With several images, a separate
+        description file is expected per image, with the image index appended to the file name.
+        """
+        if not self.batch:
+            raise Exception("The blockwise fileset export is not available with --nobatch")
+        opBlockwiseObjectClassification = self.blockwiseObjectClassificationApplet.topLevelOperator
+        taskIndex, taskCount = self.blockwise_fileset_task
+
+        nlanes = len(opBlockwiseObjectClassification.PredictionImage)
+        for lane in range(nlanes):
+            opLane = opBlockwiseObjectClassification.getLane(lane)
+            slots = []
+            descriptions = []
+            for slot, path in [(opLane.PredictionImage, self.blockwise_fileset_predictions),
+                               (opLane.BlockLabelImage, self.blockwise_fileset_labels)]:
+                if not path:
+                    continue
+                if nlanes > 1:
+                    base, ext = os.path.splitext(path)
+                    path = "{}_{}{}".format(base, lane, ext)
+                slots.append(slot)
+                descriptions.append(path)
+
+            logger.info("Exporting blocks of image {} to {}".format(lane, ", ".join(descriptions)))
+            opExport = OpBlockwiseFilesetExport(parent=self)
+            try:
+                opExport.BlockShape3dDict.connect(opLane.BlockShape3dDict)
+                opExport.TaskIndex.setValue(taskIndex)
+                opExport.TaskCount.setValue(taskCount)
+                opExport.Inputs.resize(len(slots))
+                opExport.OutputDescriptions.resize(len(slots))
+                for i, (slot, path) in enumerate(zip(slots, descriptions)):
+                    opExport.Inputs[i].connect(slot)
+                    opExport.OutputDescriptions[i].setValue(path)
+                opExport.ReturnCode[:].wait()
+            finally:
+                opExport.cleanUp()
+
+    def _exportObjectTables(self, path):
+        """
+        Export the object table of each input image. With several images,
+        the image index is appended to the file name.
+        """
+        opObjClassification = self.objectClassificationApplet.topLevelOperator
+        opObjExtraction = self.objectExtractionApplet.topLevelOperator
+        selected = opObjClassification.SelectedFeatures([]).wait()
+        label_names = None
+        if opObjClassification.LabelNames.ready():
+            label_names = opObjClassification.LabelNames.value
+
+        nlanes = len(opObjClassification.Probabilities)
+        for lane in range(nlanes):
+            lane_path = path
+            if nlanes > 1:
+                base, ext = os.path.splitext(path)
+                lane_path = "{}_{}{}".format(base, lane, ext)
+            logger.info("Exporting object table of image {} to {}".format(lane, lane_path))
+            count = exportObjectTable(lane_path,
+                                      opObjExtraction.RegionFeatures[lane],
+                                      opObjClassification.Probabilities[lane],
+                                      selected, label_names)
+            logger.info("Exported {} objects".format(count))
+
     def handleAppletStateUpdateRequested(self, upstream_ready=False):
         """
         Overridden from Workflow base class
@@ -482,6 +579,8 @@ class ObjectClassificationWorkflowPixel(ObjectClassificationWorkflow):
         opBatchThreshold.SmootherSigma.connect(opInteractiveThreshold.SmootherSigma)
         opBatchThreshold.Channel.connect(opInteractiveThreshold.Channel)
         opBatchThreshold.CurOperator.connect(opInteractiveThreshold.CurOperator)
+        opBatchThreshold.BlockwiseLabeling.connect(opInteractiveThreshold.BlockwiseLabeling)
+        opBatchThreshold.LabelingBlockShape3dDict.connect(opInteractiveThreshold.LabelingBlockShape3dDict)
         
         #  Image pathway is from the batch pipeline
         op5Pred = OperatorWrapper(OpReorderAxes, parent=self)
@@ -501,6 +600,8 @@ class ObjectClassificationWorkflowPixel(ObjectClassificationWorkflow):
         opBatchObjectClassify.SelectedFeatures.connect(opObjectTrainingTopLevel.SelectedFeatures)
         opBatchObjectClassify.BlockShape3dDict.connect(opBlockwiseObjectClassification.BlockShape3dDict)
         opBatchObjectClassify.HaloPadding3dDict.connect(opBlockwiseObjectClassification.HaloPadding3dDict)        
+        opBatchObjectClassify.AutoHaloPadding.connect(opBlockwiseObjectClassification.AutoHaloPadding)
+        opBatchObjectClassify.TrainingObjectExtent.connect(opObjectTrainingTopLevel.LabeledObjectExtent)
         
         opBatchObjectClassify.RawImage.connect(op5Raw.Output)
         opBatchObjectClassify.BinaryImage.connect(op5Binary.Output)
@@ -0,0 +1,195 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.operators import OpArrayPiper
+from lazyflow.utility.io.blockwiseFileset import BlockwiseFileset
+
+from ilastik.applets.blockwiseObjectClassification.opBlockwiseFilesetExport import OpBlockwiseFilesetExport
+
+DESCRIPTION = \
+"""
+{
+    "_schema_name" : "blockwise-fileset-description",
+    "_schema_version" : 1.0,
+
+    "name" : "%s",
+    "format" : "hdf5",
+    "axes" : "txyzc",
+    "shape" : [1, 40, 40, 20, 1],
+    "dtype" : "numpy.uint8",
+    "block_shape" : [1, 100, 100, 100, 1],
+    "block_file_name_format" : "block{roiString}.h5/volume/data"
+}
+"""
+
+class TestOpBlockwiseFilesetExport(object):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.descriptions = []
+        for name in ("predictions", "labels"):
+            os.mkdir( os.path.join(self.tempDir, name) )
+            path = os.path.join(self.tempDir, name, "description.json")
+            with open(path, 'w') as f:
+                f.write( DESCRIPTION % name )
+            self.descriptions.append( path )
+
+        graph = Graph()
+        self.data = []
+        self.sources = []
+        for dtype in (numpy.uint8, numpy.uint32):
+            data = numpy.random.randint(0, 100, (1, 40, 40, 20, 1)).astype(dtype)
+            data = vigra.taggedView(data, 'txyzc')
+            opSource = OpArrayPiper(graph=graph)
+            opSource.Input.setValue( data )
+            self.data.append( data )
+            self.sources.append( opSource )
+
+        op = OpBlockwiseFilesetExport(graph=graph)
+        op.BlockShape3dDict.setValue( {'x' : 20, 'y' : 20, 'z' : 20} )
+        op.Inputs.resize(2)
+        op.OutputDescriptions.resize(2)
+        for i in range(2):
+            op.Inputs[i].connect( self.sources[i].Output )
+            op.OutputDescriptions[i].setValue( self.descriptions[i] )
+        self.op = op
+
+    def tearDown(self):
+        self.op.cleanUp()
+        shutil.rmtree(self.tempDir)
+
+    def readFileset(self, i):
+        fileset = BlockwiseFileset( self.descriptions[i], 'r' )
+        try:
+            data = numpy.zeros( (1, 40, 40, 20, 1), dtype=fileset.description.dtype )
+            fileset.readData( ((0,)*5, data.shape), data )
+            block_rois = fileset.getAllBlockRois()
+            available = [ fileset.getBlockStatus( block_roi[0] ) == BlockwiseFileset.BLOCK_AVAILABLE
+                          for block_roi in sorted( block_rois, key=lambda block_roi: tuple(block_roi[0]) ) ]
+        finally:
+            fileset.close()
+        return data, available
+
+    def testExport(self):
+        assert self.op.ReturnCode.value
+        for i in range(2):
+            data, available = self.readFileset(i)
+            assert len(available) == 4
+            assert all(available)
+            assert (data == self.data[i]).all()
+
+    def testResume(self):
+        assert self.op.ReturnCode.value
+
+        # Simulate an export that stopped before the last block
+        fileset = BlockwiseFileset( self.descriptions[0], 'a' )
+        block_rois = OpBlockwiseFilesetExport.getTaskBlockRois( fileset )
+        fileset.setBlockStatus( block_rois[-1][0], BlockwiseFileset.BLOCK_NOT_AVAILABLE )
+        fileset.close()
+
+        # Only the incomplete block is exported again
+        new_data = self.data[0] + 1
+        self.sources[0].Input.setValue( new_data )
+        assert self.op.ReturnCode.value
+
+        data, available = self.readFileset(0)
+        assert all(available)
+        last_block = roiSlicing( block_rois[-1] )
+        assert (data[last_block] == new_data[last_block]).all()
+        data[last_block] = self.data[0][last_block]
+        assert (data == self.data[0]).all()
+
+    def testTasks(self):
+        # The first of two tasks exports every other block
+        self.op.TaskIndex.setValue(0)
+        self.op.TaskCount.setValue(2)
+        assert self.op.ReturnCode.value
+        for i in range(2):
+            data, available = self.readFileset(i)
+            assert available == [True, False, True, False]
+
+        self.op.TaskIndex.setValue(1)
+        assert self.op.ReturnCode.value
+        for i in range(2):
+            data, available = self.readFileset(i)
+            assert all(available)
+            assert (data == self.data[i]).all()
+
+    def testConcurrentTasks(self):
+        # Two tasks that start at the same time must not reset each other's blocks
+        ops = [self.op, OpBlockwiseFilesetExport(graph=self.op.graph)]
+        ops[1].BlockShape3dDict.setValue( {'x' : 20, 'y' : 20, 'z' : 20} )
+        ops[1].Inputs.resize(2)
+        ops[1].OutputDescriptions.resize(2)
+        for i in range(2):
+            ops[1].Inputs[i].connect( self.sources[i].Output )
+            ops[1].OutputDescriptions[i].setValue( self.descriptions[i] )
+
+        try:
+            results = [None, None]
+            def export(taskIndex):
+                ops[taskIndex].TaskIndex.setValue(taskIndex)
+                ops[taskIndex].TaskCount.setValue(2)
+                results[taskIndex] = ops[taskIndex].ReturnCode.value
+            threads = [threading.Thread(target=export, args=(i,)) for i in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert results == [True, True]
+        finally:
+            ops[1].cleanUp()
+
+        for i in range(2):
+            data, available = self.readFileset(i)
+            assert all(available)
+            assert (data == self.data[i]).all()
+
+    def testBlockingChanged(self):
+        assert self.op.ReturnCode.value
+
+        # Blocks of the previous blocking scheme are not reused
+        self.op.BlockShape3dDict.setValue( {'x' : 40, 'y' : 40, 'z' : 20} )
+        self.op.TaskCount.setValue(2)
+        self.op.TaskIndex.setValue(1)
+        assert self.op.ReturnCode.value
+        for i in range(2):
+            fileset = BlockwiseFileset( self.descriptions[i], 'r' )
+            try:
+                block_rois = fileset.getAllBlockRois()
+                assert len(block_rois) == 1
+                assert fileset.getBlockStatus( block_rois[0][0] ) == BlockwiseFileset.BLOCK_NOT_AVAILABLE
+            finally:
+                fileset.close()
+
+def roiSlicing(roi):
+    return tuple( slice(start, stop) for start, stop in zip(*roi) )
+
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -17,17 +17,21 @@
 import sys
 import warnings
 import tempfile
+import threading
+import collections
 
 import numpy
 import vigra
 
 from lazyflow.graph import Graph
 from lazyflow.operators import Op5ifyer
+from lazyflow.request import Request
 
 from ilastik.applets import objectExtraction
 from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtraction
 from ilastik.applets.objectClassification.opObjectClassification import OpObjectClassification
 from ilastik.applets.blockwiseObjectClassification import OpBlockwiseObjectClassification
+from ilastik.applets.blockwiseObjectClassification import opBlockwiseObjectClassification as blockwiseModule
 
 import logging
 handler = logging.StreamHandler(sys.stdout)
@@ -89,6 +93,235 @@ class TestOpBlockwiseObjectClassification(object):
                 "Blockwise prediction operator did not produce the same prediction image" \
                 "as the non-blockwise prediction operator!"
 
+    def testFewPipelines(self):
+        # Only two block pipelines may be kept; the others are deleted and
+        # recreated on demand, without changing the result.
+        self.op.BlockShape3dDict.setValue( {'x' : 40, 'y' : 40, 'z' : 40} )
+        self.op.HaloPadding3dDict.setValue( {'x' : 10, 'y' : 10, 'z' : 10} )
+        self.op.MaxBlockPipelines.setValue( 2 )
+
+        pred = self.op.PredictionImage[:].wait()
+        assert len(self.op._blockPipelines) <= 2
+        assert (pred == self.prediction_volume).all(), \
+            "Blockwise prediction with evicted block pipelines differs from the non-blockwise prediction!"
+
+        pred = self.op.PredictionImage[:].wait()
+        assert len(self.op._blockPipelines) <= 2
+        assert (pred == self.prediction_volume).all()
+
+    def testStitchedObjects(self):
+        # With 42-pixel blocks, the cubes at 40..45 are cut by the block boundaries.
+        # The stitched label image must still contain each object once, like the full-volume labeling.
+        self.op.BlockShape3dDict.setValue( {'x' : 42, 'y' : 42, 'z' : 42} )
+        self.op.HaloPadding3dDict.setValue( {'x' : 35, 'y' : 35, 'z' : 30} )
+
+        labels = self.op.LabelImage[:].wait()
+        global_labels = self.objExtraction.LabelImage[:].wait()
+        assert labels.max() == global_labels.max()
+        pairs = set( zip( labels.flat, global_labels.flat ) )
+        assert len(pairs) == global_labels.max() + 1, \
+            "Stitched object ids don't match the objects of the full volume"
+
+        pred = self.op.StitchedPredictionImage[:].wait()
+        assert (pred == self.prediction_volume).all()
+
+    def testStitchingInvalidatedWhileComputing(self):
+        # A block that becomes dirty while the objects are stitched invalidates
+        # the new stitching, it must not be kept, and the request stitches again.
+        self.op.BlockShape3dDict.setValue( {'x' : 42, 'y' : 42, 'z' : 42} )
+        self.op.HaloPadding3dDict.setValue( {'x' : 35, 'y' : 35, 'z' : 30} )
+
+        calls = []
+        computeStitching = self.op._computeStitching
+        def computeAndInvalidate():
+            calls.append(self.op._stitching)
+            stitching = computeStitching()
+            if len(calls) == 1:
+                self.op._invalidateStitching() # what _handleDirtyBlock() does
+            return stitching
+        self.op._computeStitching = computeAndInvalidate
+        labels = self.op.LabelImage[:].wait()
+        assert calls == [None, None]
+        assert self.op._stitching is not None
+
+        self.op._computeStitching = computeStitching
+        self.op._invalidateStitching()
+        assert (self.op.LabelImage[:].wait() == labels).all()
+
+    def testStitchingInvalidatedWhileWriting(self):
+        # A block that becomes dirty after the objects were stitched, but before its
+        # labels are written, makes the request stitch again.
+        self.op.BlockShape3dDict.setValue( {'x' : 42, 'y' : 42, 'z' : 42} )
+        self.op.HaloPadding3dDict.setValue( {'x' : 35, 'y' : 35, 'z' : 30} )
+        expected = self.op.LabelImage[:].wait()
+        self.op._invalidateStitching()
+
+        calls = []
+        getStitching = self.op._getStitching
+        def getAndInvalidate():
+            stitching = getStitching()
+            calls.append(stitching)
+            if len(calls) == 1:
+                self.op._invalidateStitching() # what _handleDirtyBlock() does
+            return stitching
+        self.op._getStitching = getAndInvalidate
+        labels = self.op.LabelImage[:].wait()
+        assert len(calls) == 2
+        assert calls[1] is self.op._stitching
+        assert (labels == expected).all()
+
+    def testAutoHalo(self):
+        # The labeled cubes are 5 pixels wide, and 'Mean in neighborhood' has a margin of (10, 10, 1).
+        # The halo derived from them replaces the (too small) HaloPadding3dDict.
+        self.op.TrainingObjectExtent.connect( self.classifier.LabeledObjectExtent )
+        self.op.BlockShape3dDict.setValue( {'x' : 42, 'y' : 42, 'z' : 42} )
+        self.op.HaloPadding3dDict.setValue( {'x' : 0, 'y' : 0, 'z' : 0} )
+
+        pred = self.op.PredictionImage[:].wait()
+        assert self.op._getHaloPaddingDict() == {'x' : 15, 'y' : 15, 'z' : 6}
+        assert (pred == self.prediction_volume).all(), \
+            "Blockwise prediction with the automatic halo differs from the non-blockwise prediction!"
+
+        # Manual override
+        self.op.AutoHaloPadding.setValue( False )
+        assert self.op._getHaloPaddingDict() == {'x' : 0, 'y' : 0, 'z' : 0}
+
+    def testAutoHaloUpdate(self):
+        # A new training object extent doesn't recompute the halo right away,
+        # only when the next block is requested, and then the pipelines are rebuilt.
+        self.op.TrainingObjectExtent.setValue( {'x' : 5, 'y' : 5, 'z' : 5} )
+        self.op.BlockShape3dDict.setValue( {'x' : 42, 'y' : 42, 'z' : 42} )
+        self.op.HaloPadding3dDict.setValue( {'x' : 0, 'y' : 0, 'z' : 0} )
+
+        self.op.PredictionImage[:].wait()
+        assert self.op._getHaloPaddingDict() == {'x' : 15, 'y' : 15, 'z' : 6}
+        old_pipelines = self.op._blockPipelines.values()
+
+        self.op.TrainingObjectExtent.setValue( {'x' : 2, 'y' : 2, 'z' : 2} )
+        assert self.op._halo_padding_dict is None
+        assert self.op._blockPipelines.values() == old_pipelines
+
+        self.op.PredictionImage[:].wait()
+        assert self.op._getHaloPaddingDict() == {'x' : 12, 'y' : 12, 'z' : 3}
+        halo_padding = self.op._getFullShape( {'x' : 12, 'y' : 12, 'z' : 3} )
+        assert len(self.op._blockPipelines) > 0
+        for opBlockPipeline in self.op._blockPipelines.values():
+            assert opBlockPipeline not in old_pipelines
+            assert list( opBlockPipeline._halo_padding ) == list( halo_padding )
+
+    def testParallelBlocks(self):
+        # Blocks processed in parallel give the same result as one block at a time,
+        # and no more blocks are in flight than fit into the available memory.
+        def predict(availableBlocks):
+            self.connectLanes()
+            op = self.op
+            op.BlockShape3dDict.setValue( {'x' : 42, 'y' : 42, 'z' : 42} )
+            op.HaloPadding3dDict.setValue( {'x' : 35, 'y' : 35, 'z' : 30} )
+
+            inFlight = [0, 0] # current, peak
+            lock = threading.Lock()
+            acquire, release = op._acquirePipeline, op._releasePipeline
+            def countingAcquire(block_start):
+                with lock:
+                    inFlight[0] += 1
+                    inFlight[1] = max(inFlight)
+                return acquire(block_start)
+            def countingRelease(block_start, opBlockPipeline):
+                release(block_start, opBlockPipeline)
+                with lock:
+                    inFlight[0] -= 1
+            op._acquirePipeline = countingAcquire
+            op._releasePipeline = countingRelease
+
+            # pretend that only availableBlocks blocks fit into memory
+            psutil = blockwiseModule.psutil
+            VirtualMemory = collections.namedtuple('VirtualMemory', ['available'])
+            class FakePsutil(object):
+                @staticmethod
+                def virtual_memory():
+                    return VirtualMemory(availableBlocks * op._blockBytes(op._getHaloPaddingDict()))
+            blockwiseModule.psutil = FakePsutil
+            try:
+                pred = op.PredictionImage[:].wait()
+            finally:
+                blockwiseModule.psutil = psutil
+            return pred, inFlight[1]
+
+        serial, peak = predict(1)
+        assert peak == 1
+        assert (serial == self.prediction_volume).all()
+
+        nworkers = max(1, Request.global_thread_pool.num_workers)
+        for availableBlocks in (2, 100):
+            parallel, peak = predict(availableBlocks)
+            assert 1 <= peak <= min(availableBlocks, nworkers), \
+                "{} blocks in flight, at most {} allowed".format( peak, min(availableBlocks, nworkers) )
+            assert (parallel == serial).all(), \
+                "Parallel blockwise prediction differs from the serial one"
+
+    def testAutoHaloUpdateInFlight(self):
+        # A new halo that is noticed while another request uses a pipeline
+        # doesn't delete that pipeline until the request releases it.
+        self.op.TrainingObjectExtent.setValue( {'x' : 5, 'y' : 5, 'z' : 5} )
+        self.op.BlockShape3dDict.setValue( {'x' : 42, 'y' : 42, 'z' : 42} )
+        self.op.HaloPadding3dDict.setValue( {'x' : 0, 'y' : 0, 'z' : 0} )
+        self.op.PredictionImage[:].wait()
+
+        events = []
+        changed = []
+        acquire, release = self.op._acquirePipeline, self.op._releasePipeline
+        def changingAcquire(block_start):
+            opBlockPipeline = acquire(block_start)
+            if not changed:
+                changed.append(opBlockPipeline)
+                events.append('acquired')
+                cleanUp = opBlockPipeline.cleanUp
+                def recordingCleanUp():
+                    events.append('cleaned up')
+                    cleanUp()
+                opBlockPipeline.cleanUp = recordingCleanUp
+
+                # Change the extent while this pipeline is in use, and let
+                # another user of the block rebuild the pipelines.
+                self.op.TrainingObjectExtent.setValue( {'x' : 2, 'y' : 2, 'z' : 2} )
+                opOtherPipeline = acquire(block_start)
+                assert opOtherPipeline is not opBlockPipeline
+                release(block_start, opOtherPipeline)
+                assert opBlockPipeline in self.op._retiredPipelines
+                assert events == ['acquired']
+            return opBlockPipeline
+        def recordingRelease(block_start, opBlockPipeline):
+            if opBlockPipeline in changed:
+                events.append('released')
+            release(block_start, opBlockPipeline)
+        self.op._acquirePipeline = changingAcquire
+        self.op._releasePipeline = recordingRelease
+
+        self.op.PredictionImage[:].wait()
+        assert events == ['acquired', 'released', 'cleaned up']
+        assert self.op._retiredPipelines == {}
+        assert self.op._getHaloPaddingDict() == {'x' : 12, 'y' : 12, 'z' : 3}
+
+    def testBudgetOutsideLock(self):
+        # The memory budget is estimated once, not for every released block
+        self.op.BlockShape3dDict.setValue( {'x' : 42, 'y' : 42, 'z' : 42} )
+        calls = []
+        blockBytes = self.op._blockBytes
+        def countingBlockBytes(halo_padding_dict):
+            calls.append(halo_padding_dict)
+            return blockBytes(halo_padding_dict)
+        self.op._blockBytes = countingBlockBytes
+
+        self.op.PredictionImage[:].wait()
+        assert len(calls) == 1
+        self.op.PredictionImage[:].wait()
+        assert len(calls) == 1
+
+        # a new block shape needs a new estimate
+        self.op.BlockShape3dDict.setValue( {'x' : 50, 'y' : 50, 'z' : 50} )
+        self.op.PredictionImage[:].wait()
+        assert len(calls) == 2
+
     def testZeroHalo(self):
         # If we shrink the halo down to zero, then we get different predictions...
         # This block shape/halo combination will slice through some of the big blocks, causing mis-classification.
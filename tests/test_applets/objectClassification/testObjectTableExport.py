@@ -0,0 +1,111 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import os
+import shutil
+import tempfile
+
+import numpy
+import h5py
+
+from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
+from ilastik.applets.objectClassification.objectTableExport import objectTableChunks, tableColumns, \
+    HDF5ObjectTableWriter, CSVObjectTableWriter
+
+NAME = "Standard Object Features"
+
+def features(nobj):
+    mins = numpy.arange(3 * (nobj + 1)).reshape(-1, 3)
+    return {
+        default_features_key: {"Coord<Minimum>": mins,
+                               "Coord<Maximum>": mins + 2,
+                               "Count": numpy.arange(nobj + 1).reshape(-1, 1)},
+        NAME: {"Count": numpy.arange(nobj + 1).reshape(-1, 1) * 10.,
+               "RegionCenter": numpy.ones((nobj + 1, 3))},
+    }
+
+def probabilities(nobj):
+    probs = numpy.zeros((nobj + 1, 2), dtype=numpy.float32)
+    probs[1::2, 0] = 0.75
+    probs[2::2, 0] = 0.25
+    probs[1:, 1] = 1 - probs[1:, 0]
+    return probs
+
+SELECTED = {NAME: {"Count": {}, "RegionCenter": {}}}
+
+
+class TestObjectTableExport(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_chunks(self):
+        nobj = 10
+        chunks = list(objectTableChunks(3, features(nobj), probabilities(nobj), SELECTED, chunk_rows=4))
+        assert [c.shape[0] for _, c in chunks] == [4, 4, 2]
+        col_names, _ = chunks[0]
+        table = numpy.vstack([c for _, c in chunks])
+
+        columns = tableColumns(col_names, 3, 2, ["a", "b"])
+        assert len(columns) == table.shape[1]
+        assert columns[:4] == ["time", "object_id", "bbox_min_x", "bbox_min_y"]
+        assert columns[8] == NAME + "/Count"
+        assert columns[9:12] == [NAME + "/RegionCenter[{}]".format(i) for i in range(3)]
+        assert columns[-3:] == ["predicted_class", "probability_a", "probability_b"]
+
+        assert numpy.all(table[:, 0] == 3)
+        assert numpy.all(table[:, 1] == numpy.arange(1, nobj + 1))
+        assert numpy.all(table[:, 2:5] == features(nobj)[default_features_key]["Coord<Minimum>"][1:])
+        assert numpy.all(table[:, 5:8] == table[:, 2:5] + 2)
+        assert numpy.all(table[:, 8] == table[:, 1] * 10)
+        assert numpy.all(table[:, -3] == [1, 2] * (nobj // 2))
+        assert numpy.all(table[:, -2:] == probabilities(nobj)[1:])
+
+    def test_writers(self):
+        nobj = 5
+        chunks = list(objectTableChunks(0, features(nobj), probabilities(nobj), SELECTED, chunk_rows=2))
+        columns = tableColumns(chunks[0][0], 3, 2)
+        expected = numpy.vstack([c for _, c in chunks])
+
+        h5path = os.path.join(self.tmpdir, "objects.h5")
+        writer = HDF5ObjectTableWriter(h5path, columns)
+        for _, chunk in chunks:
+            writer.write(chunk)
+        writer.close()
+        with h5py.File(h5path, 'r') as f:
+            assert list(f["objects/columns"][:]) == columns
+            assert numpy.all(f["objects/data"][:] == expected)
+
+        csvpath = os.path.join(self.tmpdir, "objects.csv")
+        writer = CSVObjectTableWriter(csvpath, columns)
+        for _, chunk in chunks:
+            writer.write(chunk)
+        writer.close()
+        with open(csvpath) as f:
+            assert f.readline().strip().split(",") == columns
+            assert f.readline().startswith("0,1,3,4,5,5,6,7,10,1,1,1,1,")
+        loaded = numpy.loadtxt(csvpath, delimiter=",", skiprows=1)
+        assert numpy.allclose(loaded, expected)
+
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -21,13 +21,16 @@ import unittest
 import numpy as np
 import vigra
 from lazyflow.graph import Graph
+from lazyflow.request import Request
+from lazyflow.rtype import List
 from ilastik.applets.objectClassification.opObjectClassification import \
     OpRelabelSegmentation, OpObjectTrain, OpObjectPredict, OpObjectClassification, \
-    OpBadObjectsToWarningMessage, OpMaxLabel
+    OpBadObjectsToWarningMessage, OpMaxLabel, OpLabeledObjectExtent, coalesce_boxes
     
 from ilastik.applets import objectExtraction
 from ilastik.applets.objectExtraction.opObjectExtraction import \
-    OpRegionFeatures, OpAdaptTimeListRoi, OpObjectExtraction
+    OpRegionFeatures, OpAdaptTimeListRoi, OpObjectExtraction, default_features_key
+from ilastik.applets.objectExtraction.objectFeatureTable import ObjectFeatureTable
 
 
 def segImage():
@@ -48,6 +51,18 @@ def segImage():
     img.axistags = vigra.defaultAxistags('txyzc')    
     return img
 
+def segFeatures():
+    '''
+    the bounding boxes of the objects in segImage()
+    '''
+    mins = {0: [[0, 0, 0], [0, 0, 0], [20, 20, 20]],
+            1: [[0, 0, 0], [0, 0, 0], [10, 10, 10], [20, 20, 20]]}
+    maxs = {0: [[49, 49, 49], [9, 9, 9], [24, 24, 24]],
+            1: [[49, 49, 49], [9, 9, 9], [19, 19, 19], [24, 24, 24]]}
+    return dict((t, {default_features_key: {'Coord<Minimum>': np.array(mins[t]),
+                                            'Coord<Maximum>': np.array(maxs[t])}})
+                for t in mins)
+
 def emptyImage():
     '''
     an empty 5D image 
@@ -68,7 +83,7 @@ class TestOpRelabelSegmentation(object):
                 1 : np.array([40, 50, 60, 70])}
         self.op.Image.setValue(segimg)
         self.op.ObjectMap.setValue(map_)
-        self.op.Features._setReady() # hack because we do not use features
+        self.op.Features.setValue(segFeatures())
         img = self.op.Output.value
 
         assert img[0, 49, 49, 49, 0] == 10
@@ -79,6 +94,139 @@ class TestOpRelabelSegmentation(object):
         assert (np.all(img[1, 10:20, 10:20, 10:20, 0] == 60))
         assert (np.all(img[1, 20:25, 20:25, 20:25, 0] == 70))
 
+    def test_short_map(self):
+        # maps without entries for all objects are padded with zeros,
+        # and the cached lookup tables follow changes of the map
+        segimg = segImage()
+        self.op.Image.setValue(segimg)
+        self.op.ObjectMap.setValue({0 : np.array([10, 20, 30]),
+                                    1 : np.array([40, 50])})
+        self.op.Features.setValue(segFeatures())
+        img = self.op.Output[1:2, 0:25, 0:25, 0:25, :].wait()
+        assert (np.all(img[0,  0:10,  0:10,  0:10, 0] == 50))
+        assert (np.all(img[0, 10:20, 10:20, 10:20, 0] == 0))
+        assert (np.all(img[0, 20:25, 20:25, 20:25, 0] == 0))
+        # the labels are not clipped in the upstream image
+        assert (segimg == segImage()).all()
+
+        self.op.ObjectMap.setValue({0 : np.array([10, 20, 30]),
+                                    1 : np.array([40, 50, 60, 70])})
+        img = self.op.Output[1:2, 0:25, 0:25, 0:25, :].wait()
+        assert (np.all(img[0, 10:20, 10:20, 10:20, 0] == 60))
+        assert (np.all(img[0, 20:25, 20:25, 20:25, 0] == 70))
+
+    def test_dirty_boxes(self):
+        # only the bounding boxes of the changed objects become dirty
+        segimg = segImage()
+        map_ = {0 : np.array([0, 1, 1]),
+                1 : np.array([0, 1, 1, 1])}
+        self.op.Image.setValue(segimg)
+        self.op.ObjectMap.setValue(map_)
+        self.op.Features.setValue(segFeatures())
+        self.op.Output[:].wait()
+
+        dirty = []
+        self.op.Output.notifyDirty(lambda slot, roi: dirty.append((tuple(roi.start), tuple(roi.stop))))
+
+        map_[1][2] = 2
+        self.op.ObjectMap.setDirty([(1, 2)])
+        assert dirty == [((1, 10, 10, 10, 0), (2, 20, 20, 20, 1))]
+
+        # the nearby objects 2 and 3 are merged into a single roi
+        self.op.Output[:].wait()
+        del dirty[:]
+        map_[1][2] = 1
+        map_[1][3] = 2
+        self.op.ObjectMap.setDirty([(1, 2), (1, 3)])
+        assert dirty == [((1, 10, 10, 10, 0), (2, 25, 25, 25, 1))]
+
+        img = self.op.Output[:].wait()
+        assert np.all(img[1, 10:20, 10:20, 10:20, 0] == 1)
+        assert np.all(img[1, 20:25, 20:25, 20:25, 0] == 2)
+
+        # without known boxes, the whole time slice is dirty
+        self.op.Features.setDirty([1])
+        del dirty[:]
+        self.op.ObjectMap.setDirty([(1, 2)])
+        assert dirty == [((1, 0, 0, 0, 0), (2, 50, 50, 50, 1))]
+
+        # time slices and empty rois are dirty entirely
+        del dirty[:]
+        self.op.ObjectMap.setDirty([0])
+        assert dirty == [((0, 0, 0, 0, 0), (1, 50, 50, 50, 1))]
+        del dirty[:]
+        self.op.ObjectMap.setDirty([])
+        assert dirty == [((0, 0, 0, 0, 0), (2, 50, 50, 50, 1))]
+
+    def test_dirty_while_computing(self):
+        # a lookup table made from an outdated object map is not cached
+        segimg = segImage()
+        map_ = {0 : np.array([10, 20, 30]),
+                1 : np.array([40, 50, 60, 70])}
+        self.op.Image.setValue(segimg)
+        self.op.ObjectMap.setValue(map_)
+        self.op.Features.setValue(segFeatures())
+
+        makeLut = self.op._makeLut
+        def changingMakeLut(t):
+            lut = makeLut(t)
+            if t == 1 and map_[1][1] == 50:
+                map_[1][1] = 55
+                self.op.ObjectMap.setDirty([1])
+            return lut
+        self.op._makeLut = changingMakeLut
+
+        img = self.op.Output[1:2, 0:10, 0:10, 0:10, :].wait()
+        assert np.all(img == 50)
+        assert 1 not in self.op._luts
+        img = self.op.Output[1:2, 0:10, 0:10, 0:10, :].wait()
+        assert np.all(img == 55)
+
+    def test_no_requests_in_propagate_dirty(self):
+        # propagateDirty must not request the object map (e.g. predictions)
+        segimg = segImage()
+        map_ = {0 : np.array([0, 1, 1]),
+                1 : np.array([0, 1, 1, 1])}
+        self.op.Image.setValue(segimg)
+        self.op.ObjectMap.setValue(map_)
+        self.op.Features.setValue(segFeatures())
+        self.op.Output[:].wait()
+
+        requests = []
+        makeLut = self.op._makeLut
+        def countingMakeLut(t):
+            requests.append(t)
+            return makeLut(t)
+        self.op._makeLut = countingMakeLut
+
+        map_[1][2] = 2
+        self.op.ObjectMap.setDirty([(1, 2)])
+        self.op.ObjectMap.setDirty([])
+        assert requests == []
+
+        # the new map is used on the next request
+        img = self.op.Output[1:2, ...].wait()
+        assert requests == [1]
+        assert np.all(img[0, 10:20, 10:20, 10:20, 0] == 2)
+
+
+class TestCoalesceBoxes(object):
+    def test(self):
+        starts = np.array([[0, 0], [12, 0], [50, 50], [25, 0]])
+        stops = np.array([[10, 10], [20, 10], [60, 60], [30, 5]])
+        new_starts, new_stops = coalesce_boxes(starts, stops, distance=0)
+        assert len(new_starts) == 4
+
+        # the first, second and fourth box form a chain of nearby boxes
+        new_starts, new_stops = coalesce_boxes(starts, stops, distance=5)
+        order = np.argsort(new_starts[:, 0])
+        assert np.all(new_starts[order] == [[0, 0], [50, 50]])
+        assert np.all(new_stops[order] == [[30, 10], [60, 60]])
+
+        new_starts, new_stops = coalesce_boxes(starts[:0], stops[:0])
+        assert len(new_starts) == 0
+
+
 class TestOpObjectTrain(unittest.TestCase):
     
     nRandomForests = 1
@@ -129,6 +277,82 @@ class TestOpObjectTrain(unittest.TestCase):
         for randomForest in results:
             self.assertIsInstance(randomForest, vigra.learning.RandomForest)
             
+    def test_tree_split(self):
+        # the trees are split evenly across the worker threads
+        labels = {0 : np.array([0, 1, 2]),
+                  1 : np.array([0, 1, 1, 2])}
+        self.op.Labels.resize(1)
+        self.op.Labels.setValue(labels)
+        self.op.TreeCount.setValue(10)
+        self.op.ForestCount.setValue(0)
+
+        results = self.op.Classifier[:].wait()
+        nworkers = max(1, Request.global_thread_pool.num_workers)
+        self.assertEquals(len(results), min(10, nworkers))
+        tree_counts = [forest.treeCount() for forest in results]
+        self.assertEquals(sum(tree_counts), 10)
+        self.assertTrue(max(tree_counts) - min(tree_counts) <= 1)
+
+        self.op.ForestCount.setValue(3)
+        results = self.op.Classifier[:].wait()
+        self.assertEquals(sorted(forest.treeCount() for forest in results), [3, 3, 4])
+
+
+    def _tableRows(self, t, objects):
+        feats = self._opRegFeatsAdaptOutput.Output([t]).wait()
+        table = ObjectFeatureTable.from_features({t: feats[t]})
+        return table.select(self.op.SelectedFeatures([]).wait(), t, objects)
+
+    def _countSelects(self):
+        # records the objects looked up in the cached feature tables
+        selects = []
+        for t, table in self.op._opFeatureTables.innerOperators[0]._cache.items():
+            def select(selected, t, objects=None, _select=table.select):
+                selects.append((t, list(objects)))
+                return _select(selected, t, objects)
+            table.select = select
+        return selects
+
+    def test_training_rows_reuse(self):
+        selected = self.op.SelectedFeatures([]).wait()
+        rows = self.op._getTrainingRows(0, {0: np.array([2]), 1: np.array([1, 3])}, selected)
+        self.assertEquals(sorted(rows.keys()), [0, 1])
+
+        # only the newly labeled objects are looked up, the rows of the
+        # other objects come from the cache
+        selects = self._countSelects()
+        labeled = {0: np.array([1, 2]), 1: np.array([1, 2, 3])}
+        rows = self.op._getTrainingRows(0, labeled, selected)
+        self.assertEquals(sorted(selects), [(0, [1]), (1, [2])])
+        for t, objects in labeled.items():
+            feats, col_names = self._tableRows(t, objects)
+            self.assertEquals(list(rows[t][1]), list(col_names))
+            np.testing.assert_array_equal(rows[t][0], feats)
+
+        # removing labels needs no lookups at all
+        del selects[:]
+        rows = self.op._getTrainingRows(0, {1: np.array([3])}, selected)
+        self.assertEquals(selects, [])
+        np.testing.assert_array_equal(rows[1][0], self._tableRows(1, np.array([3]))[0])
+        self.assertEquals(self.op._trainingRows.keys(), [(0, 1)])
+
+    def test_training_rows_invalidation(self):
+        selected = self.op.SelectedFeatures([]).wait()
+        labeled = {0: np.array([1, 2]), 1: np.array([1, 2, 3])}
+        self.op._getTrainingRows(0, labeled, selected)
+        self.assertEquals(sorted(self.op._trainingRows.keys()), [(0, 0), (0, 1)])
+
+        # dirty features of one time slice only drop the rows of that slice
+        output = self._opRegFeatsAdaptOutput.Output
+        output.setDirty(List(output, [1]))
+        self.assertEquals(self.op._trainingRows.keys(), [(0, 0)])
+        rows = self.op._getTrainingRows(0, labeled, selected)
+        np.testing.assert_array_equal(rows[1][0], self._tableRows(1, labeled[1])[0])
+
+        # a different feature selection drops all of them
+        self.op.SelectedFeatures.setDirty(())
+        self.assertEquals(self.op._trainingRows, {})
+
             
     def test_train_fail(self):
         segimg = segImage()
@@ -231,6 +455,37 @@ class TestOpObjectPredict(unittest.TestCase):
         self.assertTrue( np.all(probChannel0Time01[0]==probs[0][:, 0]) )
         self.assertTrue( np.all(probChannel0Time01[1]==probs[1][:, 0]) )
         
+    def test_parallel_time_slices(self):
+        # time slices predicted together give the same probabilities as
+        # time slices predicted one by one
+        probs = self.op.Probabilities([0, 1]).wait()
+        bad = self.op.BadObjects([0, 1]).wait()
+
+        op = OpObjectPredict(graph=self.op.graph)
+        op.Classifier.connect(self.trainop.Classifier)
+        op.Features.connect(self._opRegFeatsAdaptOutput.Output)
+        op.SelectedFeatures.setValue(self.op.SelectedFeatures.value)
+        op.LabelsCount.setValue(2)
+        for t in (1, 0):
+            self.assertTrue( np.all(op.Probabilities([t]).wait()[t] == probs[t]) )
+            self.assertTrue( np.all(op.BadObjects([t]).wait()[t] == bad[t]) )
+        self.assertEqual( sorted(op.CachedProbabilities([]).wait().keys()), [0, 1] )
+
+    def test_stale_prediction(self):
+        # a prediction that started before the cache was cleared is
+        # returned, but not cached
+        generation = self.op._getGeneration()
+        forests = self.op.Classifier[:].wait()
+        selected = self.op.SelectedFeatures([]).wait()
+        self.op.propagateDirty(self.op.Classifier, (), slice(None))
+
+        probs, bad = self.op._predict(0, forests, selected, generation)
+        self.assertEqual( probs.shape, (3, 2) )
+        self.assertFalse( 0 in self.op.CachedProbabilities([0]).wait() )
+
+        self.op._predict(0, forests, selected, self.op._getGeneration())
+        self.assertTrue( 0 in self.op.CachedProbabilities([0]).wait() )
+
 
  
 class TestFeatureSelection(unittest.TestCase):
@@ -372,6 +627,26 @@ class TestMaxLabel(object):
         assert nl[0]==4
    
 
+class TestLabeledObjectExtent(object):
+    def setUp(self):
+        g = Graph()
+        self.op = OpLabeledObjectExtent(graph=g)
+        self.op.Features.setValues([segFeatures()])
+
+    def test(self):
+        # the 5x5x5 object at t=0 and the 10x10x10 object at t=1
+        self.op.Labels.setValues([{0: np.array([0., 0., 1.]), 1: np.array([0., 0., 2., 0.])}])
+        assert self.op.Output.value == {'x': 10, 'y': 10, 'z': 10}
+
+        # only the small object
+        self.op.Labels.setValues([{0: np.array([0., 0., 1.]), 1: np.zeros((2,))}])
+        assert self.op.Output.value == {'x': 5, 'y': 5, 'z': 5}
+
+    def test_no_labels(self):
+        self.op.Labels.setValues([{0: np.zeros((2,)), 1: np.zeros((2,))}])
+        assert self.op.Output.value == {}
+
+
 class TestFullOperator(unittest.TestCase):
     def setUp(self):
         segimg = segImage()
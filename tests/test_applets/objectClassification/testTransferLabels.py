@@ -48,7 +48,26 @@ class TestTransferLabelsFunction(object):
         newmin4 =  coords_new["Coord<Minimum>"][4]
         newmax4 = coords_new["Coord<Maximum>"][4]
         assert numpy.all(newlost["conflict"]==(newmin4+(newmax4-newmin4)/2.))
-    
+
+    def test_many_objects(self):
+        # a 2D grid of small objects, shifted by one pixel in the new segmentation
+        n = 100
+        grid = numpy.array([(x, y) for x in range(n) for y in range(n)]) * 10
+        coords_old = {"Coord<Minimum>": numpy.vstack(([[0, 0]], grid)),
+                      "Coord<Maximum>": numpy.vstack(([[10*n, 10*n]], grid + 5))}
+        coords_new = {"Coord<Minimum>": numpy.vstack(([[0, 0]], grid + 1)),
+                      "Coord<Maximum>": numpy.vstack(([[10*n, 10*n]], grid + 6))}
+
+        labels = numpy.zeros((n*n + 1,))
+        labels[1::2] = 1
+        labels[2::2] = 2
+
+        newlabels, oldlost, newlost = OpObjectClassification.transferLabels(labels, coords_old, coords_new, None)
+        assert numpy.all(newlabels == labels)
+        assert len(oldlost["full"]) == 0
+        assert len(oldlost["partial"]) == 0
+        assert len(newlost["conflict"]) == 0
+
     
 if __name__ == "__main__":
     import sys
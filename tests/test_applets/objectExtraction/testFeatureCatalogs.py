@@ -0,0 +1,118 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import vigra
+
+from ilastik import plugins
+
+BROKEN_PLUGIN_INFO = \
+"""
+[Core]
+Name = Broken Object Features
+Module = broken_objfeats
+"""
+
+class TestObjectFeatureCatalogs(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.saved = (plugins.feature_catalog_cache, plugins.pluginManager,
+                      plugins.plugin_paths, plugins._versions)
+        plugins.feature_catalog_cache = os.path.join(self.tempDir, 'catalogs.json')
+        self.resetPluginManager()
+
+        self.image = vigra.taggedView(np.zeros((10, 10, 10, 1), dtype=np.float32), 'xyzc')
+        self.labels = vigra.taggedView(np.zeros((10, 10, 10, 1), dtype=np.uint32), 'xyzc')
+        self.labels[2:5, 2:5, 2:5, 0] = 1
+
+    def tearDown(self):
+        (plugins.feature_catalog_cache, plugins.pluginManager,
+         plugins.plugin_paths, plugins._versions) = self.saved
+        shutil.rmtree(self.tempDir)
+
+    def resetPluginManager(self):
+        # a new session: nothing is imported yet
+        plugins.pluginManager = plugins.LazyPluginManager(plugins.plugin_paths, plugins.plugin_categories)
+
+    def pluginsLoaded(self):
+        return plugins.pluginManager._manager is not None
+
+    def testCacheHit(self):
+        catalogs = plugins.objectFeatureCatalogs(self.image, self.labels)
+        assert "Standard Object Features" in catalogs
+        assert self.pluginsLoaded()
+        assert os.path.exists(plugins.feature_catalog_cache)
+
+        # the plugins are not imported if all catalogs are cached
+        self.resetPluginManager()
+        assert plugins.objectFeatureCatalogs(self.image, self.labels) == catalogs
+        assert not self.pluginsLoaded()
+
+        # other image types have their own catalogs
+        labels = self.labels.astype(np.uint8)
+        plugins.objectFeatureCatalogs(self.image, labels)
+        assert self.pluginsLoaded()
+
+    def testInvalidation(self):
+        catalogs = plugins.objectFeatureCatalogs(self.image, self.labels)
+
+        # a modified plugin is probed again
+        with open(plugins.feature_catalog_cache) as f:
+            cache = json.load(f)
+        cache["Standard Object Features"]['mtime'] -= 1
+        with open(plugins.feature_catalog_cache, 'w') as f:
+            json.dump(cache, f)
+        self.resetPluginManager()
+        assert plugins.objectFeatureCatalogs(self.image, self.labels) == catalogs
+        assert self.pluginsLoaded()
+
+        # so are all plugins after an update of ilastik or vigra
+        plugins._versions = lambda: "ilastik 0.0 vigra 0.0"
+        self.resetPluginManager()
+        assert plugins.objectFeatureCatalogs(self.image, self.labels) == catalogs
+        assert self.pluginsLoaded()
+
+    def testFailedImport(self):
+        pluginDir = os.path.join(self.tempDir, 'plugins')
+        os.mkdir(pluginDir)
+        with open(os.path.join(pluginDir, 'broken_objfeats.yapsy-plugin'), 'w') as f:
+            f.write(BROKEN_PLUGIN_INFO)
+        with open(os.path.join(pluginDir, 'broken_objfeats.py'), 'w') as f:
+            f.write("raise ImportError('a missing dependency')\n")
+        plugins.plugin_paths = [pluginDir]
+        self.resetPluginManager()
+
+        assert plugins.objectFeatureCatalogs(self.image, self.labels) == {}
+        assert self.pluginsLoaded()
+
+        # the broken plugin is not imported again
+        self.resetPluginManager()
+        assert plugins.objectFeatureCatalogs(self.image, self.labels) == {}
+        assert not self.pluginsLoaded()
+
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,79 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import h5py
+import numpy as np
+from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
+from ilastik.applets.objectExtraction.objectExtractionSerializer import writeFeatureTables, readFeatureTables
+
+NAME = "Standard Object Features"
+
+def regionFeatures():
+    # block 0: background + 2 objects, block 1: background + 3 objects
+    return [{NAME: {"Count": np.array([[0], [10], [20]], dtype=np.float32),
+                    "RegionCenter": np.array([[0, 0], [1, 2], [3, 4]], dtype=np.float32)},
+             default_features_key: {"Count": np.array([[0], [10], [20]], dtype=np.float32)}},
+            {NAME: {"Count": np.array([[0], [30], [40], [50]], dtype=np.float32),
+                    "RegionCenter": np.array([[0, 0], [5, 6], [7, 8], [9, 10]], dtype=np.float32)},
+             default_features_key: {"Count": np.array([[0], [30], [40], [50]], dtype=np.float32)}}]
+
+class TestFeatureTables(object):
+    def setUp(self):
+        self.f = h5py.File('featuretables.h5', 'w', driver='core', backing_store=False)
+        self.feats = regionFeatures()
+        writeFeatureTables(self.f, [[0], [1]], self.feats)
+
+    def tearDown(self):
+        self.f.close()
+
+    def test_layout(self):
+        # one table per plugin instead of one dataset per feature and block
+        assert self.f[NAME]['data'].shape == (7, 3)
+        assert self.f[default_features_key]['data'].shape == (7, 1)
+        assert list(self.f['offsets'][...]) == [0, 3, 7]
+
+    def test_roundtrip(self):
+        blocks = readFeatureTables(self.f)
+        assert [start for start, _ in blocks] == [(0,), (1,)]
+        for (_, loaded), feats in zip(blocks, self.feats):
+            assert sorted(loaded.keys()) == sorted(feats.keys())
+            for plugin in feats:
+                assert sorted(loaded[plugin].keys()) == sorted(feats[plugin].keys())
+                for featname, value in feats[plugin].iteritems():
+                    assert np.all(loaded[plugin][featname] == value)
+
+    def test_partial(self):
+        selected = {NAME: {"RegionCenter": {}}}
+        blocks = readFeatureTables(self.f, blocks=[1], selected=selected)
+        assert len(blocks) == 1
+        start, loaded = blocks[0]
+        assert start == (1,)
+        assert loaded.keys() == [NAME]
+        assert loaded[NAME].keys() == ["RegionCenter"]
+        assert np.all(loaded[NAME]["RegionCenter"] == self.feats[1][NAME]["RegionCenter"])
+
+
+if __name__ == '__main__':
+    import sys
+    import nose
+
+    # Don't steal stdout. Show it on the console as usual.
+    sys.argv.append("--nocapture")
+
+    # Don't set the logging level to DEBUG. Leave it alone.
+    sys.argv.append("--nologcapture")
+
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,82 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import numpy as np
+from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
+from ilastik.applets.objectExtraction.objectFeatureTable import ObjectFeatureTable
+
+NAME = "Standard Object Features"
+
+def featureDicts():
+    # t=0: background + 2 objects, t=1: background + 3 objects
+    return {0: {NAME: {"Count": np.array([[0], [10], [20]], dtype=np.float32),
+                       "RegionCenter": np.array([[0, 0], [1, 2], [3, 4]], dtype=np.float32)},
+                default_features_key: {"Count": np.array([[0], [10], [20]], dtype=np.float32)}},
+            1: {NAME: {"Count": np.array([[0], [30], [40], [50]], dtype=np.float32),
+                       "RegionCenter": np.array([[0, 0], [5, 6], [7, 8], [9, 10]], dtype=np.float32)},
+                default_features_key: {"Count": np.array([[0], [30], [40], [50]], dtype=np.float32)}}}
+
+class TestObjectFeatureTable(object):
+    def setUp(self):
+        self.feats = featureDicts()
+        self.table = ObjectFeatureTable.from_features(self.feats)
+
+    def test_layout(self):
+        assert self.table.data.dtype == np.float32
+        assert self.table.data.shape == (7, 4)
+        assert self.table.times == [0, 1]
+        assert self.table.rows(0) == slice(0, 3)
+        assert self.table.rows(1) == slice(3, 7)
+        for t in self.feats:
+            for name, value in self.feats[t][NAME].iteritems():
+                assert np.all(self.table.feature(t, NAME, name) == value)
+
+    def test_select(self):
+        selected = {NAME: {"RegionCenter": {}, "Count": {}}}
+        matrix, col_names = self.table.select(selected, 1)
+        assert col_names == [(NAME, "Count"), (NAME, "RegionCenter"), (NAME, "RegionCenter")]
+        assert matrix.shape == (4, 3)
+        assert np.all(matrix[:, 0] == self.feats[1][NAME]["Count"][:, 0])
+        assert np.all(matrix[:, 1:] == self.feats[1][NAME]["RegionCenter"])
+
+        # default features are never selected
+        selected = {NAME: {"Count": {}}, default_features_key: {"Count": {}}}
+        matrix, col_names = self.table.select(selected, 0, [2])
+        assert col_names == [(NAME, "Count")]
+        assert matrix.shape == (1, 1)
+        assert matrix[0, 0] == 20
+
+    def test_mismatching_features(self):
+        del self.feats[1][NAME]["Count"]
+        try:
+            ObjectFeatureTable.from_features(self.feats)
+        except Exception:
+            pass
+        else:
+            assert False, "different features in different time slices must be rejected"
+
+
+if __name__ == '__main__':
+    import sys
+    import nose
+
+    # Don't steal stdout. Show it on the console as usual.
+    sys.argv.append("--nocapture")
+
+    # Don't set the logging level to DEBUG. Leave it alone.
+    sys.argv.append("--nologcapture")
+
+    nose.run(defaultTest=__file__)
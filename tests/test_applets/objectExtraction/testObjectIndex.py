@@ -0,0 +1,91 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import numpy as np
+import vigra
+from lazyflow.graph import Graph
+from ilastik.applets.objectExtraction.objectIndex import ObjectIndex
+from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectIndex
+
+def labelImage():
+    labels = np.zeros((20, 20, 10), dtype=np.uint32)
+    labels[0:5, 0:5, 0:5] = 1
+    labels[8:12, 2:4, 0:10] = 2 # crosses two blocks in x
+    # label 3 does not occur
+    labels[15:20, 15:20, 5:10] = 4
+    return labels
+
+class TestObjectIndex(object):
+    def setUp(self):
+        self.labels = labelImage()
+        self.index = ObjectIndex.from_labels(self.labels, (10, 10, 10))
+
+    def test_bboxes(self):
+        assert self.index.nobjects == 4
+        assert self.index.bbox(1) == (slice(0, 5), slice(0, 5), slice(0, 5))
+        assert self.index.bbox(2) == (slice(8, 12), slice(2, 4), slice(0, 10))
+        assert self.index.bbox(2, margin=(1, 1, 1)) == (slice(7, 13), slice(1, 5), slice(0, 10))
+        for obj in [1, 2, 4]:
+            crop = self.labels[self.index.bbox(obj)]
+            assert np.sum(crop == obj) == np.sum(self.labels == obj)
+        assert np.all(self.index.bboxes[3] == 0)
+
+    def test_blocks(self):
+        assert self.index.gridShape == (2, 2, 1)
+        assert self.index.blocks(1).tolist() == [[0, 0, 0]]
+        assert self.index.blocks(2).tolist() == [[0, 0, 0], [10, 0, 0]]
+        assert self.index.blocks(3).tolist() == []
+        assert self.index.blocks(4).tolist() == [[10, 10, 0]]
+
+        assert list(self.index.objects((0, 0, 0))) == [1, 2]
+        assert list(self.index.objects((10, 0, 0))) == [2]
+        assert list(self.index.objects((0, 10, 0))) == []
+
+
+class TestOpObjectIndex(object):
+    def setUp(self):
+        g = Graph()
+        self.op = OpObjectIndex(graph=g)
+        labels = np.zeros((2,) + labelImage().shape + (1,), dtype=np.uint32)
+        labels[0, ..., 0] = labelImage()
+        labels[1, 0:3, 0:3, 0:3, 0] = 1
+        labels = labels.view(vigra.VigraArray)
+        labels.axistags = vigra.defaultAxistags('txyzc')
+        self.op.LabelImage.setValue(labels)
+        self.op.BlockShape.setValue((10, 10, 10))
+
+    def test_output(self):
+        indexes = self.op.Output([]).wait()
+        assert sorted(indexes.keys()) == [0, 1]
+        assert indexes[0].nobjects == 4
+        assert indexes[1].nobjects == 1
+        assert indexes[1].bbox(1) == (slice(0, 3), slice(0, 3), slice(0, 3))
+
+        indexes = self.op.Output([1]).wait()
+        assert indexes.keys() == [1]
+
+
+if __name__ == '__main__':
+    import sys
+    import nose
+
+    # Don't steal stdout. Show it on the console as usual.
+    sys.argv.append("--nocapture")
+
+    # Don't set the logging level to DEBUG. Leave it alone.
+    sys.argv.append("--nologcapture")
+
+    nose.run(defaultTest=__file__)
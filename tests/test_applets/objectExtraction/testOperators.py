@@ -19,8 +19,10 @@ import numpy as np
 import vigra
 from lazyflow.graph import Graph
 from lazyflow.operators import OpLabelImage
-from ilastik.applets.objectExtraction.opObjectExtraction import OpAdaptTimeListRoi, OpRegionFeatures
-from ilastik.plugins import pluginManager
+from ilastik.applets.objectExtraction.opObjectExtraction import OpAdaptTimeListRoi, OpRegionFeatures, \
+    OpObjectCenterImage, default_features_key
+from ilastik.applets.objectExtraction import opObjectExtraction
+from ilastik.plugins import pluginManager, ObjectFeaturesPlugin
 
 NAME = "Standard Object Features"
 
@@ -115,6 +117,75 @@ class TestOpRegionFeatures(object):
         assert np.any(feats[0][NAME]['Count'] != feats[1][NAME]['Count'])
         assert np.any(feats[0][NAME]['RegionCenter'] != feats[1][NAME]['RegionCenter'])
 
+    def test_time_subsets(self):
+        opAdapt = OpAdaptTimeListRoi(graph=self.op.graph)
+        opAdapt.Input.connect(self.op.Output)
+
+        # single, reversed and parallel requests must all agree
+        feats_all = opAdapt.Output([1, 0]).wait()
+        assert sorted(feats_all.keys()) == [0, 1]
+        for t in [0, 1]:
+            feats_t = opAdapt.Output([t]).wait()
+            assert feats_t.keys() == [t]
+            assert np.all(feats_t[t][NAME]['Count'] == feats_all[t][NAME]['Count'])
+
+        feats_direct = self.op.Output[:].wait()
+        assert feats_direct.shape == (self.img.shape[0],)
+        for t in [0, 1]:
+            assert np.all(feats_direct[t][NAME]['Count'] == feats_all[t][NAME]['Count'])
+
+    def test_size_range(self):
+        opAdapt = OpAdaptTimeListRoi(graph=self.op.graph)
+        opAdapt.Input.connect(self.op.Output)
+        unfiltered = opAdapt.Output([0, 1]).wait()
+
+        self.op.SizeRange.setValue((100, 1000))
+        feats = opAdapt.Output([0, 1]).wait()
+        for t in [0, 1]:
+            # all objects keep their IDs and default features
+            counts = feats[t][default_features_key]['Count'][1:, 0]
+            assert np.all(counts == unfiltered[t][default_features_key]['Count'][1:, 0])
+
+            inside = (counts >= 100) & (counts <= 1000)
+            values = feats[t][NAME]['Count'][1:, 0]
+            assert np.all(values[inside] == counts[inside])
+            assert np.all(np.isnan(values[~inside]))
+            centers = feats[t][NAME]['RegionCenter'][1:]
+            assert np.all(centers[inside] == unfiltered[t][NAME]['RegionCenter'][1:][inside])
+        assert np.count_nonzero(np.isnan(feats[1][NAME]['Count'][1:, 0])) == 2
+
+
+class TestOpObjectCenterImage(object):
+    def setUp(self):
+        g = Graph()
+        self.op = OpObjectCenterImage(graph=g)
+        self.img = binaryImage()
+        self.op.BinaryImage.setValue(self.img)
+        # background, then one center per object
+        centers = {0: np.array([[0, 0, 0], [4.5, 4.5, 4.5], [24.5, 24.5, 24.5], [42, 42, 42]]),
+                   1: np.array([[0, 0, 0], [24.5, 24.5, 24.5]])}
+        self.op.RegionCenters.setValue(dict((t, {default_features_key: {'RegionCenter': c}})
+                                            for t, c in centers.iteritems()))
+
+    def test_centers(self):
+        out = self.op.Output[:].wait()
+        assert out.shape == self.img.shape
+        assert np.sum(out[0]) == 3
+        assert np.sum(out[1]) == 1
+        assert out[0, 4, 4, 4, 0] == 1
+        assert out[0, 24, 24, 24, 0] == 1
+        assert out[0, 42, 42, 42, 0] == 1
+        assert out[1, 24, 24, 24, 0] == 1
+
+    def test_subregion(self):
+        out = self.op.Output[0:1, 20:45, 20:45, 20:45, :].wait()
+        assert np.sum(out) == 2
+        assert out[0, 4, 4, 4, 0] == 1
+        assert out[0, 22, 22, 22, 0] == 1
+
+        out = self.op.Output[1:2, 0:20, 0:20, 0:20, :].wait()
+        assert np.sum(out) == 0
+
 
 class testOpRegionFeaturesAgainstNumpy(object):
     def setUp(self):
@@ -187,6 +258,56 @@ class testOpRegionFeaturesAgainstNumpy(object):
                     center_good = mins[iobj][icoord] + (maxs[iobj][icoord]-mins[iobj][icoord])/2.
                     assert abs(coord-center_good)<0.01
 
+    def test_batches(self):
+        # the local features don't depend on how many objects are passed
+        # to the plugins at once
+        def compute(batch_size):
+            saved = opObjectExtraction.local_features_batch_size
+            opObjectExtraction.local_features_batch_size = batch_size
+            try:
+                op = OpRegionFeatures(graph=self.op.graph)
+                op.LabelImage.connect(self.labelop.Output)
+                op.RawImage.setValue(self.rawimage)
+                op.Features.setValue(self.features)
+                opAdapt = OpAdaptTimeListRoi(graph=self.op.graph)
+                opAdapt.Input.connect(op.Output)
+                return opAdapt.Output([0, 1]).wait()
+            finally:
+                opObjectExtraction.local_features_batch_size = saved
+
+        unbatched = compute(1)
+        for batch_size in (2, 256):
+            batched = compute(batch_size)
+            for t in [0, 1]:
+                assert sorted(batched[t][NAME].keys()) == sorted(unbatched[t][NAME].keys())
+                for key, value in unbatched[t][NAME].iteritems():
+                    np.testing.assert_array_equal(batched[t][NAME][key], value)
+
+
+class PartialFeaturesPlugin(ObjectFeaturesPlugin):
+    """computes its feature for non-empty objects only"""
+    def compute_local(self, image, binary_bbox, features, axes):
+        if binary_bbox.any():
+            return {'partial': np.array([1.0])}
+        return {}
+
+
+class TestComputeLocalBatch(object):
+    def test_missing_feature(self):
+        # a feature that is missing for some objects is an error, not dropped
+        plugin = PartialFeaturesPlugin()
+        images = [np.zeros((2, 2, 2, 1))] * 2
+        bboxes = [np.ones((2, 2, 2, 1), dtype=bool), np.zeros((2, 2, 2, 1), dtype=bool)]
+        try:
+            plugin.compute_local_batch(images, bboxes, {'partial' : {}}, None)
+        except Exception as e:
+            assert 'partial' in str(e)
+        else:
+            assert False, "a feature missing for some objects was not reported"
+
+        result = plugin.compute_local_batch(images[:1], bboxes[:1], {'partial' : {}}, None)
+        assert result['partial'].shape == (1, 1)
+
 
 if __name__ == '__main__':
     import sys
@@ -0,0 +1,118 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from ilastik.applets.thresholdTwoLevels.opBlockwiseLabelVolume import OpBlockwiseLabelVolume
+
+
+def assertSamePartition(labels, expected):
+    """Both label images must contain the same objects, possibly numbered differently."""
+    labels = numpy.asarray(labels).ravel()
+    expected = numpy.asarray(expected).ravel()
+    assert numpy.all((labels == 0) == (expected == 0)), "Different background"
+    pairs = set(zip(labels, expected))
+    assert len(pairs) == len(numpy.unique(labels)) == len(numpy.unique(expected)), \
+        "Objects were split or merged"
+
+
+class TestOpBlockwiseLabelVolume(object):
+    def setUp(self):
+        numpy.random.seed(0)
+        self.data = (numpy.random.random((2, 30, 25, 20, 2)) > 0.6).astype(numpy.uint8)
+        self.data = vigra.taggedView(self.data, 'txyzc')
+
+        self.op = OpBlockwiseLabelVolume(graph=Graph())
+        self.op.Input.setValue(self.data)
+        self.op.BlockShape3dDict.setValue({'x': 8, 'y': 7, 'z': 6})
+
+    def checkLabels(self, labels, data):
+        for t in range(data.shape[0]):
+            for c in range(data.shape[4]):
+                volume = data[t, ..., c]
+                if volume.shape[2] == 1:
+                    expected = vigra.analysis.labelImageWithBackground(numpy.asarray(volume[..., 0]))
+                else:
+                    expected = vigra.analysis.labelVolumeWithBackground(numpy.asarray(volume))
+                assertSamePartition(labels[t, ..., c].squeeze(), expected)
+                # consecutive labels
+                assert labels[t, ..., c].max() == expected.max()
+
+    def testLabels(self):
+        labels = self.op.Output[:].wait()
+        assert labels.dtype == numpy.uint32
+        self.checkLabels(labels, self.data)
+
+        cached = self.op.CachedOutput[:].wait()
+        assert numpy.all(cached == labels)
+
+    def testSubregion(self):
+        labels = self.op.Output[:].wait()
+        part = self.op.Output[1:2, 5:19, 3:20, 4:13, 1:2].wait()
+        assert numpy.all(part == labels[1:2, 5:19, 3:20, 4:13, 1:2])
+
+    def test2d(self):
+        data = vigra.taggedView(numpy.ascontiguousarray(self.data[:, :, :, 0:1, :]), 'txyzc')
+        self.op.Input.setValue(data)
+        self.checkLabels(self.op.Output[:].wait(), data)
+
+    def testComponentSizes(self):
+        labels = self.op.Output[:].wait()
+        sizes = self.op.ComponentSizes[:].wait()
+        assert sizes.shape == (2, 2)
+        for t in range(2):
+            for c in range(2):
+                expected = numpy.bincount(labels[t, ..., c].ravel())
+                assert numpy.all(sizes[t, c] == expected)
+
+    def testDirty(self):
+        self.op.Output[:].wait()
+
+        # connect all objects of the first time slice
+        data = self.data.copy()
+        data[0, :, :, 0, :] = 1
+        self.op.Input.setValue(data)
+        labels = self.op.Output[:].wait()
+        self.checkLabels(labels, data)
+
+
+    def testDirtyWhileComputing(self):
+        # lookup tables of outdated data are not kept
+        data = self.data.copy()
+        data[0, :, :, 0, :] = 1
+        changed = []
+        computeLuts = self.op._computeLuts
+        def changingComputeLuts(t, c):
+            luts = computeLuts(t, c)
+            if not changed:
+                changed.append((t, c))
+                self.op.Input.setValue(data)
+            return luts
+        self.op._computeLuts = changingComputeLuts
+
+        self.op.Output[0:1, :, :, :, 0:1].wait()
+        assert (0, 0) not in self.op._luts
+        self.checkLabels(self.op.Output[:].wait(), data)
+
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -21,12 +21,15 @@ np = numpy
 from lazyflow.graph import Graph
 from lazyflow.operators import Op5ifyer
 from ilastik.applets.thresholdTwoLevels.opThresholdTwoLevels \
-    import OpThresholdTwoLevels, OpSelectLabels
+    import OpThresholdTwoLevels, OpSelectLabels, OpAnisotropicGaussianSmoothing
+from ilastik.applets.thresholdTwoLevels.opBlockwiseLabelVolume import OpBlockwiseLabelVolume
 
 from ilastik.applets.thresholdTwoLevels.opThresholdTwoLevels\
     import _OpThresholdOneLevel as OpThresholdOneLevel
 from ilastik.applets.thresholdTwoLevels.opThresholdTwoLevels\
     import _OpThresholdTwoLevels as OpThresholdTwoLevels5d
+from ilastik.applets.thresholdTwoLevels.opThresholdTwoLevels\
+    import _OpFilterLabels5d as OpFilterLabels5d
 
 import ilastik.ilastik_logging
 ilastik.ilastik_logging.default_config.init()
@@ -351,6 +354,145 @@ class TestThresholdTwoLevels(Generator2):
         out = op.Output[...].wait()
         numpy.testing.assert_array_equal(out, big*0)
 
+    def testOpSelectLabelsRelabels(self):
+        op = OpSelectLabels(graph=Graph())
+
+        small = numpy.asarray(
+            [[0, 0, 0, 0, 0],
+             [0, 0, 0, 0, 1],
+             [0, 0, 0, 0, 0],
+             [2, 0, 0, 0, 0]])
+        big = numpy.asarray(
+            [[1, 1, 0, 2, 2],
+             [0, 0, 0, 2, 2],
+             [0, 3, 0, 0, 0],
+             [3, 3, 0, 4, 4]])
+
+        op.BigLabels.setValue(big)
+        op.SmallLabels.setValue(small)
+        out = op.Output[...].wait()
+
+        # labels 2 and 3 overlap, they become 1 and 2
+        expected = numpy.asarray(
+            [[0, 0, 0, 1, 1],
+             [0, 0, 0, 1, 1],
+             [0, 2, 0, 0, 0],
+             [2, 2, 0, 0, 0]])
+        numpy.testing.assert_array_equal(out, expected)
+
+    def testOpSelectLabelsBlockwise(self):
+        op = OpSelectLabels(graph=Graph())
+
+        small = numpy.zeros((1, 4, 5, 1, 1), dtype=numpy.uint32)
+        small[0, 1, 4, 0, 0] = 1
+        small[0, 3, 0, 0, 0] = 2
+        big = numpy.asarray(
+            [[1, 1, 0, 2, 2],
+             [0, 0, 0, 2, 2],
+             [0, 3, 0, 0, 0],
+             [3, 3, 0, 4, 4]], dtype=numpy.uint32).reshape((1, 4, 5, 1, 1))
+
+        op.BigLabels.setValue(vigra.taggedView(big, 'txyzc'))
+        op.SmallLabels.setValue(vigra.taggedView(small, 'txyzc'))
+        op.BlockShape3dDict.setValue({'x': 2, 'y': 2, 'z': 1})
+
+        # labels 2 and 3 overlap and keep their ids, in every block
+        expected = numpy.where((big == 2) | (big == 3), big, 0)
+        out = op.Output[:].wait()
+        numpy.testing.assert_array_equal(out, expected)
+        part = op.Output[:, 0:2, 0:2, :, :].wait()
+        numpy.testing.assert_array_equal(part, expected[:, 0:2, 0:2, :, :])
+
+    def testOpSelectLabelsBlockwiseDirty(self):
+        # only the dirty time slices are selected again
+        op = OpSelectLabels(graph=Graph())
+        big = numpy.zeros((2, 4, 5, 1, 1), dtype=numpy.uint32)
+        big[:, 0:2, 0:2] = 1
+        big[:, 2:4, 3:5] = 2
+        small = numpy.zeros_like(big)
+        small[:, 0, 0] = 1
+        op.BigLabels.setValue(vigra.taggedView(big, 'txyzc'))
+        op.SmallLabels.setValue(vigra.taggedView(small, 'txyzc'))
+        op.BlockShape3dDict.setValue({'x': 2, 'y': 2, 'z': 1})
+        op.Output[:].wait()
+
+        dirty = []
+        op.Output.notifyDirty(lambda slot, roi: dirty.append((tuple(roi.start), tuple(roi.stop))))
+        small[1, 3, 4] = 1
+        op.SmallLabels.setDirty((1, 3, 4, 0, 0), (2, 4, 5, 1, 1))
+        assert dirty == [((1, 0, 0, 0, 0), (2, 4, 5, 1, 1))]
+        assert (0, 0) in op._luts and (1, 0) not in op._luts
+
+        out = op.Output[:].wait()
+        numpy.testing.assert_array_equal(out[0], numpy.where(big[0] == 1, big[0], 0))
+        numpy.testing.assert_array_equal(out[1], big[1])
+
+    def testOpFilterLabels5dComponentSizes(self):
+        # the sizes are taken from ComponentSizes, not counted
+        labels = numpy.zeros((1, 4, 3, 2, 1), dtype=numpy.uint32)
+        labels[0, 0, 0, 0:2, 0] = 1
+        labels[0, 1:3, 0, 0:2, 0] = 2
+        labels = vigra.taggedView(labels, 'txyzc')
+        sizes = numpy.empty((1, 1), dtype=object)
+        sizes[0, 0] = numpy.array([0, 10, 4])
+
+        op = OpFilterLabels5d(graph=Graph())
+        op.Input.setValue(labels)
+        op.ComponentSizes.setValue(sizes)
+        op.MinLabelSize.setValue(3)
+        op.MaxLabelSize.setValue(5)
+        out = op.Output[:].wait()
+        numpy.testing.assert_array_equal(out, numpy.where(labels == 2, labels, 0))
+
+        # labels without a size (e.g. outdated sizes) are removed
+        sizes = numpy.empty((1, 1), dtype=object)
+        sizes[0, 0] = numpy.array([0, 4])
+        op.ComponentSizes.setValue(sizes)
+        out = op.Output[:].wait()
+        numpy.testing.assert_array_equal(out, numpy.where(labels == 1, labels, 0))
+
+    def testOpFilterLabels5d(self):
+        # time slice 0: label 1 has 2 pixels, label 2 has 4 and label 3 has 6
+        # time slice 1: label 1 has 6 pixels
+        labels = numpy.zeros((2, 4, 3, 2, 1), dtype=numpy.uint32)
+        labels[0, 0, 0, 0:2, 0] = 1
+        labels[0, 1:3, 0, 0:2, 0] = 2
+        labels[0, 1:4, 1:3, 1, 0] = 3
+        labels[1, 0:3, 0:2, 0, 0] = 1
+        labels = vigra.taggedView(labels, 'txyzc')
+
+        op = OpFilterLabels5d(graph=Graph())
+        op.Input.setValue(labels)
+        op.MinLabelSize.setValue(3)
+        op.MaxLabelSize.setValue(5)
+        out = op.Output[:].wait()
+        expected = numpy.where(labels == 2, labels, 0)
+        expected[1] = 0
+        numpy.testing.assert_array_equal(out, expected)
+
+        # the sizes are those of the whole slice, not of the requested region
+        part = op.Output[0:1, 1:2, 0:1, :, :].wait()
+        numpy.testing.assert_array_equal(part, expected[0:1, 1:2, 0:1, :, :])
+
+        op.MaxLabelSize.setValue(6)
+        out = op.Output[:].wait()
+        expected = numpy.array(labels)
+        expected[0][labels[0] == 1] = 0
+        numpy.testing.assert_array_equal(out, expected)
+
+        op.BinaryOut.setValue(True)
+        out = op.Output[:].wait()
+        numpy.testing.assert_array_equal(out, expected > 0)
+
+        # label 1 of time slice 0 grows to 4 pixels
+        labels = labels.copy()
+        labels[0, 0, 2, 0:2, 0] = 1
+        op.Input.setValue(labels)
+        op.BinaryOut.setValue(False)
+        op.MinLabelSize.setValue(4)
+        out = op.Output[:].wait()
+        numpy.testing.assert_array_equal(out, labels)
+
     def testSimpleUsage(self):
         oper5d = OpThresholdTwoLevels(graph=Graph())
         oper5d.InputImage.setValue(self.data5d)
@@ -537,6 +679,113 @@ class TestThresholdTwoLevels(Generator2):
         numpy.testing.assert_array_almost_equal(output*output2, output)
 
 
+    def testBlockwiseLabeling(self):
+        g = Graph()
+        oper = OpThresholdTwoLevels(graph=g)
+        oper.InputImage.setValue(self.data5d)
+        oper.MinSize.setValue(self.minSize)
+        oper.MaxSize.setValue(self.maxSize)
+        oper.HighThreshold.setValue(self.highThreshold)
+        oper.LowThreshold.setValue(self.lowThreshold)
+        oper.SmootherSigma.setValue({'x': 0, 'y': 0, 'z': 0})
+        oper.CurOperator.setValue(1)
+        expected = oper.Output[:].wait()
+
+        # the objects are cut by the blocks, but have to be merged again
+        oper.LabelingBlockShape3dDict.setValue({'x': 16, 'y': 16, 'z': 16})
+        oper.BlockwiseLabeling.setValue(True)
+        output = oper.Output[:].wait()
+        numpy.testing.assert_array_equal(output > 0, expected > 0)
+
+        output = vigra.taggedView(output, axistags=oper.Output.meta.axistags)
+        self.checkResult(output[0:1, ...])
+
+    def testBlockwiseLabelingRequests(self):
+        # with blockwise labeling, no more than a block is requested from the
+        # labelers, and the caches after them have the same block shape
+        rois = []
+        execute = OpBlockwiseLabelVolume.__dict__['execute']
+        def recordingExecute(op, slot, subindex, roi, result):
+            if slot == op.Output:
+                rois.append(numpy.subtract(roi.stop, roi.start))
+            return execute(op, slot, subindex, roi, result)
+        OpBlockwiseLabelVolume.execute = recordingExecute
+
+        try:
+            oper = OpThresholdTwoLevels(graph=Graph())
+            oper.InputImage.setValue(self.data5d)
+            oper.MinSize.setValue(self.minSize)
+            oper.MaxSize.setValue(self.maxSize)
+            oper.HighThreshold.setValue(self.highThreshold)
+            oper.LowThreshold.setValue(self.lowThreshold)
+            oper.SmootherSigma.setValue({'x': 0, 'y': 0, 'z': 0})
+            oper.LabelingBlockShape3dDict.setValue({'x': 16, 'y': 16, 'z': 16})
+            oper.BlockwiseLabeling.setValue(True)
+            for curOperator in (1, 0):
+                oper.CurOperator.setValue(curOperator)
+                output = oper.CachedOutput[:].wait()
+                assert len(rois) > 0
+                for shape in rois:
+                    assert numpy.all(shape[1:4] <= 16), "Requested {} from the labeler".format(shape)
+                del rois[:]
+            output = vigra.taggedView(output, axistags=oper.CachedOutput.meta.axistags)
+            assert output.max() > 0
+        finally:
+            OpBlockwiseLabelVolume.execute = execute
+
+        oper5d = oper.opThreshold2
+        blockshape = (1, 16, 16, 16, 1)
+        assert oper5d._opCache.BlockShape.value == blockshape
+        assert oper5d._opFilteredSmallLabelsCache.BlockShape.value == blockshape
+
+    def testSmoothingCached(self):
+        # count the calls to the smoother
+        calls = []
+        execute = OpAnisotropicGaussianSmoothing.__dict__['execute']
+        def countingExecute(*args, **kwargs):
+            calls.append(1)
+            return execute(*args, **kwargs)
+        OpAnisotropicGaussianSmoothing.execute = countingExecute
+
+        try:
+            oper = OpThresholdTwoLevels(graph=Graph())
+            oper.InputImage.setValue(self.data5d)
+            oper.MinSize.setValue(self.minSize)
+            oper.MaxSize.setValue(self.maxSize)
+            oper.HighThreshold.setValue(self.highThreshold)
+            oper.LowThreshold.setValue(self.lowThreshold)
+            oper.SmootherSigma.setValue(self.sigma)
+            oper.CurOperator.setValue(1)
+            oper.Output[:].wait()
+            assert len(calls) > 0
+            del calls[:]
+
+            # neither the thresholds nor the mode change the smoothed image
+            oper.HighThreshold.setValue(self.highThreshold * 0.9)
+            oper.Output[:].wait()
+            oper.CurOperator.setValue(0)
+            oper.SingleThreshold.setValue(self.lowThreshold)
+            oper.Output[:].wait()
+            assert len(calls) == 0
+
+            oper.SmootherSigma.setValue({'x': 0.5, 'y': 0.5, 'z': 0.5})
+            oper.Output[:].wait()
+            assert len(calls) > 0
+        finally:
+            OpAnisotropicGaussianSmoothing.execute = execute
+
+
+    def testSmoothedCacheBlockShape(self):
+        # the cache holds whole time slices, whatever the axis order
+        for axes in ('txyzc', 'xyzct', 'cxyzt'):
+            oper = OpThresholdTwoLevels(graph=Graph())
+            oper.InputImage.setValue(self.data5d.withAxes(*axes))
+            assert oper.Smoothed.ready()
+            tagged_shape = oper.Smoothed.meta.getTaggedShape()
+            tagged_shape['t'] = 1
+            assert oper._opSmoothedCache.BlockShape.value == tuple(tagged_shape.values())
+
+
 class TestTTLUseCase(unittest.TestCase):
     def setUp(self):
         # The setting: